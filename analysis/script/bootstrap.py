@@ -0,0 +1,257 @@
+"""
+Bootstrap confidence intervals for per-country rates: how often each country's stories use a word
+(mean count per story), and the share of its stories with each sentiment.
+
+The stories of every country are resampled with replacement n_resamples times, for all countries
+and all target words at once:
+- the countries are padded to the same number of stories and processed in blocks
+- the resampling weights (how often each story is drawn in each resample) come from one seeded
+  generator and are kept as uint8
+- the resampled totals of a block are one batched matrix product of the weights and the per-story
+  counts
+- as the per-story values are counts, the totals are integers, and the percentiles are read off
+  one histogram of the totals of the whole block instead of sorting every resample
+
+`words` and `sentiments` write word_rates.csv and sentiment_rates.csv to analysis/data/bootstrap/:
+one row per country and word (or sentiment) with the rate, the bounds of the interval and the
+number of stories. The per-story counts come from <CC>_story_lemmas.csv (the words analysis) and
+<CC>_sentiments.csv.
+
+Run from the repository root, e.g.
+`python3 analysis/script/bootstrap.py words -n 200` or `python3 analysis/script/bootstrap.py words -w war -w fight`
+"""
+
+import os
+import time
+import click
+import numpy as np
+import pandas as pd
+from story_vectors import load_lemma_counts
+
+BOOTSTRAP_DIR = "analysis/data/bootstrap"
+
+N_RESAMPLES = 10000
+LEVEL = 0.95
+BLOCK_SIZE = 4  # Countries per block: the totals of a block take BLOCK_SIZE x n_resamples x targets x 4 bytes
+
+
+def resample_weights(rng, sizes, n_resamples, n_max):
+    """
+    How often each story is drawn in each resample of each country.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+    sizes : numpy.ndarray
+        Number of stories of each country (at most n_max).
+    n_resamples : int
+    n_max : int
+        Number of stories the countries are padded to.
+
+    Returns
+    -------
+    numpy.ndarray
+        countries x resamples x n_max, uint8 (uint16 for more than 255 stories). Every resample of a
+        country draws as many stories as it has, and never draws its padding.
+    """
+    dtype = np.uint8 if n_max < 256 else np.uint16
+    k = len(sizes)
+    # Uniform story numbers below each country's size (scaling uniform floats is much faster than
+    # integers() with a different bound per country)
+    draws = (rng.random((k, n_resamples, n_max)) * sizes[:, None, None]).astype(np.int64)
+    # Only the first size draws of a country count, the rest go to an extra bin that is dropped
+    if (sizes < n_max).any():
+        draws = np.where(np.arange(n_max) < sizes[:, None, None], draws, n_max)
+    rows = np.arange(k * n_resamples)[:, None] * (n_max + 1)
+    counts = np.bincount((rows + draws.reshape(k * n_resamples, n_max)).ravel(), minlength=k * n_resamples * (n_max + 1))
+    return counts.reshape(k, n_resamples, n_max + 1)[:, :, :n_max].astype(dtype)
+
+
+def histogram_quantiles(totals, quantiles):
+    """
+    Quantiles of integer values along the last axis, from one histogram of all the values.
+
+    Parameters
+    ----------
+    totals : numpy.ndarray
+        ... x resamples, integer valued.
+    quantiles : list of float
+
+    Returns
+    -------
+    numpy.ndarray
+        len(quantiles) x ..., the smallest value whose share of resamples at or below it is at
+        least the quantile (numpy's 'inverted_cdf').
+    """
+    shape = totals.shape[:-1]
+    n_resamples = totals.shape[-1]
+    totals = totals.reshape(-1, n_resamples)
+    low = totals.min(axis=1).astype(np.int64)
+    spans = totals.max(axis=1).astype(np.int64) - low + 1
+    offsets = np.concatenate([[0], np.cumsum(spans)[:-1]])
+    # Shift every column to its own range of bins, converting to integers in the same pass
+    bins = np.empty(totals.shape, dtype=np.int64)
+    np.add(totals, (offsets - low)[:, None], out=bins, casting='unsafe')
+    cumulative = np.cumsum(np.bincount(bins.ravel(), minlength=spans.sum()))
+    # The resamples of the columns before each column
+    before = np.arange(len(spans)) * n_resamples
+    result = np.empty((len(quantiles), len(spans)), dtype=np.int64)
+    for i, q in enumerate(quantiles):
+        position = np.searchsorted(cumulative, before + max(q * n_resamples, 1), side='left')
+        result[i] = position - offsets + low
+    return result.reshape((len(quantiles),) + shape)
+
+
+def bootstrap_rates(values, groups, n_resamples=N_RESAMPLES, level=LEVEL, seed=0, block_size=BLOCK_SIZE):
+    """
+    Percentile bootstrap intervals of the mean per-story value of each target, per group.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        stories x targets, non-negative integer counts (e.g. uses of each word, or 0/1 per sentiment).
+    groups : numpy.ndarray
+        Group (country) number of each story, 0 to the number of groups - 1.
+    n_resamples : int
+    level : float
+        Confidence level of the intervals.
+    seed : int
+        Seed of the generator the resampling weights are drawn from.
+    block_size : int
+        Groups resampled together.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        The rates, lower and upper bounds (groups x targets, float32), and the stories per group.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = np.bincount(groups)
+    n_max = sizes.max()
+
+    # Pad each group to n_max stories: groups x n_max x targets
+    order = np.argsort(groups, kind='stable')
+    position = np.arange(len(groups)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    padded = np.zeros((len(sizes), n_max, values.shape[1]), dtype=np.float32)
+    padded[groups[order], position] = values[order]
+
+    alpha = (1 - level) / 2
+    low = np.empty((len(sizes), values.shape[1]), dtype=np.float32)
+    high = np.empty_like(low)
+    for start in range(0, len(sizes), block_size):
+        block = slice(start, start + block_size)
+        weights = resample_weights(rng, sizes[block], n_resamples, n_max).astype(np.float32)
+        # targets x resamples totals of each group; float32 is exact for totals below 2**24
+        totals = np.matmul(padded[block].transpose(0, 2, 1), weights.transpose(0, 2, 1))
+        bounds = histogram_quantiles(totals, [alpha, 1 - alpha])
+        low[block] = bounds[0] / sizes[block, None]
+        high[block] = bounds[1] / sizes[block, None]
+
+    rates = (padded.sum(axis=1) / np.maximum(sizes, 1)[:, None]).astype(np.float32)
+    return rates, low, high, sizes
+
+
+def rate_table(rates, low, high, sizes, countries, targets, target_name):
+    """
+    The results of bootstrap_rates as one row per country and target.
+    """
+    return pd.DataFrame({
+        'country': np.repeat(countries, len(targets)),
+        target_name: np.tile(targets, len(countries)),
+        'rate': rates.ravel().round(5),
+        'low': low.ravel().round(5),
+        'high': high.ravel().round(5),
+        'stories': np.repeat(sizes, len(targets)),
+    })
+
+
+def word_rates(base_dir="data", words=None, n_words=200, **options):
+    """
+    Bootstrap intervals of the mean uses per story of words in every country.
+
+    Parameters
+    ----------
+    words : list of str, optional
+        Lemmas to compute the rates of (default: the n_words most used lemmas).
+    options
+        Passed on to bootstrap_rates.
+    """
+    counts, stories, lemmas, _ = load_lemma_counts(base_dir)
+    if words:
+        columns = np.flatnonzero(np.isin(lemmas, words))
+        missing = sorted(set(words) - set(lemmas[columns]))
+        if not len(columns):
+            raise click.ClickException(f"None of the lemmas are in the lemma counts of {base_dir}: {', '.join(missing)}")
+        if missing:
+            print(f"Skipping the lemmas that are not in the lemma counts: {', '.join(missing)}")
+    else:
+        totals = np.asarray(counts.sum(axis=0)).ravel()
+        columns = np.argsort(-totals, kind='stable')[:n_words]
+    groups, countries = pd.factorize(stories['country'], sort=True)
+    values = counts[:, columns].toarray()
+    rates, low, high, sizes = bootstrap_rates(values, groups, **options)
+    return rate_table(rates, low, high, sizes, np.asarray(countries), lemmas[columns], 'word')
+
+
+def sentiment_rates(base_dir="data", **options):
+    """
+    Bootstrap intervals of the share of stories with each sentiment in every country.
+    """
+    frames = []
+    for directory in sorted(os.listdir(base_dir)):
+        file_path = os.path.join(base_dir, directory, f"{directory}_sentiments.csv")
+        if os.path.exists(file_path):
+            frames.append(pd.read_csv(file_path, usecols=['sentiment']).assign(country=directory))
+    if not frames:
+        raise click.ClickException(f"No <CC>_sentiments.csv files in {base_dir}")
+    sentiments = pd.concat(frames, ignore_index=True)
+    groups, countries = pd.factorize(sentiments['country'], sort=True)
+    labels, names = pd.factorize(sentiments['sentiment'], sort=True)
+    values = np.zeros((len(sentiments), len(names)), dtype=np.float32)
+    values[np.arange(len(sentiments)), labels] = 1
+    rates, low, high, sizes = bootstrap_rates(values, groups, **options)
+    return rate_table(rates, low, high, sizes, np.asarray(countries), np.asarray(names), 'sentiment')
+
+
+def save(table, file_name, started):
+    os.makedirs(BOOTSTRAP_DIR, exist_ok=True)
+    output_file = os.path.join(BOOTSTRAP_DIR, file_name)
+    table.to_csv(output_file, index=False)
+    print(f"{table['country'].nunique()} countries x {len(table) // table['country'].nunique()} rates "
+          f"in {time.perf_counter() - started:.1f}s, saved to {output_file}")
+
+
+@click.group()
+def cli():
+    pass
+
+
+def bootstrap_options(command):
+    command = click.option('--seed', type=int, default=0, show_default=True)(command)
+    command = click.option('--level', type=float, default=LEVEL, show_default=True, help='Confidence level')(command)
+    command = click.option('-r', '--resamples', 'n_resamples', type=int, default=N_RESAMPLES, show_default=True)(command)
+    return click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')(command)
+
+
+@cli.command()
+@bootstrap_options
+@click.option('-w', '--word', 'words', multiple=True, help='Lemma to compute the rates of (repeat for more)')
+@click.option('-n', '--n-words', type=int, default=200, show_default=True, help='Number of most used lemmas, without -w')
+def words(base_dir, n_resamples, level, seed, words, n_words):
+    """Intervals of the uses per story of words in every country."""
+    started = time.perf_counter()
+    table = word_rates(base_dir, list(words), n_words, n_resamples=n_resamples, level=level, seed=seed)
+    save(table, "word_rates.csv", started)
+
+
+@cli.command()
+@bootstrap_options
+def sentiments(base_dir, n_resamples, level, seed):
+    """Intervals of the share of stories with each sentiment in every country."""
+    started = time.perf_counter()
+    table = sentiment_rates(base_dir, n_resamples=n_resamples, level=level, seed=seed)
+    save(table, "sentiment_rates.csv", started)
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,9 +2,11 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-def plot_top_words_boxplot(csv_path="..analysis/data/filtered_word_freq.csv", 
-                           num_words=20, 
-                           output_path="../analysis/figures/top_words_boxplot.png"):
+def plot_top_words_boxplot(csv_path="analysis/data/filtered_word_freq.csv",
+                           num_words=20,
+                           output_path="analysis/figures/top_words_boxplot.png",
+                           words=None,
+                           show=True):
     """
     Reads a CSV file containing word frequencies by country, selects the top N words globally,
     and generates a boxplot of their frequency distribution across countries.
@@ -13,50 +15,60 @@ def plot_top_words_boxplot(csv_path="..analysis/data/filtered_word_freq.csv",
     - csv_path (str): Path to the CSV file containing the data.
     - num_words (int): Number of top words to include in the analysis.
     - output_path (str): Path to save the generated plot.
+    - words (list, optional): Plot these words instead of the top N, e.g. ["fight", "protest", "clash", "soldier", "war"].
+    - show (bool): Show the plot in a window, or close it after saving.
     """
 
     # Load data
-    df = pd.read_csv(csv_path)
+    df = pd.read_csv(csv_path, keep_default_na=False, na_values=[""])
+    fig = plot_top_words(df, num_words, words)
+
+    # Save the plot
+    fig.savefig(output_path, dpi=300, bbox_inches="tight")
+    if show:
+        plt.show()  # Show the plot for interactive environments
+    else:
+        plt.close(fig)
+
+
+def plot_top_words(df, num_words=20, words=None):
+    """
+    Boxplot of the frequency of the top N words (or the given words) across the columns of a word
+    frequency table (countries or sub-regions), labelling each box with the column where the word is most used.
+
+    Returns:
+    - The matplotlib Figure.
+    """
 
     # Identify country columns (excluding metadata)
     country_columns = [col for col in df.columns if col not in ["Word", "global_freq", "num_countries"]]
 
-    # Identify the top N most used words based on global frequency
-    top_words = df.nlargest(num_words, "global_freq")["Word"]
-
-    # Filter dataset to only include the top words
-    #df_top = df[df["Word"].isin(top_words)]
-    ## **** NOTE TESTING HERE REMOVE IF DOESNT WORK ****
-    df_top = df[df["Word"].isin(["fight", "protest","clash","soldier","war"])]
+    # Identify the top N most used words based on global frequency, unless the words are given
+    if words is None:
+        df_top = df.nlargest(num_words, "global_freq")
+    else:
+        df_top = df[df["Word"].isin(words)]
 
     # Sort words by global frequency in descending order
     df_top_sorted = df_top.sort_values(by="global_freq", ascending=False)
 
     # Melt the DataFrame for visualization
     df_melted = df_top_sorted.melt(id_vars=["Word"], value_vars=country_columns, var_name="Country", value_name="Frequency")
-    print(df_melted)
+
     # Set up the figure
-    plt.figure(figsize=(14, 6))
+    fig, ax = plt.subplots(figsize=(14, 6))
 
     # Create a box plot with visible outliers
-    ax = sns.boxplot(data=df_melted, x="Word", y="Frequency", showfliers=True, order=df_top_sorted["Word"])
-
-    # Annotate key outliers
-    for i, word in enumerate(df_top_sorted["Word"]):
-        word_data = df_melted[df_melted["Word"] == word]
-
-        # Find the country with the highest frequency for each word
-        max_freq_row = word_data.loc[word_data["Frequency"].idxmax()]
-
-        # Find the 90th percentile as an additional threshold for outliers
-        q90 = word_data["Frequency"].quantile(0.90)
-        high_outliers = word_data[word_data["Frequency"] >= q90]
+    sns.boxplot(data=df_melted, x="Word", y="Frequency", showfliers=True, order=df_top_sorted["Word"], ax=ax)
 
-        # Annotate max frequency country with jitter
+    # Annotate the country with the highest frequency for each word
+    max_freq_rows = df_melted.loc[df_melted.groupby("Word")["Frequency"].idxmax()].set_index("Word")
+    max_freq_rows = max_freq_rows.reindex(df_top_sorted["Word"])
+    for i, (country, frequency) in enumerate(zip(max_freq_rows["Country"], max_freq_rows["Frequency"])):
         ax.text(
             x=i,
-            y=max_freq_row["Frequency"] + 20,  # Offset label
-            s=max_freq_row["Country"],
+            y=frequency + 20,  # Offset label
+            s=country,
             horizontalalignment='center',
             verticalalignment='bottom',
             fontsize=12,
@@ -65,20 +77,17 @@ def plot_top_words_boxplot(csv_path="..analysis/data/filtered_word_freq.csv",
         )
 
     # Customize plot appearance
-    plt.ylim(bottom=0, top=max(df_melted["Frequency"]))  # Adjust y-axis
-    plt.title(f"Top {num_words} Most Used Words - Frequency Distribution Across Countries", fontsize=14)
-    plt.xlabel("Word", fontsize=10)
-    plt.ylabel("Frequency", fontsize=12)
-    plt.xticks(rotation=90, fontsize=12)
-    plt.yticks(fontsize=12)
-
-    # Save the plot
-    plt.savefig(output_path, dpi=300, bbox_inches="tight")
-    plt.show()  # Show the plot for interactive environments
+    ax.set_ylim(bottom=0, top=max(df_melted["Frequency"]))  # Adjust y-axis
+    ax.set_title(f"Top {len(df_top_sorted)} Most Used Words - Frequency Distribution Across Countries", fontsize=14)
+    ax.set_xlabel("Word", fontsize=10)
+    ax.set_ylabel("Frequency", fontsize=12)
+    plt.setp(ax.get_xticklabels(), rotation=90, fontsize=12)
+    plt.setp(ax.get_yticklabels(), fontsize=12)
+    return fig
 
 # Example usage:
 # plot_top_words_boxplot()
 
-plot_top_words_boxplot("analysis/data/regional_word_freq.csv", 
-20, "analysis/figures/regional_top_words_boxplot.png")
-
+if __name__ == "__main__":
+    plot_top_words_boxplot("analysis/data/regional_word_freq.csv",
+    20, "analysis/figures/regional_top_words_boxplot.png")
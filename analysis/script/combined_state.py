@@ -0,0 +1,222 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def file_fingerprint(file_path, previous=None):
+    """
+    Return (size, mtime_ns, sha256) of a file. The hash is only recomputed when the size or
+    modification time differ from the previous fingerprint.
+    """
+    stat = os.stat(file_path)
+    if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+        return previous
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+
+def changed_countries(base_dir, data_type, fingerprints):
+    """
+    Compare the per-country <CC>_<data_type>.csv files with the fingerprints of the last run.
+
+    Returns
+    -------
+    tuple of (dict, list)
+        {country: new fingerprint} for new or changed files, and the countries whose file was removed.
+    """
+    changed = {}
+    present = set()
+    for directory in sorted(os.listdir(base_dir)):
+        file_path = os.path.join(base_dir, directory, f"{directory}_{data_type}.csv")
+        if not os.path.exists(file_path):
+            continue
+        present.add(directory)
+        previous = fingerprints.get(directory)
+        fingerprint = file_fingerprint(file_path, previous)
+        if previous is None or fingerprint[2] != previous[2]:
+            changed[directory] = fingerprint
+        elif fingerprint != previous:
+            fingerprints[directory] = fingerprint  # Touched but not changed, remember the new mtime
+    removed = sorted(set(fingerprints) - present)
+    return changed, removed
+
+
+def load_state(state_file, default):
+    """
+    Load the state pickled by a previous run, or return default.
+    """
+    if os.path.exists(state_file):
+        with open(state_file, 'rb') as f:
+            return pickle.load(f)
+    return default
+
+
+def save_state(state_file, state):
+    """
+    Pickle the state to a temporary file and rename it, so an interrupted run keeps the old state.
+    """
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    temporary = f"{state_file}.tmp"
+    with open(temporary, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, state_file)
+
+
+class CombinedCounts:
+    """
+    A term x country count matrix kept between runs, with running totals per term and per group
+    of countries (e.g. sub-region).
+
+    Each country is stored as a sparse column (row indices and counts). Replacing a country
+    subtracts its old column from the totals and adds the new one, so an update costs time in
+    proportion to the countries that changed, not to the whole corpus.
+    """
+
+    def __init__(self, first_column):
+        self.first_column = first_column  # Name of the term column in the output, e.g. 'Word'
+        self.terms = []
+        self.index = {}
+        self.columns = {}  # country -> (row indices, counts)
+        self.fingerprints = {}  # country -> file fingerprint the column was read from
+        self.totals = np.zeros(0)
+        self.groups = {}  # country -> group
+        self.group_totals = {}  # group -> counts per term
+
+    def _rows(self, terms):
+        rows = np.empty(len(terms), dtype=np.int64)
+        for i, term in enumerate(terms):
+            row = self.index.get(term)
+            if row is None:
+                row = self.index[term] = len(self.terms)
+                self.terms.append(term)
+            rows[i] = row
+        # New terms get a zero total
+        if len(self.totals) < len(self.terms):
+            grow = len(self.terms) - len(self.totals)
+            self.totals = np.concatenate([self.totals, np.zeros(grow)])
+            for group in self.group_totals:
+                self.group_totals[group] = np.concatenate([self.group_totals[group], np.zeros(grow)])
+        return rows
+
+    def _apply(self, country, sign):
+        rows, counts = self.columns[country]
+        np.add.at(self.totals, rows, sign * counts)
+        group = self.groups.get(country)
+        if group is not None:
+            np.add.at(self.group_totals[group], rows, sign * counts)
+
+    def remove_country(self, country):
+        if country in self.columns:
+            self._apply(country, -1)
+            del self.columns[country]
+        self.fingerprints.pop(country, None)
+
+    def set_country(self, country, terms, counts, fingerprint=None):
+        """
+        Replace a country's column with new counts (duplicate terms are summed).
+        """
+        self.remove_country(country)
+        rows = self._rows(terms)
+        counts = np.asarray(counts, dtype=float)
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        self.columns[country] = (unique_rows, np.bincount(inverse, weights=counts))
+        self._apply(country, 1)
+        if fingerprint is not None:
+            self.fingerprints[country] = fingerprint
+
+    def set_groups(self, groups):
+        """
+        Assign countries to groups. The group totals are only rebuilt when the assignment changes.
+        """
+        if groups == self.groups:
+            return
+        self.groups = dict(groups)
+        self.group_totals = {group: np.zeros(len(self.terms)) for group in set(groups.values())}
+        for country in self.columns:
+            if country in self.groups:
+                self._apply_group(country)
+
+    def _apply_group(self, country):
+        rows, counts = self.columns[country]
+        np.add.at(self.group_totals[self.groups[country]], rows, counts)
+
+    def countries(self):
+        return sorted(self.columns)
+
+    def matrix(self):
+        """
+        Return the counts as a scipy.sparse CSC matrix (terms x countries), with the countries sorted.
+        """
+        countries = self.countries()
+        indptr = np.cumsum([0] + [len(self.columns[c][0]) for c in countries])
+        indices = np.concatenate([self.columns[c][0] for c in countries]) if countries else np.zeros(0, dtype=np.int64)
+        data = np.concatenate([self.columns[c][1] for c in countries]) if countries else np.zeros(0)
+        return sparse.csc_matrix((data, indices, indptr), shape=(len(self.terms), len(countries)))
+
+    def to_frame(self, rows=None):
+        """
+        The combined table: one row per term (sorted), one column per country.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray of bool, optional
+            Only include the terms where this mask is True.
+        """
+        countries = self.countries()
+        matrix = self.matrix().tocsr()
+        # Terms no country uses any more (their country changed or was removed) are left out
+        keep = np.diff(matrix.indptr) > 0
+        if rows is not None:
+            keep &= rows
+        keep = np.flatnonzero(keep)
+        terms = np.array(self.terms, dtype=object)[keep]
+        order = np.argsort(terms, kind="stable")
+        df = pd.DataFrame(matrix[keep[order]].toarray(), columns=countries)
+        df.insert(0, self.first_column, terms[order])
+        return df
+
+    def group_frame(self, rows=None):
+        """
+        The totals per group: one row per term (sorted), one column per group and a 'global_freq' column.
+        """
+        groups = sorted(self.group_totals)
+        values = np.column_stack([self.group_totals[g] for g in groups]) if groups else np.zeros((len(self.terms), 0))
+        global_freq = values.sum(axis=1)
+        keep = global_freq > 0
+        if rows is not None:
+            keep &= rows
+        keep = np.flatnonzero(keep)
+        terms = np.array(self.terms, dtype=object)[keep]
+        order = np.argsort(terms, kind="stable")
+        df = pd.DataFrame(values[keep[order]], columns=groups)
+        df.insert(0, self.first_column, terms[order])
+        df['global_freq'] = global_freq[keep[order]]
+        return df
+
+    def update(self, base_dir, data_type, read_country):
+        """
+        Bring the state up to date with the per-country files in base_dir.
+
+        Parameters
+        ----------
+        read_country : callable
+            read_country(file_path) -> (terms, counts) for one country's file.
+
+        Returns
+        -------
+        tuple of (list, list)
+            The countries that were (re)read and the countries that were removed.
+        """
+        changed, removed = changed_countries(base_dir, data_type, self.fingerprints)
+        for country in removed:
+            self.remove_country(country)
+        for country, fingerprint in changed.items():
+            terms, counts = read_country(os.path.join(base_dir, country, f"{country}_{data_type}.csv"))
+            self.set_country(country, terms, counts, fingerprint)
+        return list(changed), removed
@@ -0,0 +1,42 @@
+import os
+import pandas as pd
+from countries import add_country_data
+
+
+def load_stories(base_dir="data", countries=None, columns=('Story_ID', 'Story')):
+    """
+    Read the stories of every country into one DataFrame.
+
+    Parameters
+    ----------
+    base_dir : str
+        The data directory (one folder per country).
+    countries : list of str, optional
+        Only read these country codes.
+    columns : tuple of str
+        Columns to read from each <CC>_stories.csv.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The requested columns plus 'country' (the alpha-2 code of the folder), in country order.
+    """
+    frames = []
+    for directory in sorted(os.listdir(base_dir)):
+        if countries and directory not in countries:
+            continue
+        file_path = os.path.join(base_dir, directory, f"{directory}_stories.csv")
+        if os.path.exists(file_path):
+            data = pd.read_csv(file_path, usecols=list(columns), keep_default_na=False)
+            data['country'] = directory
+            frames.append(data)
+    if not frames:
+        return pd.DataFrame(columns=list(columns) + ['country'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def add_regions(df, on='country'):
+    """
+    Add the 'region' and 'sub-region' of each row's country from the country table.
+    """
+    return add_country_data(df, on, ['region', 'sub-region'])
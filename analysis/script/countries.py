@@ -0,0 +1,126 @@
+"""
+The country dimension table, and lookups against it.
+
+One row per country, keyed by its alpha-2 code: alpha-3, the ISO name, a short name for figures and
+tables ("USA", "South Korea", ...), flag emoji, demonym, region, sub-region and population. The table
+is built from support_data/country_data.csv (see country_wrangling.py) into
+support_data/countries.parquet the first time it is used, and rebuilt when TABLE_VERSION changes.
+After that every lookup is a join against the table in memory, so no analysis script needs the network.
+
+Run `python3 analysis/script/countries.py` from the repository root to rebuild the table by hand.
+"""
+
+import os
+import pandas as pd
+
+SUPPORT_DATA = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "support_data"))
+COUNTRY_DATA_FILE = os.path.join(SUPPORT_DATA, "country_data.csv")
+COUNTRIES_FILE = os.path.join(SUPPORT_DATA, "countries.parquet")
+
+# Bump when the columns or SHORT_NAMES change, to rebuild countries.parquet
+TABLE_VERSION = 2
+
+COLUMNS = ['alpha-2', 'alpha-3', 'country_name', 'short_name', 'flag_emoji', 'demonym', 'region', 'sub-region', 'population']
+
+# Short names of the countries whose ISO name is too long or formal for figures and tables.
+# Every other country keeps its ISO name, e.g. "Netherlands (the)".
+SHORT_NAMES = {
+    "United States of America (the)": "USA",
+    "United Kingdom of Great Britain and Northern Ireland (the)": "United Kingdom",
+    "Korea (the Republic of)": "South Korea",
+    "Korea (the Democratic People's Republic of)": "North Korea",
+    "Palestine, State of": "Palestine",
+    "Bolivia (Plurinational State of)": "Bolivia",
+    "Taiwan (Province of China)": "Taiwan",
+    "Russian Federation (the)": "Russia",
+    "Iran (Islamic Republic of)": "Iran",
+    "Venezuela (Bolivarian Republic of)": "Venezuela",
+}
+
+_table = None
+
+
+def short_names(names):
+    """
+    The short name of each ISO country name in a Series. Names that are already short are kept.
+    """
+    return names.replace(SHORT_NAMES)
+
+
+def build_table(country_data_file=COUNTRY_DATA_FILE, countries_file=COUNTRIES_FILE):
+    """
+    Build the country table from country_data.csv and save it to countries_file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The table, indexed by alpha-2 code.
+    """
+    table = pd.read_csv(country_data_file, keep_default_na=False, na_values=[""], dtype={'population': 'float64'})
+    table['short_name'] = short_names(table['country_name'])
+    table = table[COLUMNS].set_index('alpha-2')
+    if not table.index.is_unique:
+        raise ValueError(f"Duplicate country codes in {country_data_file}: {', '.join(table.index[table.index.duplicated()])}")
+    table.attrs['version'] = TABLE_VERSION
+    table.to_parquet(countries_file)
+    return table
+
+
+def load_table(countries_file=COUNTRIES_FILE):
+    """
+    The country table, indexed by alpha-2 code. It is read once per process, and built first if
+    countries_file does not exist or was built by another TABLE_VERSION.
+    """
+    global _table
+    if _table is None:
+        table = pd.read_parquet(countries_file) if os.path.exists(countries_file) else None
+        if table is None or table.attrs.get('version') != TABLE_VERSION:
+            table = build_table(countries_file=countries_file)
+        _table = table
+    return _table
+
+
+def lookup(codes, columns=None):
+    """
+    The rows of the country table for a list of alpha-2 codes, in the same order (NaN for unknown codes).
+
+    Parameters
+    ----------
+    codes : list-like of str
+        Alpha-2 codes.
+    columns : list of str, optional
+        Columns to return (default: all).
+    """
+    table = load_table()
+    if columns is not None:
+        table = table[columns]
+    return table.reindex(pd.Index(codes, name='alpha-2'))
+
+
+def add_country_data(df, on='alpha-2', columns=None):
+    """
+    Add columns of the country table to a DataFrame with a column of alpha-2 codes.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    on : str
+        Column of df with the alpha-2 codes.
+    columns : list of str, optional
+        Columns of the country table to add (default: all). The columns already in df are not added again.
+    """
+    columns = [c for c in (columns or COLUMNS[1:]) if c not in df.columns]
+    data = lookup(df[on], columns)
+    return pd.concat([df.reset_index(drop=True), data.reset_index(drop=True)], axis=1).set_axis(df.index)
+
+
+def country_codes():
+    """
+    All alpha-2 codes of the table.
+    """
+    return load_table().index.tolist()
+
+
+if __name__ == "__main__":
+    table = build_table()
+    print(f"Built {COUNTRIES_FILE} with {len(table)} countries (version {TABLE_VERSION})")
@@ -1,4 +1,5 @@
 import pandas as pd
+from countries import build_table
 
 
 def construct_country_data():
@@ -9,7 +10,11 @@ def construct_country_data():
     1. ISO-3361 country codes with demonym and emoji flags - from Statistics Norway's list
     2. World Bank population numbers - from the World Bank (https://data.worldbank.org/indicator/SP.POP.TOTL)
     3. ISO-3166 country codes with regional codes - to match alpha-2 codes to alpha-3 codes and add regions and sub-regions
-        This file is downloaded directly from https://github.com/lukes/ISO-3166-Countries-with-Regional-Codes/blob/master/all/all.csv
+        The columns used from https://github.com/lukes/ISO-3166-Countries-with-Regional-Codes/blob/master/all/all.csv,
+        kept in support_data/ISO-3166-countries-with-regional-codes.csv so this runs without the network
+
+    The result is saved to support_data/country_data.csv, and the country table that the analysis
+    scripts look countries up in (see countries.py) is rebuilt from it.
 
     Returns
     -------
@@ -25,6 +30,8 @@ def construct_country_data():
     countries = pd.read_csv(
         "support_data/ISO-3361-country-codes-with-demonyms-and-emoji.csv",
         usecols=["code", "name", "Emoji", "Demonym 1"],
+        keep_default_na=False,  # so Namibia's code "NA" is not read as missing
+        na_values=[""],
     )
 
     countries = countries.rename(
@@ -52,16 +59,19 @@ def construct_country_data():
         }
     )
 
-    # read third csv file from github (connects alpha-2 to alpha-3 codes and adds regions and subregions)
+    # read third csv file, from github (connects alpha-2 to alpha-3 codes and adds regions and subregions)
     codes_and_regions = pd.read_csv(
-        "https://raw.githubusercontent.com/lukes/ISO-3166-Countries-with-Regional-Codes/refs/heads/master/all/all.csv",
+        "support_data/ISO-3166-countries-with-regional-codes.csv",
         usecols=["alpha-2", "alpha-3", "region", "sub-region"],
+        keep_default_na=False,
+        na_values=[""],
     )
 
     df = pd.merge(countries, codes_and_regions, on="alpha-2", how="left")
     df = pd.merge(df, population, on="alpha-3", how="left")
  
     df.to_csv("support_data/country_data.csv", index=False)
+    build_table()
   
     return df
 
@@ -1,103 +1,215 @@
 import os
+import numpy as np
 import pandas as pd
+from combined_state import CombinedCounts, load_state, save_state
+from countries import load_table
 
 
-def create_df(base_dir, data_type):
+def create_df(base_dir, data_type, output_dir="analysis/data", state_dir=None):
     """
   
     e.g. create_df("data", "names") will return a DataFrame with all names from the data directory
+    The combined table is saved as combined_<data_type>.csv in output_dir.
+
+    The per-country counts are kept in state_dir (default: <output_dir>/state) between runs, and
+    only the countries whose CSV changed since the last run are read again.
 
     """
+    state, modified = update_state(base_dir, data_type, state_dir or os.path.join(output_dir, "state"))
+    combined_df = state.to_frame()
+    if data_type == 'sentiments':
+        # The running totals are floats, the sentiment counts are whole numbers of stories
+        counts = combined_df.columns[1:]
+        combined_df[counts] = combined_df[counts].astype(int)
+
+    print(combined_df.head())
     
+
+    # Save to CSV (writing the dense table is the slow part, so skip it when nothing changed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output_file = os.path.join(output_dir, f"combined_{data_type}.csv")
+    if not modified and os.path.exists(output_file):
+        print(f"✅ {output_file} is up to date")
+        return combined_df
+    combined_df.to_csv(output_file, index=False)
+
+    print(f"✅ {output_file} created successfully!")
     
-    # Start with an empty DataFrame
-    combined_df = pd.DataFrame()
+    return combined_df
 
 
-    if data_type == 'sentiments':
-        dfs = []
-        for directory in sorted(os.listdir(base_dir)):
-            file_path = os.path.join(base_dir, directory, f"{directory}_sentiments.csv")
-
-            if os.path.exists(file_path):
-                # Read CSV file
-                data = pd.read_csv(file_path)
-                dfs.append(data)
-                
-        treshold = 0.85
-        combined_df = count_high_scoring_sentiments(pd.concat(dfs), treshold)
+def update_state(base_dir, data_type, state_dir, groups=None):
+    """
+    Load the combined counts of a data type, apply the per-country files that changed since the
+    last run and save the state again.
+
+    Parameters
+    ----------
+    groups : dict, optional
+        Country -> group (e.g. sub-region) to keep running totals for.
+
+    Returns
+    -------
+    tuple of (CombinedCounts, bool)
+        The state and whether any country was added, changed or removed.
+    """
+    state_file = os.path.join(state_dir, f"{data_type}.pkl")
+    first_column = 'sentiment' if data_type == 'sentiments' else None
+    state = load_state(state_file, None)
 
+    if data_type == 'sentiments':
+        read_country = read_high_scoring_sentiments
     else:
-        for directory in sorted(os.listdir(base_dir)):
-            file_path = os.path.join(base_dir, directory, f"{directory}_{data_type}.csv")
+        def read_country(file_path):
+            data = pd.read_csv(file_path)
+
+            # Identify the first two columns dynamically
+            first_column = data.columns[0]  # Identifier (e.g., Name, Word, Sentiment)
+            second_column = data.columns[1]  # Count column (or equivalent numeric measure)
+            if state.first_column is None:
+                state.first_column = first_column
+            return data[first_column].map(str).tolist(), data[second_column].fillna(0).to_numpy()
+
+    if state is None:
+        state = CombinedCounts(first_column)
+    if groups is not None:
+        state.set_groups(groups)
+    changed, removed = state.update(base_dir, data_type, read_country)
+    print(f"{data_type}: updated {len(changed)} countries{' (' + ', '.join(changed) + ')' if 0 < len(changed) <= 10 else ''}, "
+          f"removed {len(removed)}, {len(state.columns) - len(changed)} unchanged")
+    save_state(state_file, state)
+    return state, bool(changed or removed)
+
+
+def create_word_freq_tables(base_dir, output_dir="analysis/data", min_total=500, state_dir=None):
+    """
+    Write filtered_word_freq.csv (word x country, only words used at least min_total times over
+    all countries, plus global_freq and num_countries, the number of countries that use the word)
+    and regional_word_freq.csv (the same words summed per sub-region, plus global_freq).
 
-            if os.path.exists(file_path):
-                # Read CSV file
-                data = pd.read_csv(file_path)
-                
-                # Identify the first two columns dynamically
-                first_column = data.columns[0]  # Identifier (e.g., Name, Word, Sentiment)
-                second_column = data.columns[1]  # Count column (or equivalent numeric measure)
+    Both come from the running word x country totals, so only changed countries are read again.
+    """
+    groups = load_table()['sub-region'].dropna().to_dict()
 
-                data[first_column] = data[first_column].astype(str)
+    state, _ = update_state(base_dir, "word_freq", state_dir or os.path.join(output_dir, "state"), groups)
+    frequent = state.totals >= min_total
 
-                # Rename columns dynamically
-                data = data[[first_column, second_column]].rename(columns={second_column: directory})
-                print(data.head())
-                # Merge with the existing DataFrame
-                if combined_df.empty:
-                    combined_df = data
-                else:
-                    combined_df = combined_df.merge(data, on=first_column, how="outer").fillna(0)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    filtered_file = os.path.join(output_dir, "filtered_word_freq.csv")
+    filtered = state.to_frame(frequent)
+    countries = filtered.columns[1:]
+    filtered['global_freq'] = filtered[countries].sum(axis=1)
+    filtered['num_countries'] = (filtered[countries] > 0).sum(axis=1)
+    filtered.to_csv(filtered_file, index=False)
+    print(f"✅ {filtered_file} created successfully!")
 
+    regional_file = os.path.join(output_dir, "regional_word_freq.csv")
+    state.group_frame(frequent).to_csv(regional_file, index=False)
+    print(f"✅ {regional_file} created successfully!")
 
-    print(combined_df.head())
-    
 
-    # Save to CSV
-    if not os.path.exists("analysis/data"):
-        os.makedirs("analysis/data")
-    output_file = f"analysis/data/combined_{data_type}.csv"
-    combined_df.to_csv(output_file, index=False)
+def read_high_scoring_sentiments(file_path, threshold=0.85):
+    """
+    Count one country's stories per sentiment with a confidence of at least threshold.
+    Every sentiment found in the file is included, with 0 if none of its stories pass.
+    """
+    data = pd.read_csv(file_path)
+    counts = (data['confidence'] >= threshold).groupby(data['sentiment']).sum()
+    return counts.index.astype(str).tolist(), counts.to_numpy()
 
-    print(f"✅ {output_file} created successfully!")
-    
-    return combined_df
 
+# The classes of the emotion model, in the order of sentiment_huggingface.EMOTIONS
+EMOTIONS = ['sadness', 'joy', 'love', 'anger', 'fear', 'surprise']
 
-def count_high_scoring_sentiments(input_df, threshold):
+
+def load_emotion_scores(base_dir, countries=None):
     """
-    Count high-scoring sentiment entries in a single DataFrame and ensure all sentiment-country combinations have at least 0.
+    Read the probabilities of all the emotions of every story (<CC>_emotion_scores.parquet, written
+    by the sentiment analysis).
+
+    Returns
+    -------
+    pandas.DataFrame
+        One float32 column per emotion, indexed by ('alpha-2', 'story_id').
     """
-    # Filter rows based on the confidence score threshold
-    high_confidence = input_df[input_df['confidence'] >= threshold]
+    frames = {}
+    for directory in sorted(os.listdir(base_dir)):
+        file_path = os.path.join(base_dir, directory, f"{directory}_emotion_scores.parquet")
+        if (countries is None or directory in countries) and os.path.exists(file_path):
+            frames[directory] = pd.read_parquet(file_path)
+    if not frames:
+        raise FileNotFoundError(f"No <CC>_emotion_scores.parquet files in {base_dir}, run the sentiment analysis first")
+    return pd.concat(frames, names=['alpha-2', 'story_id'])[EMOTIONS]
 
-    # Get unique sentiments and countries
-    all_sentiments = set(input_df['sentiment'].unique())
-    all_countries = set(input_df['story_id'].str[:2].unique())
 
-    high_confidence_dict = {sentiment: {country: 0 for country in all_countries} for sentiment in all_sentiments}
+def ranked_emotions(scores, rank=1):
+    """
+    The emotion of each story with the rank-th highest probability (1 for the top emotion, 2 for
+    the secondary emotion), and that probability.
+    """
+    values = scores.to_numpy()
+    column = np.argsort(-values, axis=1, kind='stable')[:, rank - 1]
+    return (pd.Series(np.asarray(EMOTIONS)[column], index=scores.index, name='emotion'),
+            pd.Series(values[np.arange(len(values)), column], index=scores.index, name='probability'))
 
-    # Count occurrences
-    for index, row in high_confidence.iterrows():
-        sentiment = row['sentiment']
-        country = row['story_id'][:2]
-        high_confidence_dict[sentiment][country] += 1
 
-    # Convert to DataFrame and transpose
-    df = pd.DataFrame.from_dict(high_confidence_dict, orient='index').fillna(0)
-    
-    # Reset index so 'country' is a column
-    df.index.name = 'sentiment'
-    df = df[sorted(df.columns)]
-    df.reset_index(inplace=True)
+def count_high_scoring_sentiments(scores, threshold=0.85, rank=1):
+    """
+    Count the stories of each country per top emotion (or per emotion of another rank) whose
+    probability is at least threshold, the way read_high_scoring_sentiments counts the sentiments
+    files, but for any threshold and from the full probabilities.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Countries x emotions.
+    """
+    emotion, probability = ranked_emotions(scores, rank)
+    countries = scores.index.get_level_values('alpha-2')
+    counts = pd.crosstab(countries, emotion, values=probability >= threshold, aggfunc='sum')
+    return counts.reindex(columns=EMOTIONS, fill_value=0).fillna(0).astype(int).rename_axis(index='alpha-2', columns=None)
+
+
+def emotion_profiles(scores):
+    """
+    The mean probability of each emotion over each country's stories, with the number of stories.
+    """
+    profiles = scores.groupby(level='alpha-2').mean().round(4)
+    profiles.insert(0, 'stories', scores.groupby(level='alpha-2').size())
+    return profiles
+
+
+def create_emotion_tables(base_dir, output_dir="analysis/data", threshold=0.85):
+    """
+    Save the emotion tables computed from the emotion probabilities of the stories, without
+    running the model again:
+    - emotion_profiles.csv: the mean emotion profile of each country
+    - emotion_counts.csv: per country and emotion, the stories with it as top emotion, as top
+      emotion with a probability of at least threshold, and as secondary emotion
+    """
+    scores = load_emotion_scores(base_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    profiles_file = os.path.join(output_dir, "emotion_profiles.csv")
+    emotion_profiles(scores).to_csv(profiles_file)
+    print(f"✅ {profiles_file} created successfully!")
 
-    return df
+    counts = pd.DataFrame({
+        'top': count_high_scoring_sentiments(scores, 0).stack(),
+        f"top_at_least_{threshold}": count_high_scoring_sentiments(scores, threshold).stack(),
+        'secondary': count_high_scoring_sentiments(scores, 0, rank=2).stack(),
+    })
+    counts.index.names = ['alpha-2', 'emotion']
+    counts_file = os.path.join(output_dir, "emotion_counts.csv")
+    counts.to_csv(counts_file)
+    print(f"✅ {counts_file} created successfully!")
 
 
 def main():
     # Create a DataFrame for each type of data
-    data_select = input("Enter the type of data you would like to analyze: \n1: word_freq\n2: noun_phrases\n3: names\n4: sentiments\n") # e.g., names, noun_phrases, word_freq, sentiments
+    data_select = input("Enter the type of data you would like to analyze: \n1: word_freq\n2: noun_phrases\n3: names\n4: sentiments\n5: filtered and regional word_freq\n6: emotion profiles and counts\n") # e.g., names, noun_phrases, word_freq, sentiments
     type_of_data = ''
     if data_select == "1":
         type_of_data = "word_freq"
@@ -107,6 +219,13 @@ def main():
         type_of_data = "names"
     elif data_select == "4":
         type_of_data = "sentiments"
+    elif data_select == "5":
+        create_word_freq_tables("data")
+        return
+    elif data_select == "6":
+        threshold = input("Minimum probability of the top emotion [0.85]: ")
+        create_emotion_tables("data", threshold=float(threshold) if threshold else 0.85)
+        return
     create_df("data", type_of_data)
     
 
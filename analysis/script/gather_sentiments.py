@@ -1,56 +1,70 @@
 import os
 import pandas as pd
+from combined_state import changed_countries, load_state, save_state
+from countries import add_country_data
 
-def gather_sentiment_data(base_dir, output_file):
+def gather_sentiment_data(base_dir, output_file, state_file=None, counts_file=None):
     """ 
     Reads all sentiment files from country directories, extracts story_id, sentiment, and confidence, 
-    and combines them into a single CSV file.
-    """
+    and combines them into a single CSV file. The number of stories per sentiment in each country is
+    saved to counts_file (default: sentiment_counts.csv next to output_file), for the figures.
 
-    all_data = []
+    The rows of each country are kept in state_file (default: state/sentiment_rows.pkl next to
+    output_file) between runs, and only the countries whose sentiment file changed are read again.
+    """
+    state_file = state_file or os.path.join(os.path.dirname(output_file), "state", "sentiment_rows.pkl")
+    state = load_state(state_file, {'fingerprints': {}, 'rows': {}})
 
-    for directory in sorted(os.listdir(base_dir)):
+    changed, removed = changed_countries(base_dir, "sentiments", state['fingerprints'])
+    for directory in removed:
+        del state['fingerprints'][directory]
+        state['rows'].pop(directory, None)
+    for directory, fingerprint in changed.items():
         file_path = os.path.join(base_dir, directory, f"{directory}_sentiments.csv")
-
-        if os.path.exists(file_path):
-            # Read CSV file, ensuring necessary columns exist
-            try:
-                data = pd.read_csv(file_path, usecols=['story_id', 'sentiment', 'confidence'])
-                data['alpha-2'] = directory  # Add country column for reference
-                all_data.append(data)
-            except Exception as e:
-                print(f"Error reading {file_path}: {e}")
+        # Read CSV file, ensuring necessary columns exist
+        try:
+            data = pd.read_csv(file_path, usecols=['story_id', 'sentiment', 'confidence'])
+            data['alpha-2'] = directory  # Add country column for reference
+            state['rows'][directory] = data
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
+            state['rows'].pop(directory, None)
+        state['fingerprints'][directory] = fingerprint
+    print(f"sentiments: updated {len(changed)} countries, removed {len(removed)}, {len(state['rows']) - len(changed)} unchanged")
+    save_state(state_file, state)
 
     # Combine all data into a single DataFrame
-    if all_data:
-        combined_df = pd.concat(all_data, ignore_index=True)
+    if state['rows']:
+        combined_df = pd.concat([state['rows'][d] for d in sorted(state['rows'])], ignore_index=True)
 
     else:
         print("No sentiment files found.")
     
-    country_data = pd.read_csv("support_data/country_data.csv")
-    # merge data with country_data
-    combined_df = pd.merge(combined_df, country_data, on='alpha-2', how='left')
-
-    # Change the value "United States of America (the)" to "USA"
-    # add replacements for Bolivia (Plurinational State of), United Kingdom of Great Britain and Northern Ireland (the), Korea (the Republic of), Korea (the Democratic People's Republic of)
-    combined_df['country_name'] = combined_df['country_name'].replace({
-        "United States of America (the)": "USA",
-        "Palestine, State of": "Palestine",
-        "United Kingdom of Great Britain and Northern Ireland (the)": "United Kingdom",
-        "Korea (the Republic of)": "South Korea",
-        "Korea (the Democratic People's Republic of)": "North Korea",
-        "Bolivia (Plurinational State of)": "Bolivia",
-        "Taiwan (Province of China)": "Taiwan",
-        "Russian Federation (the)": "Russia",
-        "Iran (Islamic Republic of)": "Iran",
-        "Venezuela (Bolivarian Republic of)": "Venezuela",
-    })
+    # Add the country data, with the short country names ("USA", "South Korea", ...)
+    combined_df = add_country_data(combined_df, 'alpha-2',
+                                   ['short_name', 'flag_emoji', 'demonym', 'alpha-3', 'region', 'sub-region', 'population'])
+    combined_df = combined_df.rename(columns={'short_name': 'country_name'})
 
     combined_df.to_csv(output_file, index=False)
     print(f"Combined sentiment data saved to {output_file}")
 
+    counts_file = counts_file or os.path.join(os.path.dirname(output_file), "sentiment_counts.csv")
+    sentiment_counts(combined_df).to_csv(counts_file, index=False)
+    print(f"Sentiment counts per country saved to {counts_file}")
+
+
+def sentiment_counts(sentiments):
+    """
+    Number of stories per sentiment in each country, with the country's name, region and sub-region.
+    """
+    counts = pd.crosstab(sentiments['alpha-2'], sentiments['sentiment'])
+    counts.columns.name = None
+    countries = sentiments.groupby('alpha-2')[['country_name', 'region', 'sub-region']].first()
+    countries['country_name'] = countries['country_name'].fillna(pd.Series(countries.index, index=countries.index))
+    return countries.join(counts).reset_index()
+
 
 
 # Example usage:
-gather_sentiment_data("data", "analysis/data/all_countries_sentiments.csv")
+if __name__ == "__main__":
+    gather_sentiment_data("data", "analysis/data/all_countries_sentiments.csv")
@@ -0,0 +1,190 @@
+"""
+Impute demographic categories of the protagonists of every country from their names.
+
+The reference table is a census-style CSV with one row per name: 'name', 'kind' ('full', 'last' or
+'first') and one column per category with the probability of that category for the name (e.g. the
+api/black/hispanic/white columns of US_names_with_imputed_race_from_census.csv, or a census surname
+table converted to probabilities). It is loaded once into a hash index per kind, and the names of
+all countries (from names.py's load_names) are looked up in it at once: a name is matched on its full
+name, then on its last name, then on its first name.
+
+`impute` writes to analysis/data/name_imputation/:
+- imputed_names.csv: each name of each country with the level it was matched on and its probabilities
+- country_distributions.csv: per country, the expected share of its protagonists in each category
+  (over the matched protagonists) and the match rates
+
+`seed` builds a small starting reference table from the US names imputed earlier
+(analysis/data/US_names_with_imputed_race_from_census.csv), to extend with a full reference table.
+
+Run from the repository root, e.g. `python3 analysis/script/name_imputation.py impute --reference analysis/data/name_reference.csv`
+"""
+
+import os
+import click
+import numpy as np
+import pandas as pd
+from names import load_names, normalize_names, NO_NAME
+
+IMPUTATION_DIR = "analysis/data/name_imputation"
+REFERENCE_FILE = "analysis/data/name_reference.csv"
+US_IMPUTED_FILE = "analysis/data/US_names_with_imputed_race_from_census.csv"
+
+# The order names are matched in: the most specific first
+MATCH_LEVELS = ['full', 'last', 'first']
+
+
+class NameReference:
+    """
+    Reference table of category probabilities per name, with a hash index per kind of name.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        'name', 'kind' and one probability column per category.
+    """
+
+    def __init__(self, table):
+        self.categories = [c for c in table.columns if c not in ('name', 'kind', 'count')]
+        _, keys = normalize_names(table['name'])
+        table = table.assign(key=keys.to_numpy()).drop_duplicates(['kind', 'key'])
+        self.probabilities = {}
+        self.index = {}
+        for kind in MATCH_LEVELS:
+            rows = table[table['kind'] == kind]
+            self.index[kind] = pd.Index(rows['key'])
+            self.probabilities[kind] = rows[self.categories].to_numpy(dtype=np.float32)
+
+    @classmethod
+    def load(cls, reference_file=REFERENCE_FILE):
+        if not os.path.exists(reference_file):
+            raise click.ClickException(f"No reference table {reference_file}, run `seed` or pass --reference")
+        return cls(pd.read_csv(reference_file, keep_default_na=False, na_values=[""]))
+
+    def __len__(self):
+        return sum(len(index) for index in self.index.values())
+
+    def impute(self, names):
+        """
+        Look every name up in the reference table.
+
+        Parameters
+        ----------
+        names : pandas.Series
+            Protagonist names.
+
+        Returns
+        -------
+        tuple of (numpy.ndarray, numpy.ndarray)
+            The level each name was matched on ('full', 'last', 'first' or 'none'), and the category
+            probabilities of each name (NaN where it was not matched).
+        """
+        _, keys = normalize_names(names)
+        parts = keys.str.split(" ")
+        queries = {'full': keys, 'last': parts.str[-1].where(parts.str.len() > 1), 'first': parts.str[0]}
+
+        match = np.full(len(names), 'none', dtype=object)
+        probabilities = np.full((len(names), len(self.categories)), np.nan, dtype=np.float32)
+        for kind in MATCH_LEVELS:
+            positions = self.index[kind].get_indexer(queries[kind].fillna(""))
+            found = (positions >= 0) & (match == 'none')
+            match[found] = kind
+            probabilities[found] = self.probabilities[kind][positions[found]]
+        return match, probabilities
+
+
+def impute_countries(reference, base_dir="data"):
+    """
+    Impute the categories of the protagonists of every country.
+
+    Returns
+    -------
+    tuple of (pandas.DataFrame, pandas.DataFrame)
+        The imputed names ('country', 'Name', 'Count', 'match' and the categories) and the
+        distributions per country.
+    """
+    names = load_names(base_dir)
+    _, keys = normalize_names(names['Name'])
+    names = names[(keys.str.len() > 1) & ~keys.isin(NO_NAME)].reset_index(drop=True)
+
+    match, probabilities = reference.impute(names['Name'])
+    imputed = pd.concat([names.assign(match=match),
+                         pd.DataFrame(probabilities, columns=reference.categories).round(5)], axis=1)
+    return imputed, country_distributions(imputed, reference.categories)
+
+
+def country_distributions(imputed, categories):
+    """
+    The expected share of each country's matched protagonists in each category, the number of
+    protagonists and the share matched on each level.
+    """
+    counts = imputed['Count'].to_numpy(dtype=np.float64)
+    matched = imputed['match'] != 'none'
+    weighted = imputed[categories].fillna(0).mul(counts, axis=0).groupby(imputed['country']).sum()
+
+    protagonists = imputed.groupby('country')['Count'].sum()
+    levels = pd.crosstab(imputed['country'], imputed['match'], values=imputed['Count'], aggfunc='sum').fillna(0)
+    levels = levels.reindex(columns=MATCH_LEVELS, fill_value=0)
+
+    matched_protagonists = imputed['Count'].where(matched, 0).groupby(imputed['country']).sum()
+    distributions = weighted.div(matched_protagonists.where(matched_protagonists > 0), axis=0).round(4)
+    distributions.insert(0, 'protagonists', protagonists)
+    distributions.insert(1, 'match_rate', (matched_protagonists / protagonists).round(4))
+    for level in MATCH_LEVELS:
+        distributions[f"{level}_name_rate"] = (levels[level] / protagonists).round(4)
+    return distributions
+
+
+def seed_reference(us_file=US_IMPUTED_FILE, reference_file=REFERENCE_FILE):
+    """
+    Build a reference table from the US names imputed earlier: full names for the rows with a
+    first and last name, last names (the mean over the full names sharing it) for those rows too,
+    and first names for the rows with only a first name.
+    """
+    us = pd.read_csv(us_file, keep_default_na=False, na_values=[""])
+    categories = [c for c in us.columns if c not in ('Name', 'first', 'last', 'race')]
+    us = us.drop_duplicates('Name')
+    reference = pd.concat([
+        us.loc[us['last'].notna(), ['Name'] + categories].assign(kind='full'),
+        us[us['last'].notna()].groupby('last', as_index=False)[categories].mean()
+        .rename(columns={'last': 'Name'}).assign(kind='last'),
+        us.loc[us['last'].isna(), ['first'] + categories].rename(columns={'first': 'Name'}).assign(kind='first'),
+    ]).rename(columns={'Name': 'name'})[['name', 'kind'] + categories]
+    reference.to_csv(reference_file, index=False)
+    return reference
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+@click.option('--reference', 'reference_file', default=REFERENCE_FILE, show_default=True, help='Reference table of category probabilities per name')
+def impute(base_dir, reference_file):
+    """Impute the categories of every country's protagonists."""
+    reference = NameReference.load(reference_file)
+    imputed, distributions = impute_countries(reference, base_dir)
+
+    os.makedirs(IMPUTATION_DIR, exist_ok=True)
+    imputed.to_csv(os.path.join(IMPUTATION_DIR, "imputed_names.csv"), index=False)
+    distributions.to_csv(os.path.join(IMPUTATION_DIR, "country_distributions.csv"))
+
+    total = distributions['protagonists'].sum()
+    matched = (distributions['protagonists'] * distributions['match_rate']).sum()
+    print(f"Matched {matched:.0f} of {total} protagonists ({matched / total:.1%}) in {len(distributions)} countries "
+          f"against {len(reference)} reference names")
+    print(f"Saved to {IMPUTATION_DIR}")
+
+
+@cli.command()
+@click.option('--reference', 'reference_file', default=REFERENCE_FILE, show_default=True)
+def seed(reference_file):
+    """Build a reference table from the US names imputed earlier."""
+    reference = seed_reference(reference_file=reference_file)
+    print(f"Wrote {len(reference)} names ({', '.join(f'{n} {k}' for k, n in reference['kind'].value_counts().items())}) "
+          f"to {reference_file}")
+
+
+if __name__ == "__main__":
+    cli()
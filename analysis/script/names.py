@@ -0,0 +1,229 @@
+"""
+Protagonist names across countries: a sparse name x country matrix and the name overlap between countries.
+
+`build` reads the names of every country in one pass: <CC>_story_names.csv (one row per story and
+name, written by the names analysis) or, for countries analysed before that file existed, the name
+counts in <CC>_names.csv. The names are normalized with vectorized string operations over the whole
+corpus at once (whitespace collapsed, case ignored when matching, the most common spelling kept),
+and counted into a sparse name x country matrix. The country x country Jaccard overlap of the sets
+of names is computed from it with one sparse product.
+
+Saved to analysis/data/names/:
+- name_country_matrix.npz: stories per name (rows) and country (columns)
+- names.csv: the rows of the matrix, with the number of stories and countries of each name
+- name_overlap.csv: the country x country Jaccard overlap (also the columns of the matrix, in order)
+
+Run from the repository root, e.g.
+`python3 analysis/script/names.py build` and `python3 analysis/script/names.py shared Elena`
+"""
+
+import os
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from countries import lookup
+
+NAMES_DIR = "analysis/data/names"
+MATRIX_FILE = os.path.join(NAMES_DIR, "name_country_matrix.npz")
+NAMES_FILE = os.path.join(NAMES_DIR, "names.csv")
+OVERLAP_FILE = os.path.join(NAMES_DIR, "name_overlap.csv")
+
+# Replies that mean the model found no name
+NO_NAME = {"unknown", "none", "no name", "not mentioned"}
+
+
+def load_names(base_dir="data", countries=None):
+    """
+    Read the protagonist names of every country.
+
+    Returns
+    -------
+    pandas.DataFrame
+        'country', 'Name' and 'Count' (number of stories), one row per name and country.
+    """
+    frames = []
+    for directory in sorted(os.listdir(base_dir)):
+        if countries is not None and directory not in countries:
+            continue
+        story_names_file = os.path.join(base_dir, directory, f"{directory}_story_names.csv")
+        names_file = os.path.join(base_dir, directory, f"{directory}_names.csv")
+        if os.path.exists(story_names_file):
+            data = pd.read_csv(story_names_file, usecols=['Name'], keep_default_na=False, na_values=[""])
+            data['Count'] = 1
+        elif os.path.exists(names_file):
+            data = pd.read_csv(names_file, usecols=['Name', 'Count'], keep_default_na=False, na_values=[""])
+        else:
+            continue
+        data['country'] = directory
+        frames.append(data)
+    if not frames:
+        return pd.DataFrame(columns=['country', 'Name', 'Count'])
+    return pd.concat(frames, ignore_index=True)[['country', 'Name', 'Count']]
+
+
+def normalize_names(names):
+    """
+    Collapse whitespace and strip the names, and the case-folded key each name is matched on.
+
+    Returns
+    -------
+    tuple of (pandas.Series, pandas.Series)
+        The cleaned names and their keys.
+    """
+    cleaned = names.fillna("").astype(str).str.replace(r"\s+", " ", regex=True).str.strip(" .,'\"")
+    return cleaned, cleaned.str.casefold()
+
+
+def name_country_matrix(names):
+    """
+    Count the names into a sparse name x country matrix.
+
+    Parameters
+    ----------
+    names : pandas.DataFrame
+        'country', 'Name' and 'Count', as returned by load_names.
+
+    Returns
+    -------
+    tuple of (scipy.sparse.csr_matrix, pandas.DataFrame, list of str)
+        The matrix (stories per name and country), the rows ('Name' in its most common spelling,
+        'stories' and 'countries' using it) and the countries of the columns.
+    """
+    cleaned, keys = normalize_names(names['Name'])
+    # Single letters are the remains of names split at a letter the old name splitting did not know (Mar|a)
+    keep = (keys.str.len() > 1) & ~keys.isin(NO_NAME)
+    names, cleaned, keys = names[keep], cleaned[keep], keys[keep]
+
+    key_codes, unique_keys = pd.factorize(keys, sort=True)
+    country_codes, countries = pd.factorize(names['country'], sort=True)
+    counts = names['Count'].to_numpy(dtype=np.int64)
+    matrix = sparse.coo_matrix((counts, (key_codes, country_codes)), shape=(len(unique_keys), len(countries))).tocsr()
+    matrix.sum_duplicates()
+
+    # Show each name in its most common spelling ("Elena" rather than "ELENA")
+    spellings = pd.DataFrame({'key': key_codes, 'Name': cleaned.to_numpy(), 'Count': counts})
+    spellings = spellings.groupby(['key', 'Name'], sort=False)['Count'].sum().reset_index()
+    spellings = spellings.sort_values(['key', 'Count'], ascending=[True, False]).drop_duplicates('key')
+
+    rows = pd.DataFrame({
+        'Name': spellings['Name'].to_numpy(),
+        'stories': np.asarray(matrix.sum(axis=1)).ravel(),
+        'countries': np.diff(matrix.indptr),
+    })
+    return matrix, rows, list(countries)
+
+
+def jaccard_overlap(matrix):
+    """
+    Jaccard similarity of the sets of names of each pair of countries (the columns of matrix):
+    names in both / names in either.
+
+    Returns
+    -------
+    numpy.ndarray
+        countries x countries, float32.
+    """
+    present = (matrix > 0).astype(np.float32).tocsc()
+    shared = (present.T @ present).toarray()
+    sizes = np.diag(shared)
+    union = sizes[:, None] + sizes[None, :] - shared
+    return (shared / np.where(union > 0, union, 1)).astype(np.float32)
+
+
+def build_names(base_dir="data"):
+    """
+    Build the name x country matrix and the name overlap of all countries, and save them.
+
+    Returns
+    -------
+    tuple of (scipy.sparse.csr_matrix, pandas.DataFrame, pandas.DataFrame)
+        The matrix, its rows and the overlap (indexed by country on both axes).
+    """
+    matrix, rows, countries = name_country_matrix(load_names(base_dir))
+    overlap = pd.DataFrame(jaccard_overlap(matrix).round(5), index=countries, columns=countries)
+    overlap.index.name = 'country'
+
+    os.makedirs(NAMES_DIR, exist_ok=True)
+    sparse.save_npz(MATRIX_FILE, matrix)
+    rows.to_csv(NAMES_FILE, index=False)
+    overlap.to_csv(OVERLAP_FILE)
+    return matrix, rows, overlap
+
+
+def load_built():
+    """
+    The saved matrix, its rows and the overlap, as returned by build_names.
+    """
+    if not os.path.exists(MATRIX_FILE):
+        raise click.ClickException(f"No name matrix in {NAMES_DIR}, run `build` first")
+    rows = pd.read_csv(NAMES_FILE, keep_default_na=False, na_values=[""])
+    overlap = pd.read_csv(OVERLAP_FILE, index_col='country', keep_default_na=False)
+    return sparse.load_npz(MATRIX_FILE).tocsr(), rows, overlap
+
+
+def countries_with_name(name, matrix, rows, countries):
+    """
+    The countries with protagonists called name (case is ignored), with the number of stories.
+    """
+    _, key = normalize_names(pd.Series([name]))
+    _, row_keys = normalize_names(rows['Name'])
+    found = np.flatnonzero(row_keys.to_numpy() == key[0])
+    if len(found) == 0:
+        return pd.DataFrame(columns=['country', 'stories'])
+    row = matrix[found[0]]
+    result = pd.DataFrame({'country': np.asarray(countries)[row.indices], 'stories': row.data})
+    return result.sort_values('stories', ascending=False, kind='stable').reset_index(drop=True)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+def build(base_dir):
+    """Build the name x country matrix and the name overlap."""
+    matrix, rows, overlap = build_names(base_dir)
+    print(f"{len(rows)} distinct names of {matrix.sum()} protagonists from {len(overlap)} countries, "
+          f"{(rows['countries'] > 1).sum()} of them used in more than one country")
+    print(f"Saved to {NAMES_DIR}")
+
+
+@cli.command()
+@click.argument('name')
+def shared(name):
+    """Which countries have protagonists called NAME."""
+    matrix, rows, overlap = load_built()
+    result = countries_with_name(name, matrix, rows, overlap.index.tolist())
+    if result.empty:
+        print(f"No protagonists called {name}")
+        return
+    result = pd.concat([result, lookup(result['country'], ['short_name', 'region']).reset_index(drop=True)], axis=1)
+    print(f"{len(result)} countries have protagonists called {name} ({result['stories'].sum()} stories):")
+    print(result.to_string(index=False))
+
+
+@cli.command()
+@click.option('-c', '--country', default=None, help='Show the countries whose names overlap most with this country')
+@click.option('-n', default=10, show_default=True, help='How many countries or pairs to show')
+def overlap(country, n):
+    """Countries sharing the most protagonist names."""
+    matrix, rows, overlap = load_built()
+    if country:
+        if country not in overlap.index:
+            raise click.ClickException(f"No names for {country}")
+        similar = overlap.loc[country].drop(country).sort_values(ascending=False).head(n)
+        print(f"Countries with the most protagonist names in common with {country} (Jaccard):")
+        print(similar.to_string())
+        return
+    # Every pair once: the upper triangle of the overlap matrix
+    upper = np.triu_indices(len(overlap), k=1)
+    pairs = pd.DataFrame({'country': overlap.index[upper[0]], 'other_country': overlap.index[upper[1]],
+                          'jaccard': overlap.to_numpy()[upper]})
+    print(pairs.nlargest(n, 'jaccard').to_string(index=False))
+
+
+if __name__ == "__main__":
+    cli()
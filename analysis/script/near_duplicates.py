@@ -0,0 +1,257 @@
+"""
+Find near-duplicate stories within and across countries with MinHash and LSH.
+
+Every story is turned into a set of word shingles (runs of `shingle_size` words). Its MinHash
+signature is the minimum of `num_perm` hash functions over that set, and the share of equal
+positions in two signatures estimates the Jaccard similarity of the two sets. LSH cuts the
+signatures into bands and only compares stories that share all values of at least one band, so
+the work grows with the number of stories instead of the number of pairs.
+
+Run from the repository root: `python3 analysis/script/near_duplicates.py`
+"""
+
+import os
+import itertools
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from corpus import load_stories
+
+MAX_SHINGLES_PER_BLOCK = 500_000  # Bounds the memory of a block to about 500k x PERM_GROUP x 4 bytes
+PERM_GROUP = 32
+
+
+def hash_functions(num_perm, seed=0):
+    """
+    Parameters (a, b) of num_perm permutations h(x) = (a * x + b) mod 2^32 of the 32-bit shingle hashes.
+    With an odd a each one is a bijection, and it stays in 32-bit integer arithmetic.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**32, size=num_perm, dtype=np.uint32) | np.uint32(1)  # Odd multipliers
+    b = rng.integers(0, 2**32, size=num_perm, dtype=np.uint32)
+    return a, b
+
+
+def shingle_hashes(texts, shingle_size):
+    """
+    Hash the word shingles of each text.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray)
+        The 32-bit shingle hashes of all texts concatenated, and the number of shingles per text.
+    """
+    tokens = texts.str.lower().str.findall(r"[^\W_]+(?:'[^\W_]+)?")
+    lengths = tokens.str.len().to_numpy()
+    flat = np.fromiter(itertools.chain.from_iterable(tokens), dtype=object, count=int(lengths.sum()))
+    # Hash each distinct word once; hash_array is stable across runs, unlike hash()
+    codes, words = pd.factorize(flat)
+    word_hashes = pd.util.hash_array(np.asarray(words, dtype=object))[codes]
+
+    # Rolling combination of shingle_size consecutive word hashes (wraps around mod 2^64)
+    count = max(0, len(word_hashes) - shingle_size + 1)
+    combined = np.zeros(count, dtype=np.uint64)
+    multiplier = np.uint64(1099511628211)
+    for offset in range(shingle_size):
+        combined = combined * multiplier + word_hashes[offset:offset + count]
+
+    # Keep the shingles that start and end inside the same text
+    text = np.repeat(np.arange(len(lengths)), lengths)[:count]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    keep = np.arange(count) - starts[text] <= lengths[text] - shingle_size
+    return (combined[keep] >> np.uint64(32)).astype(np.uint32), np.maximum(lengths - shingle_size + 1, 0)
+
+
+def minhash_signatures(texts, num_perm=128, shingle_size=5, seed=0):
+    """
+    MinHash signatures of texts, computed in blocks of stories with NumPy.
+
+    Returns
+    -------
+    numpy.ndarray
+        uint32 array of shape (len(texts), num_perm). Texts shorter than shingle_size words get
+        the maximum value everywhere and never match anything.
+    """
+    a, b = hash_functions(num_perm, seed)
+    texts = pd.Series(texts).reset_index(drop=True).astype(str)
+    signatures = np.full((len(texts), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+
+    # Blocks of consecutive stories holding roughly MAX_SHINGLES_PER_BLOCK shingles
+    approx_words = texts.str.len().to_numpy() // 5 + 1
+    block = np.cumsum(approx_words) // MAX_SHINGLES_PER_BLOCK
+    block_ends = np.append(np.flatnonzero(np.diff(block)) + 1, len(texts))
+    start = 0
+    for end in block_ends:
+        hashes, counts = shingle_hashes(texts.iloc[start:end], shingle_size)
+        has_shingles = counts > 0
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])[has_shingles]
+        rows = np.arange(start, end)[has_shingles]
+        if len(rows):
+            values = np.empty((PERM_GROUP, len(hashes)), dtype=np.uint32)
+            for first in range(0, num_perm, PERM_GROUP):
+                group = slice(first, first + PERM_GROUP)
+                size = len(a[group])
+                # In place, wrapping around mod 2^32
+                np.multiply(a[group, None], hashes[None, :], out=values[:size])
+                values[:size] += b[group, None]
+                signatures[rows, group] = np.minimum.reduceat(values[:size], offsets, axis=1).T
+        start = end
+    return signatures
+
+
+def choose_bands(num_perm, threshold):
+    """
+    Pick the number of bands b (and rows per band r = num_perm / b) whose LSH threshold
+    (1/b)^(1/r) is closest to the requested Jaccard threshold.
+    """
+    options = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(options, key=lambda o: abs((1 / o[0]) ** (1 / o[1]) - threshold))
+
+
+def candidate_pairs(signatures, bands, rows):
+    """
+    Pairs of stories that share every value of at least one band.
+
+    Within each bucket every member is paired with the first member and with the previous one,
+    so a bucket of n stories gives at most 2n pairs. That is enough to link a bucket into one
+    cluster without comparing all n^2 pairs of a heavily templated bucket.
+    """
+    pairs = []
+    valid = signatures[:, 0] != np.iinfo(np.uint32).max
+    for band in range(bands):
+        # One 64-bit key per band (a collision only adds a candidate, which is then checked)
+        keys = np.zeros(len(signatures), dtype=np.uint64)
+        for column in signatures[:, band * rows:(band + 1) * rows].T:
+            keys = keys * np.uint64(1099511628211) + column.astype(np.uint64)
+        keys = np.where(valid, keys, np.arange(len(keys), dtype=np.uint64))  # Short texts get their own bucket
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        same_as_previous = np.concatenate([[False], sorted_keys[1:] == sorted_keys[:-1]])
+        if not same_as_previous.any():
+            continue
+        bucket_start = np.maximum.accumulate(np.where(~same_as_previous, np.arange(len(order)), 0))
+        members = np.flatnonzero(same_as_previous)
+        pairs.append(np.column_stack([order[members - 1], order[members]]))
+        pairs.append(np.column_stack([order[bucket_start[members]], order[members]]))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return np.unique(pairs, axis=0)
+
+
+def clusters_from_pairs(num_items, pairs):
+    """
+    Label connected components of the graph given by pairs. Returns one label per item.
+    """
+    graph = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(num_items, num_items))
+    return sparse.csgraph.connected_components(graph, directed=False)[1]
+
+
+def find_near_duplicates(stories, threshold=0.5, num_perm=128, shingle_size=5, seed=0):
+    """
+    Find near-duplicate stories.
+
+    Parameters
+    ----------
+    stories : pandas.DataFrame
+        'Story_ID', 'Story' and 'country' columns, as returned by corpus.load_stories.
+    threshold : float
+        Estimated Jaccard similarity of the shingle sets above which two stories are near-duplicates.
+    num_perm : int
+        Length of the MinHash signatures. More is more precise and slower.
+    shingle_size : int
+        Words per shingle.
+    seed : int
+        Seed of the hash functions.
+
+    Returns
+    -------
+    tuple of (pandas.DataFrame, pandas.DataFrame, pandas.DataFrame)
+        The near-duplicate pairs found (story_a, story_b, country_a, country_b, jaccard), the
+        clusters (cluster, cluster_size, Story_ID, country) and per country pair the number of
+        near-duplicate pairs implied by the clusters and the Jaccard estimates of the pairs found.
+    """
+    stories = stories.reset_index(drop=True)
+    signatures = minhash_signatures(stories['Story'], num_perm, shingle_size, seed)
+    bands, rows = choose_bands(num_perm, threshold)
+    candidates = candidate_pairs(signatures, bands, rows)
+
+    jaccard = (signatures[candidates[:, 0]] == signatures[candidates[:, 1]]).mean(axis=1) if len(candidates) else np.zeros(0)
+    verified = candidates[jaccard >= threshold]
+    jaccard = jaccard[jaccard >= threshold]
+    ids = stories['Story_ID'].to_numpy()
+    countries = stories['country'].to_numpy()
+    pairs = pd.DataFrame({
+        'story_a': ids[verified[:, 0]], 'story_b': ids[verified[:, 1]],
+        'country_a': countries[verified[:, 0]], 'country_b': countries[verified[:, 1]],
+        'jaccard': jaccard.round(4),
+    })
+
+    labels = clusters_from_pairs(len(stories), verified)
+    sizes = np.bincount(labels)
+    in_cluster = sizes[labels] > 1
+    clusters = pd.DataFrame({'cluster': labels, 'cluster_size': sizes[labels], 'Story_ID': ids, 'country': countries})[in_cluster]
+    # Number the clusters 0, 1, ... from the largest
+    clusters = clusters.sort_values(['cluster_size', 'cluster', 'Story_ID'], ascending=[False, True, True])
+    clusters['cluster'] = pd.factorize(clusters['cluster'])[0]
+
+    country_pairs = country_pair_summary(clusters, pairs)
+    return pairs, clusters.reset_index(drop=True), country_pairs
+
+
+def country_pair_summary(clusters, pairs):
+    """
+    Near-duplicates per pair of countries (including a country with itself).
+
+    'pairs_in_clusters' counts every pair of stories that ended up in the same cluster (the
+    cluster x country count matrix multiplied by its transpose); 'mean_jaccard' and
+    'max_jaccard' are over the pairs LSH actually compared.
+    """
+    codes, countries = pd.factorize(clusters['country'], sort=True)
+    counts = sparse.coo_matrix((np.ones(len(codes)), (clusters['cluster'].to_numpy(), codes)),
+                               shape=(clusters['cluster'].max() + 1 if len(clusters) else 0, len(countries))).tocsr()
+    co_occurrence = (counts.T @ counts).tocoo()
+    per_country = np.asarray(counts.sum(axis=0)).ravel()
+    upper = co_occurrence.row <= co_occurrence.col
+    a, b, n = co_occurrence.row[upper], co_occurrence.col[upper], co_occurrence.data[upper]
+    # A country with itself counts n * n, of which n are a story with itself and the rest are counted twice
+    n = np.where(a == b, (n - per_country[a]) / 2, n)
+    summary = pd.DataFrame({'country_a': countries[a], 'country_b': countries[b], 'pairs_in_clusters': n})
+    summary = summary[summary['pairs_in_clusters'] > 0]
+
+    ordered = pairs.assign(country_a=pairs[['country_a', 'country_b']].min(axis=1), country_b=pairs[['country_a', 'country_b']].max(axis=1))
+    jaccard = ordered.groupby(['country_a', 'country_b'])['jaccard'].agg(compared_pairs='size', mean_jaccard='mean', max_jaccard='max').reset_index()
+    summary = summary.merge(jaccard, on=['country_a', 'country_b'], how='left')
+    summary['pairs_in_clusters'] = summary['pairs_in_clusters'].astype(int)
+    summary['compared_pairs'] = summary['compared_pairs'].fillna(0).astype(int)
+    return summary.sort_values('pairs_in_clusters', ascending=False).reset_index(drop=True)
+
+
+@click.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+@click.option('-o', '--output-dir', default="analysis/data/near_duplicates", show_default=True)
+@click.option('-c', '--country', 'countries', multiple=True, help='Only use these country codes')
+@click.option('--threshold', type=float, default=0.5, show_default=True, help='Estimated Jaccard similarity of two stories to count as near-duplicates')
+@click.option('--num-perm', type=int, default=128, show_default=True, help='Length of the MinHash signatures')
+@click.option('--shingle-size', type=int, default=5, show_default=True, help='Words per shingle')
+@click.option('--seed', type=int, default=0, show_default=True)
+def main(base_dir, output_dir, countries, threshold, num_perm, shingle_size, seed):
+    """Find near-duplicate stories within and across countries."""
+    stories = load_stories(base_dir, list(countries))
+    print(f"Finding near-duplicates among {len(stories)} stories from {stories['country'].nunique()} countries...")
+    pairs, clusters, country_pairs = find_near_duplicates(stories, threshold, num_perm, shingle_size, seed)
+
+    os.makedirs(output_dir, exist_ok=True)
+    pairs.to_csv(os.path.join(output_dir, "duplicate_pairs.csv"), index=False)
+    clusters.to_csv(os.path.join(output_dir, "duplicate_clusters.csv"), index=False)
+    country_pairs.to_csv(os.path.join(output_dir, "duplicate_country_pairs.csv"), index=False)
+
+    print(f"{len(pairs)} near-duplicate pairs in {clusters['cluster'].nunique()} clusters "
+          f"({len(clusters)} stories), saved to {output_dir}")
+    print(country_pairs.head(10).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Render the full set of figures from the combined tables, without a display.
+
+For the sentiments (from sentiment_counts.csv, written by gather_sentiments.py):
+- the sentiment distribution of every region and every sub-region, side by side
+- the sentiment distribution of the countries of each region and of each sub-region
+- the sentiment distribution of the selected countries (-c)
+- a boxplot of the sentiment counts per country
+For the words (from regional_word_freq.csv and filtered_word_freq.csv, written by gather_data.py):
+- the top words across sub-regions, across all countries, and across the countries of each region
+And, if the expanded unique words table of visualise_unique_words.py exists, a word cloud per region.
+And, if story_graphs.py has built the edge tables, the story flowchart of every country, region and sub-region.
+
+The figures are drawn with the Agg backend in a process pool and saved to analysis/figures/. The hash
+of the data behind each figure is kept in analysis/figures/figures.json, and figures whose data has
+not changed since they were last rendered are skipped. A table that is missing or cannot be read
+only loses its own figures; the others are still rendered, and the run exits with an error.
+
+Run from the repository root, e.g. `python3 analysis/script/render_figures.py -c NO -c JP`
+"""
+
+import os
+import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use("Agg")
+import click
+import pandas as pd
+import matplotlib.pyplot as plt
+from visualise_sentiments import plot_sentiment_proportions, plot_sentiment_boxplot, SENTIMENT_ORDER
+from boxplot_word_frequency import plot_top_words
+from visualise_unique_words import region_wordcloud, EXPANDED_FILE
+from story_graphs import plot_flowchart, LEVELS
+from countries import lookup
+
+DATA_DIR = "analysis/data"
+FIGURES_DIR = "analysis/figures"
+
+# Bump when a change to the plotting code changes the figures, to render them all again
+RENDER_VERSION = 1
+
+SELECTED_COUNTRIES = ["US", "GB", "KP", "AT"]
+TOP_WORDS = 20
+
+# Figure kind -> function drawing it from its data and parameters, returning the Figure
+FIGURE_KINDS = {
+    'proportions': plot_sentiment_proportions,
+    'sentiment_boxplot': plot_sentiment_boxplot,
+    'top_words': plot_top_words,
+    'wordcloud': region_wordcloud,
+    'flowchart': plot_flowchart,
+}
+
+
+def slug(name):
+    """
+    A region or sub-region name as part of a file name, e.g. "Latin America and the Caribbean" -> "Latin_America_and_the_Caribbean".
+    """
+    return re.sub(r"[^0-9A-Za-z]+", "_", name).strip("_")
+
+
+def load_sentiment_counts(data_dir=DATA_DIR):
+    """
+    The number of stories per sentiment in each country, from sentiment_counts.csv, or counted from
+    all_countries_sentiments.csv if gather_sentiments.py has not written it yet.
+    """
+    counts_file = os.path.join(data_dir, "sentiment_counts.csv")
+    if os.path.exists(counts_file):
+        return pd.read_csv(counts_file, keep_default_na=False, na_values=[""])
+    from gather_sentiments import sentiment_counts
+    sentiments = pd.read_csv(os.path.join(data_dir, "all_countries_sentiments.csv"), keep_default_na=False, na_values=[""])
+    return sentiment_counts(sentiments)
+
+
+def sentiment_figures(counts, selected_countries):
+    """
+    The sentiment figures: (name, kind, data, parameters) for each.
+    """
+    sentiments = [s for s in SENTIMENT_ORDER if s in counts.columns]
+    by_country = counts.set_index('country_name')[sentiments]
+    figures = [
+        ("sentiments_regions", 'proportions', counts.groupby('region')[sentiments].sum(),
+         {'title': "Proportional Sentiment Distribution by Region", 'xlabel': "Region"}),
+        ("sentiments_sub-regions", 'proportions', counts.groupby('sub-region')[sentiments].sum(),
+         {'title': "Proportional Sentiment Distribution by Sub-Region", 'xlabel': "Sub-Region"}),
+        ("sentiment_boxplot", 'sentiment_boxplot', by_country, {}),
+    ]
+    for level in ['region', 'sub-region']:
+        for group in sorted(counts[level].dropna().unique()):
+            figures.append((f"sentiments_{level}_{slug(group)}", 'proportions', by_country[(counts[level] == group).to_numpy()],
+                            {'title': f"Proportional Sentiment Distribution in {group}", 'xlabel': "Country Name"}))
+    selected = counts['alpha-2'].isin(selected_countries).to_numpy()
+    if selected.any():
+        figures.append(("sentiments_selected_countries", 'proportions', by_country[selected],
+                        {'title': "Proportional Sentiment Distribution for Selected Countries", 'xlabel': "Country Name"}))
+    return figures
+
+
+def with_global_freq(words):
+    """
+    A word frequency table with its global_freq column, summed from the count columns if the table
+    does not have one (e.g. written by an older gather_data.py).
+    """
+    if 'global_freq' in words.columns:
+        return words
+    columns = [c for c in words.columns if c not in ('Word', 'num_countries')]
+    return pd.concat([words, words[columns].sum(axis=1).rename('global_freq')], axis=1)
+
+
+def word_figures(data_dir, counts):
+    """
+    The top words figures: (name, kind, data, parameters) for each. Only the rows of the top words are
+    passed on, so neither the figure processes nor the hashes go through the whole table.
+    Without the sentiment counts (counts is None) the figures per region are left out.
+    """
+    figures = []
+    regional_file = os.path.join(data_dir, "regional_word_freq.csv")
+    if os.path.exists(regional_file):
+        regional = with_global_freq(pd.read_csv(regional_file, keep_default_na=False, na_values=[""]))
+        figures.append(("top_words_sub-regions", 'top_words', regional.nlargest(TOP_WORDS, "global_freq"), {'num_words': TOP_WORDS}))
+
+    countries_file = os.path.join(data_dir, "filtered_word_freq.csv")
+    if os.path.exists(countries_file):
+        by_country = with_global_freq(pd.read_csv(countries_file, keep_default_na=False, na_values=[""]))
+        figures.append(("top_words_countries", 'top_words', by_country.nlargest(TOP_WORDS, "global_freq"), {'num_words': TOP_WORDS}))
+        for region, region_countries in ([] if counts is None else counts.groupby('region')['alpha-2']):
+            columns = [c for c in region_countries if c in by_country.columns]
+            if not columns:
+                continue
+            region_words = by_country[['Word'] + columns].assign(global_freq=by_country[columns].sum(axis=1))
+            figures.append((f"top_words_region_{slug(region)}", 'top_words', region_words.nlargest(TOP_WORDS, "global_freq"),
+                            {'num_words': TOP_WORDS}))
+    return figures
+
+
+def wordcloud_figures(unique_words_file):
+    """
+    The word clouds of the unique words of each region: (name, kind, data, parameters) for each.
+    """
+    if not os.path.exists(unique_words_file):
+        return []
+    data = pd.read_csv(unique_words_file, keep_default_na=False, na_values=[""])
+    return [(f"wordcloud_inverse_uniqueness_{slug(region)}", 'wordcloud', subset[['word', 'proportion_of_global']], {'region': region})
+            for region, subset in data.groupby('region')]
+
+
+def flowchart_figures(data_dir):
+    """
+    The story flowcharts of every country, region and sub-region: (name, kind, data, parameters) for each.
+    """
+    figures = []
+    for level in LEVELS:
+        edges_file = os.path.join(data_dir, "plot_structure", f"{level}_edges.csv")
+        if not os.path.exists(edges_file):
+            continue
+        edges = pd.read_csv(edges_file, keep_default_na=False, na_values=[""])
+        for group, group_edges in edges.groupby('group'):
+            title = lookup([group], ['short_name'])['short_name'].fillna(group).iloc[0] if level == 'country' else group
+            figures.append((f"story_flowchart_{level}_{slug(group)}", 'flowchart', group_edges.drop(columns=['level', 'group']),
+                            {'title': f"Story Flowchart: {title}"}))
+    return figures
+
+
+def collect_figures(builders):
+    """
+    Call every figure list builder, so that a table that is missing or malformed only loses its own
+    figures instead of stopping the others from being rendered.
+
+    Parameters
+    ----------
+    builders : dict
+        Description -> function returning a list of (name, kind, data, parameters).
+
+    Returns
+    -------
+    tuple of (list, dict)
+        The figures, and the error of each builder that failed.
+    """
+    figures, failed = [], {}
+    for description, builder in builders.items():
+        try:
+            figures += builder()
+        except Exception as e:
+            failed[description] = e
+    return figures, failed
+
+
+def figure_hash(kind, data, params):
+    """
+    Hash of everything a figure is drawn from: the plotting code version, its kind, parameters and data.
+    """
+    digest = hashlib.sha256(json.dumps([RENDER_VERSION, kind, params], sort_keys=True).encode("utf-8"))
+    digest.update(data.to_csv().encode("utf-8"))
+    return digest.hexdigest()
+
+
+def render_figure(kind, data, params, output_path):
+    """
+    Draw one figure and save it (run in the worker processes).
+    """
+    fig = FIGURE_KINDS[kind](data, **params)
+    fig.savefig(output_path, dpi=300, bbox_inches="tight")
+    plt.close(fig)
+    return output_path
+
+
+def load_hashes(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_hashes(manifest_file, hashes):
+    temporary = f"{manifest_file}.tmp"
+    with open(temporary, 'w', encoding="utf-8") as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
+    os.replace(temporary, manifest_file)
+
+
+def render_all(figures, figures_dir=FIGURES_DIR, workers=None, force=False):
+    """
+    Render the figures whose data changed since they were last rendered, in a process pool.
+
+    Parameters
+    ----------
+    figures : list of tuple
+        (name, kind, data, parameters) of each figure, saved as <figures_dir>/<name>.png.
+    workers : int, optional
+        Number of processes (default: the number of CPUs).
+    force : bool
+        Render every figure, even those that are up to date.
+
+    Returns
+    -------
+    tuple of (list of str, list of str, dict)
+        The figures rendered, the figures skipped as up to date, and the error of each figure that failed.
+    """
+    os.makedirs(figures_dir, exist_ok=True)
+    manifest_file = os.path.join(figures_dir, "figures.json")
+    hashes = load_hashes(manifest_file)
+
+    stale, skipped = {}, []
+    for name, kind, data, params in figures:
+        output_path = os.path.join(figures_dir, f"{name}.png")
+        new_hash = figure_hash(kind, data, params)
+        if not force and hashes.get(name) == new_hash and os.path.exists(output_path):
+            skipped.append(name)
+        else:
+            stale[name] = (new_hash, kind, data, params, output_path)
+
+    rendered, failed = [], {}
+    if stale:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(render_figure, kind, data, params, output_path): name
+                           for name, (_, kind, data, params, output_path) in stale.items()}
+                for future in as_completed(futures):
+                    name = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed[name] = e
+                        continue
+                    hashes[name] = stale[name][0]
+                    rendered.append(name)
+        finally:
+            save_hashes(manifest_file, hashes)
+    return sorted(rendered), skipped, failed
+
+
+@click.command()
+@click.option('--data-dir', default=DATA_DIR, show_default=True, help='Directory with the combined tables')
+@click.option('--figures-dir', default=FIGURES_DIR, show_default=True)
+@click.option('-c', '--country', 'countries', multiple=True, default=SELECTED_COUNTRIES, show_default=True,
+              help='Country code to include in the selected countries chart (repeat for more)')
+@click.option('--unique-words', default=EXPANDED_FILE, show_default=True, help='Expanded unique words table, for the word clouds')
+@click.option('-w', '--workers', type=int, default=None, help='Number of processes [default: number of CPUs]')
+@click.option('-f', '--force', is_flag=True, help='Render every figure, even those whose data has not changed')
+def main(data_dir, figures_dir, countries, unique_words, workers, force):
+    """Render all region, sub-region and country figures."""
+    try:
+        counts = load_sentiment_counts(data_dir)
+    except Exception as e:
+        print(f"Skipping the sentiment figures and the top words per region, the sentiment counts could not be read: {e}")
+        counts = None
+    builders = {
+        'word figures': lambda: word_figures(data_dir, counts),
+        'word clouds': lambda: wordcloud_figures(unique_words),
+        'flowcharts': lambda: flowchart_figures(data_dir),
+    }
+    if counts is not None:
+        builders = {'sentiment figures': lambda: sentiment_figures(counts, countries), **builders}
+    figures, unbuilt = collect_figures(builders)
+    for description, error in unbuilt.items():
+        print(f"Skipping the {description}: {type(error).__name__}: {error}")
+
+    rendered, skipped, failed = render_all(figures, figures_dir, workers, force)
+    print(f"Rendered {len(rendered)} figures to {figures_dir}, skipped {len(skipped)} whose data has not changed")
+    for name, error in failed.items():
+        print(f"Failed to render {name}: {error}")
+    if failed or unbuilt or counts is None:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
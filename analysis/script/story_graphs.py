@@ -0,0 +1,280 @@
+"""
+Story graphs: the plot structure of the stories aggregated into a weighted directed graph per
+country, region and sub-region.
+
+The plot analysis of story_cli (script/plot_structure.py) writes one record per story to
+<CC>_plot_structure.csv, with a label for each slot of the story flowchart. Each story is a path
+through its slots, setting -> protagonist -> instigating event -> quest giver -> opponent ->
+resolution -> outcome. The nodes of a graph are the (slot, label) pairs, and the weight of an edge
+is the number of stories taking it. The edges of each country are kept in
+analysis/data/state/story_edges.pkl between runs, and only the countries whose records changed are
+read again. A region's graph is built by adding the edges of its countries one after another.
+
+`build` saves the edge tables to analysis/data/plot_structure/ (country_edges.csv, region_edges.csv
+and sub-region_edges.csv, with the columns of EDGE_COLUMNS). `flowchart` draws the flowchart of one
+country or region from them: the flowchart story_structure_updated.py draws by hand for Norway, for
+any country. render_figures.py draws the flowcharts of all countries and regions.
+
+Run from the repository root, e.g.
+`python3 analysis/script/story_graphs.py build` and `python3 analysis/script/story_graphs.py flowchart NO`
+"""
+
+import os
+import textwrap
+import click
+import pandas as pd
+import networkx as nx
+import matplotlib.pyplot as plt
+from combined_state import changed_countries, load_state, save_state
+from countries import lookup
+
+PLOT_STRUCTURE_DIR = "analysis/data/plot_structure"
+STATE_FILE = "analysis/data/state/story_edges.pkl"
+
+# The slots of plot_structure.py, in story order
+SLOTS = ['setting', 'protagonist', 'instigating_event', 'quest_giver', 'opponent', 'resolution', 'outcome']
+UNKNOWN = "unknown"
+
+EDGE_COLUMNS = ['level', 'group', 'source_slot', 'source', 'target_slot', 'target', 'weight']
+LEVELS = ['country', 'region', 'sub-region']
+
+# Distance between the centres of the labels of a slot in the flowchart
+NODE_SPACING = 2.2
+
+
+def story_edges(records):
+    """
+    Count the edges of the stories' paths through the slots.
+
+    Parameters
+    ----------
+    records : pandas.DataFrame
+        One row per story, with a column per slot.
+
+    Returns
+    -------
+    pandas.DataFrame
+        'source_slot', 'source', 'target_slot', 'target' and 'weight' (number of stories).
+    """
+    steps = [pd.DataFrame({'source_slot': source_slot, 'source': records[source_slot].to_numpy(),
+                           'target_slot': target_slot, 'target': records[target_slot].to_numpy()})
+             for source_slot, target_slot in zip(SLOTS, SLOTS[1:])]
+    edges = pd.concat(steps, ignore_index=True).fillna(UNKNOWN)
+    return edges.groupby(['source_slot', 'source', 'target_slot', 'target'], sort=False).size().rename('weight').reset_index()
+
+
+def update_edges(base_dir="data", state_file=STATE_FILE):
+    """
+    The edges of every country, reading only the plot structure files that changed since the last run.
+
+    Returns
+    -------
+    dict
+        {country: edges, as returned by story_edges}.
+    """
+    state = load_state(state_file, {'fingerprints': {}, 'edges': {}})
+    changed, removed = changed_countries(base_dir, "plot_structure", state['fingerprints'])
+    for directory in removed:
+        del state['fingerprints'][directory]
+        state['edges'].pop(directory, None)
+    for directory, fingerprint in changed.items():
+        file_path = os.path.join(base_dir, directory, f"{directory}_plot_structure.csv")
+        records = pd.read_csv(file_path, usecols=SLOTS, keep_default_na=False, na_values=[""])
+        state['edges'][directory] = story_edges(records)
+        state['fingerprints'][directory] = fingerprint
+    print(f"plot structure: updated {len(changed)} countries, removed {len(removed)}, "
+          f"{len(state['edges']) - len(changed)} unchanged")
+    save_state(state_file, state)
+    return state['edges']
+
+
+def story_graph(edges, graph=None):
+    """
+    Add edges to a weighted story graph.
+
+    Parameters
+    ----------
+    edges : pandas.DataFrame
+        'source_slot', 'source', 'target_slot', 'target' and 'weight'.
+    graph : networkx.DiGraph, optional
+        Graph to add to (the weights of the edges it has are increased). A new graph by default.
+
+    Returns
+    -------
+    networkx.DiGraph
+        Nodes are (slot, label) with 'slot' and 'label' attributes, edges have a 'weight'.
+    """
+    graph = nx.DiGraph() if graph is None else graph
+    for source_slot, source, target_slot, target, weight in edges[['source_slot', 'source', 'target_slot', 'target', 'weight']].itertuples(index=False):
+        for slot, label in ((source_slot, source), (target_slot, target)):
+            if (slot, label) not in graph:
+                graph.add_node((slot, label), slot=slot, label=label)
+        if graph.has_edge((source_slot, source), (target_slot, target)):
+            graph[(source_slot, source)][(target_slot, target)]['weight'] += weight
+        else:
+            graph.add_edge((source_slot, source), (target_slot, target), weight=weight)
+    return graph
+
+
+def group_graphs(country_edges, level):
+    """
+    The story graph of every region or sub-region, built by adding the graphs of its countries.
+
+    Returns
+    -------
+    dict
+        {region: networkx.DiGraph}.
+    """
+    countries = sorted(country_edges)
+    groups = lookup(countries, [level])[level]
+    graphs = {}
+    for country, group in zip(countries, groups):
+        if pd.isna(group):
+            continue
+        graphs[group] = story_graph(country_edges[country], graphs.get(group))
+    return graphs
+
+
+def graph_edges(graph):
+    """
+    The edges of a story graph as a table, heaviest first.
+    """
+    rows = [(source[0], source[1], target[0], target[1], data['weight']) for source, target, data in graph.edges(data=True)]
+    edges = pd.DataFrame(rows, columns=['source_slot', 'source', 'target_slot', 'target', 'weight'])
+    edges['step'] = edges['source_slot'].map(SLOTS.index)
+    return edges.sort_values(['step', 'weight'], ascending=[True, False], kind='stable').drop(columns='step')
+
+
+def edge_tables(country_edges):
+    """
+    The edge tables of the countries, regions and sub-regions.
+
+    Returns
+    -------
+    dict
+        {level: pandas.DataFrame with EDGE_COLUMNS}.
+    """
+    tables = {'country': {country: graph_edges(story_graph(edges)) for country, edges in country_edges.items()}}
+    for level in LEVELS[1:]:
+        tables[level] = {group: graph_edges(graph) for group, graph in group_graphs(country_edges, level).items()}
+
+    result = {}
+    for level, groups in tables.items():
+        frames = [edges.assign(level=level, group=group) for group, edges in sorted(groups.items())]
+        result[level] = pd.concat(frames, ignore_index=True)[EDGE_COLUMNS] if frames else pd.DataFrame(columns=EDGE_COLUMNS)
+    return result
+
+
+def build_edge_tables(base_dir="data", output_dir=PLOT_STRUCTURE_DIR, state_file=STATE_FILE):
+    """
+    Update the country edges and save the edge tables of all levels to output_dir.
+    """
+    tables = edge_tables(update_edges(base_dir, state_file))
+    os.makedirs(output_dir, exist_ok=True)
+    for level, table in tables.items():
+        table.to_csv(os.path.join(output_dir, f"{level}_edges.csv"), index=False)
+    return tables
+
+
+def load_edge_table(level, output_dir=PLOT_STRUCTURE_DIR):
+    file_path = os.path.join(output_dir, f"{level}_edges.csv")
+    if not os.path.exists(file_path):
+        raise click.ClickException(f"No edge table {file_path}, run `build` first")
+    return pd.read_csv(file_path, keep_default_na=False, na_values=[""])
+
+
+def plot_flowchart(edges, title="Story Flowchart", top_n=4):
+    """
+    Draw the flowchart of a story graph: the slots from top to bottom, with the top_n most common
+    labels of each slot side by side ('unknown' is left out) and the edges between them drawn in
+    proportion to the number of stories.
+
+    Parameters
+    ----------
+    edges : pandas.DataFrame
+        The edges of one country or region, from an edge table.
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+    """
+    graph = story_graph(edges)
+    stories = {node: max(graph.in_degree(node, weight='weight'), graph.out_degree(node, weight='weight')) for node in graph}
+    kept = []
+    for slot in SLOTS:
+        nodes = [n for n in graph if n[0] == slot and n[1] != UNKNOWN]
+        kept += sorted(nodes, key=lambda n: (-stories[n], n[1]))[:top_n]
+    graph = graph.subgraph(kept)
+
+    pos = {}
+    for row, slot in enumerate(SLOTS):
+        nodes = [n for n in kept if n[0] == slot]
+        for i, node in enumerate(nodes):
+            pos[node] = (NODE_SPACING * (i - (len(nodes) - 1) / 2), -row)
+
+    # The widest row spans half_width on either side of 0, with the slot names in a column to its left.
+    # The figure grows with it, so the nodes keep their size in data units and do not overlap.
+    half_width = NODE_SPACING * (top_n - 1) / 2
+    label_x = -half_width - 1.9
+    left, right = label_x - 1.3, half_width + 1.2
+    fig, ax = plt.subplots(figsize=(12 * (right - left) / 11, 13))
+    heaviest = max((w for _, _, w in graph.edges(data='weight')), default=1)
+    nx.draw_networkx_edges(graph, pos, ax=ax, edge_color="gray", arrows=True, node_size=3000,
+                           width=[0.5 + 6 * w / heaviest for _, _, w in graph.edges(data='weight')])
+    nx.draw_networkx_nodes(graph, pos, ax=ax, node_size=3000, node_color="lightblue")
+    nx.draw_networkx_labels(graph, pos, ax=ax, font_size=9, font_weight="bold",
+                            labels={n: f"{textwrap.fill(n[1], 14)}\n({stories[n]})" for n in graph})
+    for row, slot in enumerate(SLOTS):
+        ax.text(label_x, -row, slot.replace("_", " "), ha="right", va="center", fontsize=11, style="italic")
+    ax.set_xlim(left, right)
+    ax.set_ylim(-len(SLOTS) + 0.5, 0.5)
+    ax.set_title(title)
+    ax.axis("off")
+    return fig
+
+
+def find_group(tables, name):
+    """
+    The level and group of a country code, region or sub-region name.
+    """
+    for level in LEVELS:
+        if name in set(tables[level]['group']):
+            return level, name
+    raise click.ClickException(f"No plot structure for {name}")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+def build(base_dir):
+    """Build the story graphs and save their edge tables."""
+    tables = build_edge_tables(base_dir)
+    for level, table in tables.items():
+        print(f"{level}: {table['group'].nunique()} graphs, {len(table)} edges")
+    print(f"Saved to {PLOT_STRUCTURE_DIR}")
+
+
+@cli.command()
+@click.argument('name')
+@click.option('-n', '--top-n', default=4, show_default=True, help='Labels to show per slot')
+@click.option('-o', '--output', default=None, help='Output file [default: analysis/figures/story_flowchart_<NAME>.png]')
+def flowchart(name, top_n, output):
+    """Draw the story flowchart of a country code, region or sub-region."""
+    tables = {level: load_edge_table(level) for level in LEVELS}
+    level, group = find_group(tables, name)
+    edges = tables[level][tables[level]['group'] == group]
+    title = lookup([group], ['short_name'])['short_name'].iloc[0] if level == 'country' else group
+    fig = plot_flowchart(edges, f"Story Flowchart: {title if pd.notna(title) else group}", top_n)
+    output = output or f"analysis/figures/story_flowchart_{group.replace(' ', '_')}.png"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    fig.savefig(output, dpi=300, bbox_inches="tight")
+    plt.close(fig)
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    cli()
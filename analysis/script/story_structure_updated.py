@@ -7,6 +7,7 @@ that is hardcoded into the script.
 It does not automatically identify the plotline, it is just a visualisation of provided data.
 At this point it is written for the Norwegian stories in the GPT-stories dataset,
 though it may be developed to work more generally in the future.
+story_graphs.py draws the same flowchart for any country or region from the plot structure of its stories.
 
 The script creates a file saved as "analysis/figures/story_flowchart.png"
 """
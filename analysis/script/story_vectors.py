@@ -0,0 +1,318 @@
+"""
+Dense story vectors and nearest-neighbour search, for questions like "which stories from other
+countries are most like this Norwegian story?".
+
+`build` reads the lemma counts per story written by the words stage (<CC>_story_lemmas.csv),
+weights them with TF-IDF, reduces them with truncated SVD (LSA) and saves the L2-normalised
+float32 vectors to analysis/data/vectors/vectors.npy. The vectors are opened memory-mapped, so
+searches do not need to load them all, and the cosine similarity of two stories is the dot
+product of their vectors.
+
+Run from the repository root, e.g.
+`python3 analysis/script/story_vectors.py build`, `python3 analysis/script/story_vectors.py similar NO_1 --other-countries`
+"""
+
+import os
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from corpus import add_regions
+
+VECTORS_DIR = "analysis/data/vectors"
+QUERY_BLOCK_SIZE = 1024
+
+
+def load_lemma_counts(base_dir="data", countries=None):
+    """
+    Read the per-story lemma counts of every country into a sparse stories x lemmas matrix.
+
+    Returns
+    -------
+    tuple of (scipy.sparse.csr_matrix, pandas.DataFrame, numpy.ndarray, list)
+        The counts, the stories of the rows ('Story_ID', 'country'), the lemmas of the columns
+        and the countries that have stories but no lemma counts yet.
+    """
+    frames, missing = [], []
+    for directory in sorted(os.listdir(base_dir)):
+        if countries and directory not in countries:
+            continue
+        file_path = os.path.join(base_dir, directory, f"{directory}_story_lemmas.csv")
+        if os.path.exists(file_path):
+            # keep_default_na so lemmas like "nan" and "null" stay words
+            data = pd.read_csv(file_path, keep_default_na=False, dtype={'Story_ID': str, 'Lemma': str})
+            data['country'] = directory
+            frames.append(data)
+        elif os.path.exists(os.path.join(base_dir, directory, f"{directory}_stories.csv")):
+            missing.append(directory)
+    if not frames:
+        raise FileNotFoundError(f"No <CC>_story_lemmas.csv files in {base_dir}, run the words analysis first "
+                                f"(python3 story_cli.py analyze all -a words)")
+
+    counts = pd.concat(frames, ignore_index=True)
+    rows, story_ids = pd.factorize(counts['Story_ID'])
+    columns, lemmas = pd.factorize(counts['Lemma'], sort=True)
+    matrix = sparse.csr_matrix((counts['Count'].to_numpy(dtype=np.float32), (rows, columns)),
+                               shape=(len(story_ids), len(lemmas)))
+    stories = counts.drop_duplicates('Story_ID')[['Story_ID', 'country']].reset_index(drop=True)
+    return matrix, stories, np.asarray(lemmas, dtype=object), missing
+
+
+def build_vectors(base_dir="data", output_dir=VECTORS_DIR, n_components=256, min_df=2, seed=0):
+    """
+    Build the TF-IDF/LSA story vectors and save them.
+
+    Parameters
+    ----------
+    n_components : int
+        Length of the vectors (SVD components).
+    min_df : int
+        Ignore lemmas used in fewer stories than this.
+    seed : int
+        Seed of the randomized SVD.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, pandas.DataFrame, list)
+        The vectors, their stories and the countries skipped for lack of lemma counts.
+    """
+    from sklearn.feature_extraction.text import TfidfTransformer
+    from sklearn.decomposition import TruncatedSVD
+
+    counts, stories, lemmas, missing = load_lemma_counts(base_dir)
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    counts = counts[:, document_frequency >= min_df]
+
+    tfidf = TfidfTransformer(sublinear_tf=True).fit_transform(counts)
+    n_components = min(n_components, tfidf.shape[1] - 1, tfidf.shape[0] - 1)
+    svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=seed)
+    vectors = svd.fit_transform(tfidf).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1)
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "vectors.npy"), vectors)
+    stories.to_csv(os.path.join(output_dir, "stories.csv"), index=False)
+    print(f"{len(stories)} story vectors of length {n_components} from {counts.shape[1]} lemmas "
+          f"({svd.explained_variance_ratio_.sum():.0%} of the TF-IDF variance), saved to {output_dir}")
+    return vectors, stories, missing
+
+
+def load_vectors(output_dir=VECTORS_DIR):
+    """
+    Open the saved vectors memory-mapped, with the table of their stories.
+    """
+    vectors = np.load(os.path.join(output_dir, "vectors.npy"), mmap_mode='r')
+    stories = pd.read_csv(os.path.join(output_dir, "stories.csv"), keep_default_na=False)
+    return vectors, stories
+
+
+def knn(vectors, queries, k=10, allowed=None, query_rows=None, block_size=8192):
+    """
+    Exact k nearest neighbours by cosine similarity, scanning the vectors in blocks.
+
+    Only one block of vectors and one block of scores are in memory at a time, so this works
+    on memory-mapped vectors of any size.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        Normalised vectors to search (n x d), e.g. from load_vectors.
+    queries : numpy.ndarray
+        Normalised query vectors (q x d).
+    k : int
+        Neighbours per query.
+    allowed : numpy.ndarray of bool, optional
+        Which vectors may be returned, e.g. only those of other countries.
+    query_rows : numpy.ndarray of int, optional
+        Row of each query in vectors, so a story is not returned as its own neighbour.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray)
+        Indices (q x k, -1 where there are fewer than k candidates) and similarities, best first.
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if len(queries) > QUERY_BLOCK_SIZE:
+        # Many queries are searched a block at a time, to bound the size of the score matrix
+        results = [knn(vectors, queries[start:start + QUERY_BLOCK_SIZE], k, allowed,
+                       None if query_rows is None else query_rows[start:start + QUERY_BLOCK_SIZE], block_size)
+                   for start in range(0, len(queries), QUERY_BLOCK_SIZE)]
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size])
+        scores = queries @ block.T
+        if allowed is not None:
+            scores[:, ~allowed[start:start + len(block)]] = -np.inf
+        if query_rows is not None:
+            own = (query_rows >= start) & (query_rows < start + len(block))
+            scores[np.flatnonzero(own), query_rows[own] - start] = -np.inf
+        # Keep the best k of the previous best and this block
+        scores = np.concatenate([best_scores, scores], axis=1)
+        indices = np.concatenate([best_indices, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if scores.shape[1] > k else np.argsort(-scores, axis=1)
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_indices = np.take_along_axis(indices, top, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_indices = np.take_along_axis(best_indices, order, axis=1)
+    best_indices[~np.isfinite(best_scores)] = -1
+    return best_indices, best_scores
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour index: the vectors are split into clusters with k-means, and a
+    search only scans the n_probe clusters whose centres are closest to the query.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        The normalised vectors.
+    n_lists : int, optional
+        Number of clusters, by default about the square root of the number of vectors.
+    """
+
+    def __init__(self, vectors, n_lists=None, seed=0, centroids=None, assignments=None):
+        if centroids is None:
+            from sklearn.cluster import MiniBatchKMeans
+            n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+            kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3, batch_size=4096)
+            assignments = kmeans.fit_predict(np.asarray(vectors))
+            centroids = kmeans.cluster_centers_.astype(np.float32)
+        self.vectors = vectors
+        self.centroids = centroids
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+
+    def save(self, file_path):
+        np.savez(file_path, centroids=self.centroids, assignments=self.assignments)
+
+    @classmethod
+    def load(cls, file_path, vectors):
+        saved = np.load(file_path)
+        return cls(vectors, centroids=saved['centroids'], assignments=saved['assignments'])
+
+    def search(self, queries, k=10, n_probe=8, allowed=None, query_rows=None):
+        """
+        Approximate k nearest neighbours, with the same arguments and results as knn().
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :n_probe]
+        all_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = np.sort(np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes[i]]))
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            if query_rows is not None:
+                candidates = candidates[candidates != query_rows[i]]
+            indices, scores = knn(np.asarray(self.vectors[candidates]), query, k)
+            found = indices[0] >= 0
+            all_indices[i, :found.sum()] = candidates[indices[0][found]]
+            all_scores[i, :found.sum()] = scores[0][found]
+        return all_indices, all_scores
+
+
+def country_centroids(vectors, stories, block_size=8192):
+    """
+    The normalised mean vector of each country's stories.
+
+    Returns
+    -------
+    tuple of (numpy.ndarray, numpy.ndarray)
+        The countries (sorted) and their centroids.
+    """
+    codes, countries = pd.factorize(stories['country'], sort=True)
+    sums = np.zeros((len(countries), vectors.shape[1]), dtype=np.float64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float64)
+        block_codes = codes[start:start + len(block)]
+        # Country x story indicator matrix times the block sums each country's rows
+        indicator = sparse.csr_matrix((np.ones(len(block)), (block_codes, np.arange(len(block)))), shape=(len(countries), len(block)))
+        sums += indicator @ block
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    return np.asarray(countries), (sums / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+
+def country_similarity(vectors, stories):
+    """
+    Cosine similarity of every pair of country centroids, as a countries x countries DataFrame.
+    """
+    countries, centroids = country_centroids(vectors, stories)
+    return pd.DataFrame(centroids @ centroids.T, index=countries, columns=countries)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+@click.option('--components', 'n_components', type=int, default=256, show_default=True, help='Length of the story vectors')
+@click.option('--min-df', type=int, default=2, show_default=True, help='Ignore lemmas used in fewer stories than this')
+@click.option('--approximate-index', is_flag=True, help='Also build the approximate (clustered) index')
+@click.option('--seed', type=int, default=0, show_default=True)
+def build(base_dir, n_components, min_df, approximate_index, seed):
+    """Build the story vectors from the lemma counts per story."""
+    vectors, stories, missing = build_vectors(base_dir, VECTORS_DIR, n_components, min_df, seed)
+    if missing:
+        print(f"Skipped {len(missing)} countries without lemma counts per story (run the words analysis for them): {' '.join(missing)}")
+    if approximate_index:
+        IVFIndex(vectors, seed=seed).save(os.path.join(VECTORS_DIR, "ivf_index.npz"))
+        print("Approximate index saved")
+
+    similarity = country_similarity(vectors, stories)
+    similarity.to_csv(os.path.join(VECTORS_DIR, "country_similarity.csv"), float_format="%.4f")
+    print(f"Country x country similarity saved to {os.path.join(VECTORS_DIR, 'country_similarity.csv')}")
+
+
+@cli.command()
+@click.argument('story_id')
+@click.option('-k', default=10, show_default=True, help='How many similar stories to show')
+@click.option('--other-countries', is_flag=True, help='Only stories from other countries')
+@click.option('--approximate', is_flag=True, help='Use the approximate index (build it with build --approximate-index)')
+@click.option('--n-probe', default=8, show_default=True, help='Clusters to scan with --approximate')
+def similar(story_id, k, other_countries, approximate, n_probe):
+    """Show the stories most similar to STORY_ID."""
+    vectors, stories = load_vectors()
+    matches = np.flatnonzero(stories['Story_ID'].to_numpy() == story_id)
+    if not len(matches):
+        raise click.ClickException(f"No vector for {story_id}")
+    row = matches[:1]
+    allowed = (stories['country'] != stories['country'].iloc[row[0]]).to_numpy() if other_countries else None
+
+    if approximate:
+        index = IVFIndex.load(os.path.join(VECTORS_DIR, "ivf_index.npz"), vectors)
+        indices, scores = index.search(vectors[row], k, n_probe, allowed, row)
+    else:
+        indices, scores = knn(vectors, vectors[row], k, allowed, row)
+    found = indices[0] >= 0
+    result = stories.iloc[indices[0][found]].assign(similarity=scores[0][found].round(4))
+    print(add_regions(result)[['Story_ID', 'country', 'sub-region', 'similarity']].to_string(index=False))
+
+
+@cli.command()
+@click.option('-c', '--country', default=None, help='Show the countries most similar to this one')
+@click.option('-n', default=10, show_default=True)
+def countries(country, n):
+    """Show the most similar countries (by the mean vector of their stories)."""
+    vectors, stories = load_vectors()
+    similarity = country_similarity(vectors, stories)
+    if country:
+        if country not in similarity.index:
+            raise click.ClickException(f"No story vectors for {country}")
+        print(similarity[country].drop(country).sort_values(ascending=False).head(n).to_string())
+        return
+    pairs = similarity.where(np.triu(np.ones(similarity.shape, dtype=bool), k=1)).stack()
+    print(pairs.sort_values(ascending=False).head(n).to_string())
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,55 @@
+"""
+Tests of the reference table seeded by name_imputation and of the levels names are matched on.
+Run with `python -m pytest` from analysis/script/.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from name_imputation import NameReference, seed_reference
+
+US_IMPUTED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data",
+                               "US_names_with_imputed_race_from_census.csv")
+
+
+@pytest.fixture
+def us_file(tmp_path):
+    us = pd.DataFrame({
+        'Name': ["Emma Collins", "Liam Collins", "Maggie Thompson", "Clara"],
+        'first': ["Emma", "Liam", "Maggie", "Clara"],
+        'last': ["Collins", "Collins", "Thompson", None],
+        'black': [0.2, 0.4, 0.3, 0.1],
+        'white': [0.8, 0.6, 0.7, 0.9],
+        'race': ["white", "white", "white", "white"],
+    })
+    path = tmp_path / "us.csv"
+    us.to_csv(path, index=False)
+    return path
+
+
+def test_seed_writes_last_names(us_file, tmp_path):
+    reference = seed_reference(us_file, tmp_path / "reference.csv")
+
+    last = reference[reference['kind'] == 'last'].set_index('name')
+    assert sorted(last.index) == ["Collins", "Thompson"]
+    # The mean over the full names with that last name
+    assert last.loc["Collins", 'black'] == pytest.approx(0.3)
+    assert sorted(reference.loc[reference['kind'] == 'first', 'name']) == ["Clara"]
+
+
+def test_match_on_last_name_alone(us_file, tmp_path):
+    seed_reference(us_file, tmp_path / "reference.csv")
+    reference = NameReference.load(str(tmp_path / "reference.csv"))
+
+    match, probabilities = reference.impute(pd.Series(["Noah Collins", "Emma Collins", "Clara Smith", "Noah"]))
+    assert match.tolist() == ['last', 'full', 'first', 'none']
+    assert probabilities[0] == pytest.approx([0.3, 0.7])
+    assert np.isnan(probabilities[3]).all()
+
+
+def test_shipped_seed_has_last_names(tmp_path):
+    reference = NameReference(seed_reference(US_IMPUTED_FILE, tmp_path / "reference.csv"))
+    assert len(reference.index['last']) > 0
+    match, _ = reference.impute(pd.Series(["Jordan Collins"]))
+    assert match.tolist() == ['last']
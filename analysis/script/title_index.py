@@ -0,0 +1,205 @@
+"""
+Titles of every story, and an inverted index from title words to titles.
+
+`build` extracts the title of each story in one vectorized pass and saves them with the story's
+country, region and sub-region to analysis/data/titles.csv. The index (a sparse titles x words
+matrix, whose columns are the posting lists) is saved next to it, so questions like "how many
+titles contain 'whisper', per region" are answered without reading the stories again.
+
+Run from the repository root, e.g.
+`python3 analysis/script/title_index.py build` and `python3 analysis/script/title_index.py count whisper --by region`
+"""
+
+import os
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from corpus import load_stories, add_regions
+
+TITLES_FILE = "analysis/data/titles.csv"
+INDEX_FILE = "analysis/data/title_index.npz"
+
+# Words that label a title line in the languages the stories were written in
+TITLE_LABELS = r"title|titel|titre|titolo|título|titulo|tytuł|název|naslov|otsikko|tittel|titill"
+
+# "**Title: X**", "**Title:** *X*", "### Title: X", "Título: **X**", ... anywhere in the first lines
+LABELLED_TITLE = rf"(?im)^[#\s*_]*(?:{TITLE_LABELS})[*_\s]*:[*_\s]*(?P<title>[^\n]+?)[*_\s]*$"
+# Otherwise the first line that is a heading or entirely bold, e.g. "**The Echoes of Heddal**",
+# as long as it is not a chapter or section heading
+HEADING = r"(?im)^\s*(?:#+\s*|\*\*)(?!(?:chapter|part|setting|characters?|prologue|epilogue|act|scene)\b)(?P<title>[^*#\n]{2,150}?)(?:\*\*)?\s*$"
+
+# Only the start of a story is searched, where the title is
+TITLE_SEARCH_LENGTH = 400
+
+
+def extract_titles(stories):
+    """
+    Extract the title of each story.
+
+    Returns
+    -------
+    pandas.DataFrame
+        'title' (None when no title was found) and 'title_format' ('labelled', 'heading' or 'none').
+    """
+    start = stories.astype(str).str[:TITLE_SEARCH_LENGTH]
+    labelled = start.str.extract(LABELLED_TITLE)['title']
+    heading = start.str.extract(HEADING)['title']
+    title = labelled.fillna(heading).str.strip(" \"'“”‘’*_").replace("", None)
+
+    title_format = np.where(labelled.notna(), 'labelled', np.where(heading.notna(), 'heading', 'none'))
+    return pd.DataFrame({'title': title, 'title_format': title_format}, index=stories.index)
+
+
+def tokenize(titles):
+    """
+    Lowercase words of each title, as a Series of lists.
+    """
+    return titles.fillna("").str.lower().str.findall(r"[^\W_]+(?:'[^\W_]+)?")
+
+
+class TitleIndex:
+    """
+    Inverted index from the lowercase words of titles to the titles containing them.
+
+    Parameters
+    ----------
+    titles : pandas.DataFrame
+        One row per story with at least 'title', as written by build_titles.
+    matrix : scipy.sparse.csc_matrix, optional
+        titles x vocabulary matrix with a 1 where a title contains a word. Built from titles when not given.
+    vocabulary : numpy.ndarray, optional
+        The sorted words of the matrix columns.
+    """
+
+    def __init__(self, titles, matrix=None, vocabulary=None):
+        self.titles = titles.reset_index(drop=True)
+        if matrix is None:
+            tokens = tokenize(self.titles['title']).explode().dropna()
+            word_codes, vocabulary = pd.factorize(tokens, sort=True)
+            matrix = sparse.csc_matrix((np.ones(len(word_codes), dtype=bool), (tokens.index.to_numpy(), word_codes)),
+                                       shape=(len(self.titles), len(vocabulary)))
+        self.matrix = matrix.tocsc()
+        self.vocabulary = np.asarray(vocabulary, dtype=object)
+
+    def save(self, index_file):
+        sparse.save_npz(index_file, self.matrix)
+        np.save(index_file.replace(".npz", "_vocabulary.npy"), self.vocabulary.astype(str))
+
+    @classmethod
+    def load(cls, titles_file=TITLES_FILE, index_file=INDEX_FILE):
+        titles = pd.read_csv(titles_file, keep_default_na=False, na_values=[""])
+        matrix = sparse.load_npz(index_file)
+        vocabulary = np.load(index_file.replace(".npz", "_vocabulary.npy"))
+        return cls(titles, matrix, vocabulary)
+
+    def matching_words(self, word, match="substring"):
+        """
+        Words of the vocabulary matching a query word: the same word ('word'), words starting
+        with it ('prefix') or words containing it ('substring', like str.contains).
+        """
+        word = word.lower()
+        if match == "word":
+            position = np.searchsorted(self.vocabulary, word)
+            found = position < len(self.vocabulary) and self.vocabulary[position] == word
+            return np.array([position]) if found else np.array([], dtype=int)
+        if match == "prefix":
+            start = np.searchsorted(self.vocabulary, word)
+            end = np.searchsorted(self.vocabulary, word + "\uffff")
+            return np.arange(start, end)
+        return np.flatnonzero(np.char.find(self.vocabulary.astype(str), word) >= 0)
+
+    def rows(self, query, match="substring"):
+        """
+        Boolean mask of the titles containing every word of the query.
+        """
+        mask = np.ones(len(self.titles), dtype=bool)
+        for word in tokenize(pd.Series([query]))[0]:
+            columns = self.matrix[:, self.matching_words(word, match)]
+            mask &= np.asarray(columns.sum(axis=1)).ravel() > 0
+        return mask
+
+    def find(self, query, match="substring"):
+        """
+        The rows of the titles table whose title contains every word of the query.
+        """
+        return self.titles[self.rows(query, match)]
+
+    def count(self, query, by='region', match="substring"):
+        """
+        Number of titles containing the query, per value of a column of the titles table
+        (e.g. 'region', 'sub-region' or 'country'), with the share of all titles of that group.
+        """
+        mask = self.rows(query, match)
+        groups = self.titles[by].fillna("Unknown")
+        counts = pd.DataFrame({'titles': pd.Series(mask).groupby(groups.to_numpy()).sum(),
+                               'all_titles': groups.value_counts()})
+        counts['share'] = (counts['titles'] / counts['all_titles']).round(4)
+        counts.index.name = by
+        return counts.sort_values('titles', ascending=False)
+
+
+def build_titles(base_dir="data", titles_file=TITLES_FILE, index_file=INDEX_FILE):
+    """
+    Extract the titles of all stories and build the word index.
+
+    Returns
+    -------
+    TitleIndex
+    """
+    stories = load_stories(base_dir)
+    titles = extract_titles(stories['Story'])
+    titles.insert(0, 'story_id', stories['Story_ID'])
+    titles.insert(1, 'country', stories['country'])
+    titles = add_regions(titles)
+
+    os.makedirs(os.path.dirname(titles_file), exist_ok=True)
+    titles.to_csv(titles_file, index=False)
+    index = TitleIndex(titles)
+    index.save(index_file)
+    return index
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+def build(base_dir):
+    """Extract all titles and build the word index."""
+    index = build_titles(base_dir)
+    formats = index.titles['title_format'].value_counts()
+    print(f"Extracted {formats.drop('none', errors='ignore').sum()} titles from {len(index.titles)} stories "
+          f"({', '.join(f'{n} {f}' for f, n in formats.items())}), {len(index.vocabulary)} distinct title words")
+    print(f"Saved to {TITLES_FILE} and {INDEX_FILE}")
+
+
+@cli.command()
+@click.argument('query')
+@click.option('--by', default='region', show_default=True, type=click.Choice(['region', 'sub-region', 'country']))
+@click.option('--match', default='substring', show_default=True, type=click.Choice(['word', 'prefix', 'substring']), help='How each query word matches title words')
+@click.option('--list', 'list_titles', is_flag=True, help='Also list the matching titles with their counts')
+def count(query, by, match, list_titles):
+    """Count the titles containing every word of QUERY."""
+    index = TitleIndex.load()
+    with pd.option_context('display.max_rows', None):
+        print(index.count(query, by, match))
+        if list_titles:
+            print(index.find(query, match)['title'].value_counts().to_string())
+
+
+@cli.command()
+@click.option('-c', '--country', default=None, help='Only titles from this country code')
+@click.option('-n', default=20, show_default=True, help='How many titles to show')
+def top(country, n):
+    """Show the most common titles."""
+    titles = TitleIndex.load().titles
+    if country:
+        titles = titles[titles['country'] == country]
+    print(titles['title'].value_counts().head(n).to_string())
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,211 @@
+"""
+Topic model of the stories: minibatch NMF over the TF-IDF weighted lemma counts per story.
+
+`fit` learns the topics from every country with lemma counts (<CC>_story_lemmas.csv, written by
+the words stage). `update` adds the countries that arrived since with partial_fit, updating the
+topics without refitting: the vocabulary and IDF weights stay those of the first fit, so lemmas
+that only new countries use are ignored until the next `fit`.
+
+Both write to analysis/data/topics/:
+- story_topics.csv: the topic weights of each story (summing to 1)
+- country_topics.csv: the mean topic distribution of each country's stories
+- topic_terms.csv: the top lemmas of each topic with their weights
+
+Run from the repository root, e.g. `python3 analysis/script/topics.py fit --topics 20`
+"""
+
+import os
+import pickle
+import click
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from story_vectors import load_lemma_counts
+
+TOPICS_DIR = "analysis/data/topics"
+MODEL_FILE = os.path.join(TOPICS_DIR, "model.pkl")
+
+
+def tfidf(counts, idf):
+    """
+    Sublinear TF-IDF with fixed IDF weights, rows normalised to unit length.
+    """
+    weighted = counts.tocsr(copy=True).astype(np.float32)
+    weighted.data = 1 + np.log(weighted.data)
+    weighted = weighted @ sparse.diags(idf.astype(np.float32))
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1))).ravel()
+    return sparse.diags(1 / np.where(norms > 0, norms, 1)) @ weighted
+
+
+def to_vocabulary(counts, lemmas, vocabulary):
+    """
+    Re-index the columns of a stories x lemmas matrix to a fixed vocabulary, dropping unknown lemmas.
+    """
+    positions = pd.Index(vocabulary).get_indexer(lemmas)
+    known = positions >= 0
+    mapping = sparse.csr_matrix((np.ones(known.sum(), dtype=np.float32), (np.flatnonzero(known), positions[known])),
+                                shape=(len(lemmas), len(vocabulary)))
+    return counts @ mapping
+
+
+def fit_topics(base_dir="data", n_topics=20, min_df=5, max_df=0.9, batch_size=1024, seed=0):
+    """
+    Fit the topic model on every country with lemma counts and save it with its outputs.
+
+    Parameters
+    ----------
+    n_topics : int
+        Number of topics.
+    min_df : int
+        Ignore lemmas used in fewer stories than this.
+    max_df : float
+        Ignore lemmas used in more than this share of the stories (they say nothing about topics).
+    batch_size : int
+        Stories per minibatch.
+    seed : int
+        Seed of the initialisation.
+    """
+    from sklearn.decomposition import MiniBatchNMF
+
+    counts, stories, lemmas, missing = load_lemma_counts(base_dir)
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    keep = (document_frequency >= min_df) & (document_frequency <= max_df * counts.shape[0])
+    counts, vocabulary = counts[:, keep], lemmas[keep]
+    idf = np.log((1 + counts.shape[0]) / (1 + document_frequency[keep])) + 1
+
+    model = MiniBatchNMF(n_components=n_topics, batch_size=batch_size, init="nndsvda", random_state=seed)
+    model.fit(tfidf(counts, idf))
+
+    state = {'model': model, 'vocabulary': vocabulary, 'idf': idf, 'countries': sorted(stories['country'].unique())}
+    save_model(state)
+    print(f"Fitted {n_topics} topics on {len(stories)} stories from {len(state['countries'])} countries "
+          f"({len(vocabulary)} lemmas)")
+    if missing:
+        print(f"Skipped {len(missing)} countries without lemma counts per story: {' '.join(missing)}")
+    write_outputs(state, base_dir)
+    return state
+
+
+def update_topics(base_dir="data", passes=1):
+    """
+    Update the saved topic model with the countries that have lemma counts but were not fitted yet.
+
+    Returns
+    -------
+    list of str
+        The countries added.
+    """
+    state = load_model()
+    available = [d for d in sorted(os.listdir(base_dir))
+                 if os.path.exists(os.path.join(base_dir, d, f"{d}_story_lemmas.csv"))]
+    new_countries = [c for c in available if c not in state['countries']]
+    if not new_countries:
+        print("No new countries, the topics are up to date")
+        return []
+
+    counts, stories, lemmas, _ = load_lemma_counts(base_dir, new_countries)
+    weighted = tfidf(to_vocabulary(counts, lemmas, state['vocabulary']), state['idf'])
+    model = state['model']
+    rng = np.random.default_rng(len(state['countries']))
+    for _ in range(passes):
+        order = rng.permutation(weighted.shape[0])
+        for start in range(0, len(order), model.batch_size):
+            model.partial_fit(weighted[order[start:start + model.batch_size]])
+
+    state['countries'] = sorted(state['countries'] + new_countries)
+    save_model(state)
+    print(f"Updated the topics with {len(stories)} stories from {len(new_countries)} new countries: {' '.join(new_countries)}")
+    write_outputs(state, base_dir)
+    return new_countries
+
+
+def save_model(state):
+    os.makedirs(TOPICS_DIR, exist_ok=True)
+    temporary = f"{MODEL_FILE}.tmp"
+    with open(temporary, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(temporary, MODEL_FILE)
+
+
+def load_model():
+    if not os.path.exists(MODEL_FILE):
+        raise click.ClickException(f"No topic model in {MODEL_FILE}, run `fit` first")
+    with open(MODEL_FILE, 'rb') as f:
+        return pickle.load(f)
+
+
+def topic_terms(state, n_terms=15):
+    """
+    The n_terms lemmas with the largest weight in each topic.
+    """
+    components = state['model'].components_
+    top = np.argsort(-components, axis=1)[:, :n_terms]
+    return pd.DataFrame({
+        'topic': np.repeat(np.arange(len(components)), n_terms),
+        'rank': np.tile(np.arange(1, n_terms + 1), len(components)),
+        'term': state['vocabulary'][top].ravel(),
+        'weight': np.take_along_axis(components, top, axis=1).ravel().round(5),
+    })
+
+
+def write_outputs(state, base_dir="data"):
+    """
+    Write the topic weights of every fitted story, the country distributions and the top terms.
+    """
+    counts, stories, lemmas, _ = load_lemma_counts(base_dir, state['countries'])
+    weights = state['model'].transform(tfidf(to_vocabulary(counts, lemmas, state['vocabulary']), state['idf']))
+    totals = weights.sum(axis=1, keepdims=True)
+    weights = weights / np.where(totals > 0, totals, 1)
+
+    columns = [f"topic_{i}" for i in range(weights.shape[1])]
+    story_topics = pd.concat([stories, pd.DataFrame(weights.round(5), columns=columns)], axis=1)
+    country_topics = story_topics.groupby('country')[columns].mean().round(5)
+
+    story_topics.to_csv(os.path.join(TOPICS_DIR, "story_topics.csv"), index=False)
+    country_topics.to_csv(os.path.join(TOPICS_DIR, "country_topics.csv"))
+    topic_terms(state).to_csv(os.path.join(TOPICS_DIR, "topic_terms.csv"), index=False)
+    print(f"Topic weights of {len(story_topics)} stories, {len(country_topics)} country distributions "
+          f"and the top terms saved to {TOPICS_DIR}")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+@click.option('--topics', 'n_topics', type=int, default=20, show_default=True)
+@click.option('--min-df', type=int, default=5, show_default=True, help='Ignore lemmas used in fewer stories than this')
+@click.option('--max-df', type=float, default=0.9, show_default=True, help='Ignore lemmas used in more than this share of the stories')
+@click.option('--seed', type=int, default=0, show_default=True)
+def fit(base_dir, n_topics, min_df, max_df, seed):
+    """Fit the topic model on all countries."""
+    fit_topics(base_dir, n_topics, min_df, max_df, seed=seed)
+
+
+@cli.command()
+@click.option('--data-dir', 'base_dir', default="data", show_default=True, help='Directory with one folder per country')
+@click.option('--passes', type=int, default=1, show_default=True, help='Times to go over the new stories')
+def update(base_dir, passes):
+    """Add new countries to the topic model with partial_fit."""
+    update_topics(base_dir, passes)
+
+
+@cli.command()
+@click.option('-n', 'n_terms', default=10, show_default=True, help='Terms per topic')
+@click.option('-c', '--country', default=None, help='Also show the topic distribution of this country')
+def show(n_terms, country):
+    """Show the top terms of each topic."""
+    state = load_model()
+    terms = topic_terms(state, n_terms)
+    for topic, group in terms.groupby('topic'):
+        print(f"{topic:>3}: {' '.join(group['term'])}")
+    if country:
+        country_topics = pd.read_csv(os.path.join(TOPICS_DIR, "country_topics.csv"), index_col='country', keep_default_na=False)
+        print(f"\nTopics of {country}:")
+        print(country_topics.loc[country].sort_values(ascending=False).head(5).to_string())
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,90 +1,119 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-import seaborn as sns
-from adjustText import adjust_text  # Prevent overlapping labels
+from countries import short_names
 
-#note: requires installing adjustText package
+#note: the boxplot requires installing adjustText package (to prevent overlapping labels)
 #pip install adjustText
 
-def make_boxplot():
-    df = pd.read_csv("analysis/data/all_countries_sentiments.csv")
+SENTIMENT_ORDER = ['anger', 'fear', 'joy', 'love', 'sadness', 'surprise']
+
+# Define fixed colours for each sentiment
+SENTIMENT_COLOURS = {
+    "sadness": "blue",
+    "love": "red",
+    "anger": "brown",
+    "joy": "lightgreen",
+    "surprise": "pink",
+    "fear": "orange"
+}
+
+
+def finish_figure(fig, output_path=None, show=True):
+    """
+    Save a figure to output_path (if given), show it if show is True, and close it otherwise.
+    """
+    if output_path:
+        fig.savefig(output_path, dpi=300, bbox_inches="tight")
+    if show:
+        plt.show()  # Show the plot for interactive environments
+    else:
+        plt.close(fig)
+
+
+def make_boxplot(df=None, output_path=None, show=True):
+    """
+    Boxplot of the number of stories per sentiment in each country, labelling the most extreme countries.
+
+    Parameters:
+    - df (DataFrame, optional): The per-story sentiments, read from all_countries_sentiments.csv if not given.
+    - output_path (str, optional): Where to save the figure.
+    - show (bool): Show the figure in a window, or close it after saving.
+    """
+    if df is None:
+        df = pd.read_csv("analysis/data/all_countries_sentiments.csv")
 
     # Calculate sentiment counts
     sentiment_counts = calculate_sentiment_counts(df)
+    fig = plot_sentiment_boxplot(sentiment_counts)
+    finish_figure(fig, output_path, show)
 
-    # Convert the sentiment counts to a DataFrame suitable for boxplot
-    sentiment_counts = sentiment_counts.stack().reset_index()
-    sentiment_counts.columns = ['group_by', 'sentiment', 'count']
 
-    # Ensure sentiment order is preserved
-    sentiment_order = ['anger', 'fear', 'joy', 'love', 'sadness', 'surprise']
-    sentiment_counts['sentiment'] = pd.Categorical(sentiment_counts['sentiment'], categories=sentiment_order, ordered=True)
+def plot_sentiment_boxplot(sentiment_counts):
+    """
+    Boxplot of sentiment counts per group (a table of groups x sentiments, as made by calculate_sentiment_counts).
 
-    # Assign numerical codes AFTER sorting
-    sentiment_counts = sentiment_counts.sort_values('sentiment')
-    sentiment_counts['sentiment_code'] = sentiment_counts['sentiment'].cat.codes
+    Returns:
+    - The matplotlib Figure.
+    """
+    from adjustText import adjust_text  # Prevent overlapping labels
+
+    # Ensure sentiment order is preserved
+    sentiment_counts = sentiment_counts.reindex(columns=SENTIMENT_ORDER, fill_value=0)
 
     # Create a figure and axis
     fig, ax = plt.subplots(figsize=(12, 6))
 
-    # Boxplot with aligned labels
-    sentiment_counts.boxplot(column='count', by='sentiment_code', grid=False, patch_artist=True, ax=ax,
-                             flierprops=dict(marker='o', markersize=8, markerfacecolor='red', markeredgecolor='black'))
+    # One box per sentiment, at x positions 1..6
+    box_positions = np.arange(1, len(SENTIMENT_ORDER) + 1)
+    boxes = ax.boxplot([sentiment_counts[sentiment] for sentiment in SENTIMENT_ORDER], positions=box_positions,
+                       patch_artist=True,
+                       flierprops=dict(marker='o', markersize=8, markerfacecolor='red', markeredgecolor='black'))
 
     # Set colors for the boxes
     colors = ['#A6CEE3', '#1F78B4', '#B2DF8A', '#33A02C', '#FB9A99', '#E31A1C']
-    for box, color in zip(ax.patches[:len(colors)], colors):  # Ensure coloring works
+    for box, color in zip(boxes['boxes'], colors):
         box.set_facecolor(color)
         box.set_alpha(0.6)  # Semi-transparent fill
 
     ax.set_title("Sentiment Counts by Sentiment", fontsize=14)
     ax.set_ylabel("Count", fontsize=12)
     ax.set_xlabel("Sentiment", fontsize=12)
+    ax.set_xticks(box_positions)
+    ax.set_xticklabels(SENTIMENT_ORDER, rotation=30, ha="right")
 
-    # **Ensure x-axis labels align correctly**
-    box_positions = ax.get_xticks()  # Get actual tick positions
-    ax.set_xticks(box_positions)  # Ensure proper positioning
-    ax.set_xticklabels(sentiment_order, rotation=30, ha="right")  # Apply correct sentiment labels
-
-    # **Fix outlier label placement using actual tick positions**
-    texts = []
-    for i, sentiment in enumerate(sentiment_order):
-        sentiment_data = sentiment_counts[sentiment_counts['sentiment'] == sentiment]
-        outlier_threshold = sentiment_data['count'].quantile(0.99)  # Select only extreme outliers
-        outliers = sentiment_data[sentiment_data['count'] > outlier_threshold]
-        
-        for _, row in outliers.iterrows():
-            text = ax.text(box_positions[i], row['count'], row['group_by'], fontsize=9, ha='center', va='bottom', color='black')
-            texts.append(text)
+    # Label the extreme outliers (above the 99th percentile of their sentiment) with their group
+    long_counts = sentiment_counts.melt(ignore_index=False, var_name='sentiment', value_name='count').reset_index(names='group_by')
+    thresholds = long_counts.groupby('sentiment')['count'].transform('quantile', 0.99)
+    outliers = long_counts[long_counts['count'] > thresholds]
+    x = box_positions[pd.Categorical(outliers['sentiment'], categories=SENTIMENT_ORDER).codes]
+    texts = [ax.text(position, count, group, fontsize=9, ha='center', va='bottom', color='black')
+             for position, count, group in zip(x, outliers['count'], outliers['group_by'])]
 
     # Adjust text to prevent overlap
-    adjust_text(texts, arrowprops=dict(arrowstyle="-", color='gray', alpha=0.5))
-
-    plt.show()
-
-
-
+    if texts:
+        adjust_text(texts, ax=ax, arrowprops=dict(arrowstyle="-", color='gray', alpha=0.5))
+    return fig
 
 
-
-
-
-def make_scatterplot():
+def make_scatterplot(df=None, output_path=None, show=True):
     
-    df = pd.read_csv("analysis/data/all_countries_sentiments.csv")
+    if df is None:
+        df = pd.read_csv("analysis/data/all_countries_sentiments.csv")
 
     # Create a scatter plot of the sentiment confidence scores
-    df.plot.scatter(x='sentiment', y='confidence')
-    plt.title("Sentiment by Confidence")
-    plt.ylabel("Confidence")
-    plt.xlabel("Sentiment")
+    fig, ax = plt.subplots()
+    df.plot.scatter(x='sentiment', y='confidence', ax=ax)
+    ax.set_title("Sentiment by Confidence")
+    ax.set_ylabel("Confidence")
+    ax.set_xlabel("Sentiment")
 
     # Add labels for outliers
-    for i, row in df.iterrows():
-        if row['confidence'] > df['confidence'].quantile(0.95):  # Adjust the threshold as needed
-            plt.text(row['sentiment'], row['confidence'], row['country_name'], fontsize=8, ha='right')
+    outliers = df[df['confidence'] > df['confidence'].quantile(0.95)]  # Adjust the threshold as needed
+    for sentiment, confidence, country_name in zip(outliers['sentiment'], outliers['confidence'], outliers['country_name']):
+        ax.text(sentiment, confidence, country_name, fontsize=8, ha='right')
 
-    plt.show()
+    finish_figure(fig, output_path, show)
 
 
 
@@ -111,18 +140,8 @@ def calculate_sentiment_counts(df, group_by="country_name", region=None, sub_reg
     if country_list:
         df = df[df["country_name"].isin(country_list)]
 
-    #rename country_names United States of America (the) to USA, Korea (the Republic of) to South Korea, Korea (the Democratic People's Republic of) to North Korea, United Kingdom of Great Britain and Northern Ireland (the) to United Kingdom, Bolivia (Plurinational State of) to Bolivia
-    df['country_name'] = df['country_name'].replace({
-        "United States of America (the)": "USA",
-        "Korea (the Republic of)": "South Korea",
-        "Korea (the Democratic People's Republic of)": "North Korea",
-        "United Kingdom of Great Britain and Northern Ireland (the)": "United Kingdom",
-        "Bolivia (Plurinational State of)": "Bolivia",
-        "Taiwan (Province of China)": "Taiwan",
-        "Russian Federation (the)": "Russia",
-        "Iran (Islamic Republic of)": "Iran",
-        "Venezuela (Bolivarian Republic of)": "Venezuela",
-    })
+    # Use the short country names, e.g. USA instead of United States of America (the)
+    df = df.assign(country_name=short_names(df['country_name']))
 
     # Aggregate sentiment counts by the chosen group level
     return df.groupby([group_by, "sentiment"]).size().unstack(fill_value=0)
@@ -133,7 +152,9 @@ def make_proportional_stacked_barchart(df,
                                        region=None, 
                                        sub_region=None, 
                                        country_list=None,
-                                       filename="unnamed"):
+                                       filename="unnamed",
+                                       output_path=None,
+                                       show=True):
     """
     Creates a proportional stacked bar chart of sentiment distribution.
     
@@ -143,73 +164,62 @@ def make_proportional_stacked_barchart(df,
     - region (str, optional): If specified, filters data to this specific region.
     - sub_region (str, optional): If specified, filters data to this specific sub-region.
     - country_list (list, optional): If specified, filters data to these specific countries.
+    - filename (str): Saved as analysis/figures/sentiments_<filename>.png, unless output_path is given.
+    - output_path (str, optional): Where to save the chart.
+    - show (bool): Show the chart in a window, or close it after saving.
     
     Returns:
     - A stacked bar chart showing proportional sentiment distribution.
     """
 
-    # Filter by region if specified
+    # Calculate sentiment counts based on grouping level and filters
+    sentiment_counts = calculate_sentiment_counts(df, group_by=group_by, region=region, sub_region=sub_region,
+                                                  country_list=country_list)
+
+    # Title and labels
+    title = "Proportional Sentiment Distribution"
     if region:
-        df = df[df["region"] == region]
-    
-    # Filter by sub-region if specified
+        title += f" in {region}"
     if sub_region:
-        df = df[df["sub-region"] == sub_region]
-    
-    # Filter by country list if specified
+        title += f" in {sub_region}"
     if country_list:
-        df = df[df["country_name"].isin(country_list)]
+        title += f" for Selected Countries"
 
-    # Calculate sentiment counts based on grouping level
-    sentiment_counts = calculate_sentiment_counts(df, group_by=group_by)
-
-    # Define fixed colours for each sentiment
-    sentiment_colours = {
-        "sadness": "blue",
-        "love": "red",
-        "anger": "brown",
-        "joy": "lightgreen",
-        "surprise": "pink",
-        "fear": "orange"
-    }
-    
+    fig = plot_sentiment_proportions(sentiment_counts, title, xlabel=group_by.replace("_", " ").title())
+
+    # Save the plot
+    finish_figure(fig, output_path or f"analysis/figures/sentiments_{filename}.png", show)
+
+
+def plot_sentiment_proportions(sentiment_counts, title="Proportional Sentiment Distribution", xlabel="Country Name"):
+    """
+    Proportional stacked bar chart of a table of sentiment counts (groups x sentiments).
+
+    Returns:
+    - The matplotlib Figure.
+    """
     # Convert to proportions
     sentiment_proportions = sentiment_counts.div(sentiment_counts.sum(axis=1), axis=0)
 
     # Ensure the colours are applied in the correct order
-    available_sentiments = sentiment_proportions.columns.tolist()
-    colours = [sentiment_colours[sent] for sent in available_sentiments if sent in sentiment_colours]
+    available_sentiments = [sent for sent in sentiment_proportions.columns if sent in SENTIMENT_COLOURS]
+    sentiment_proportions = sentiment_proportions[available_sentiments]
+    colours = [SENTIMENT_COLOURS[sent] for sent in available_sentiments]
 
     # Plot
-    plt.figure(figsize=(14, 7))
+    fig, ax = plt.subplots(figsize=(14, 7))
     sentiment_proportions.plot(kind="bar", 
                                stacked=True, 
-                               figsize=(14, 7),
+                               ax=ax,
                                color=colours)
 
-    # Title and labels
-    title = "Proportional Sentiment Distribution"
-    if region:
-        title += f" in {region}"
-    if sub_region:
-        title += f" in {sub_region}"
-    if country_list:
-        title += f" for Selected Countries"
-    
-    plt.title(title)
-    plt.ylabel("Proportion of Sentiments")
-    plt.xlabel(group_by.replace("_", " ").title())
-    plt.xticks(rotation=45, ha="right")  # Ensure country names are readable
-    plt.legend(title="Sentiment", bbox_to_anchor=(1, 1), loc='upper left')
-    plt.tight_layout()  # Adjust layout to fit labels
-    plt.show()
-
-        # Save the plot
-
-    output_path=(f"analysis/figures/sentiments_{filenmae}.png")
-
-    plt.savefig(output_path, dpi=300, bbox_inches="tight")
-    plt.show()  # Show the plot for interactive environments
+    ax.set_title(title)
+    ax.set_ylabel("Proportion of Sentiments")
+    ax.set_xlabel(xlabel)
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")  # Ensure country names are readable
+    ax.legend(title="Sentiment", bbox_to_anchor=(1, 1), loc='upper left')
+    fig.tight_layout()  # Adjust layout to fit labels
+    return fig
 
 # def make_boxplot(df):
 
@@ -1,86 +1,58 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from wordcloud import WordCloud
+from countries import add_country_data
 
 # Jill's still messy code for exploring the unique words dataset by adding more variables like population, region etc
 # This is a work in progress and will be cleaned up later
 
-import os
-print(os.getcwd())
+UNIQUE_WORDS_FILE = 'most_unique_words_per_country.csv'
+EXPANDED_FILE = 'data/analysed_data/unique_words_by_country_expanded.csv'
 
-# Load the data
-data = pd.read_csv('most_unique_words_per_country.csv')
 
-# Set pandas to display all rows (useful for testing)
-pd.set_option('display.max_rows', None)
+def load_unique_words(csv_path=UNIQUE_WORDS_FILE):
+    """
+    Load the unique words per country and add the country names, regions and population.
+    """
+    # Load the data
+    data = pd.read_csv(csv_path, keep_default_na=False, na_values=[""])
 
-data['diff'] = data['frequency'] - data['uniqueness_score']
-data['proportion_of_global'] = data['uniqueness_score'] / data['frequency']
-#filtered_data = data[data['diff'] > 0]
-#sorted_data = filtered_data.sort_values(by='unique_prop', ascending=False)
-#print(sorted_data)
+    data['diff'] = data['frequency'] - data['uniqueness_score']
+    data['proportion_of_global'] = data['uniqueness_score'] / data['frequency']
+    #filtered_data = data[data['diff'] > 0]
+    #sorted_data = filtered_data.sort_values(by='unique_prop', ascending=False)
+    #print(sorted_data)
 
-# Fetch country names and alpha-3 codes from the country code dataset and merge with the data
-country_code_dataset_URL = 'https://raw.githubusercontent.com/lukes/ISO-3166-Countries-with-Regional-Codes/refs/heads/master/all/all.csv'
-codes = pd.read_csv(country_code_dataset_URL, usecols=['alpha-2', 'name', 'alpha-3', 'region', 'sub-region'])
-data = pd.merge(data, codes, left_on='Country', right_on='alpha-2', how='left')
+    # Add the country names, alpha-3 codes, regions and population (2023, from the World Bank) from the country table
+    data = add_country_data(data, 'Country', ['short_name', 'alpha-3', 'region', 'sub-region', 'population'])
+    data.rename(columns={'short_name': 'name'}, inplace=True)
 
-# Fetch population numbers from the World Bank dataset and merge into the data
-population = pd.read_csv(
-    'support_data/World_Bank_population_numbers.csv', 
-    usecols=['Country Code', '2023'], 
-    skiprows=4
-    )
+    # Ensure population and frequency contain only finite values
+    data = data.replace([float('inf'), float('-inf')], pd.NA)  # Convert infinite values to NaN
+    data = data.dropna(subset=['population', 'frequency'])  # Remove NaN values
 
-# Set pandas to display floats in standard notation
-pd.options.display.float_format = '{:,.0f}'.format
+    # All the countries where word frequency is greater than 1000 have stop words 
+    # in the local language as most unique word, so filter them out.
 
-data = pd.merge(
-    data, 
-    population, 
-    left_on='alpha-3', 
-    right_on='Country Code', 
-    how='left')
+    # Assign each region a unique color
+    region_colors = {region: idx for idx, region in enumerate(data['region'].unique())}
+    data['region_color'] = data['region'].map(region_colors)
+    return data
 
-data.rename(columns={'2023': 'population'}, inplace=True)
-
-# Ensure population and frequency contain only finite values
-data = data.replace([float('inf'), float('-inf')], pd.NA)  # Convert infinite values to NaN
-data = data.dropna(subset=['population', 'frequency'])  # Remove NaN values
-
-# All the countries where word frequency is greater than 1000 have stop words 
-# in the local language as most unique word, so filter them out.
-
-
-# Assign each region a unique color
-region_colors = {region: idx for idx, region in enumerate(data['region'].unique())}
-data['region_color'] = data['region'].map(region_colors)
-
-
-print(data.head())
-print(data.columns)
-
-# Save the data to a CSV file
-data.to_csv('data/analysed_data/unique_words_by_country_expanded.csv', index=False)
-
-# Display the merged data
-print("Data loaded, will now visualise the data")
-
-# -------------------Testing  Visualisations ------------------- 
 
 # ----- Wordclouds by region sized by inverse of proportion -----
 
-# Define the regions
-regions = data['region'].unique()
+def region_wordcloud(subset, region):
+    """
+    Word cloud of the unique words of a region's countries, sized by the inverse of their proportion of global use.
+
+    Returns:
+    - The matplotlib Figure.
+    """
+    from wordcloud import WordCloud
 
-# Loop through each region to create a word cloud
-for region in regions:
-    # Filter data for the region
-    subset = data[data['region'] == region]
-    
     # Create a dictionary of words and their inverse proportions
-    word_weights = {row['word']: 1 / row['proportion_of_global'] for _, row in subset.iterrows()}
+    word_weights = dict(zip(subset['word'], 1 / subset['proportion_of_global']))
     # (using inverse because otherwise the words that are ONLY
     # used in that country are biggest, and those words are usually
     # stop words or place names that we should really weed out of dataset)=
@@ -89,15 +61,52 @@ for region in regions:
     wordcloud = WordCloud(width=800, height=400, background_color="white").generate_from_frequencies(word_weights)
     
     # Plot the word cloud
-    plt.figure(figsize=(10, 5))
+    fig = plt.figure(figsize=(10, 5))
     plt.imshow(wordcloud, interpolation="bilinear")
     plt.axis("off")
     plt.title(f"Most unique words for {region}", fontsize=24)
     plt.suptitle("Bigger words are used in more different countries", fontsize=10)
-    
-    #save the wordclouds
-    plt.savefig(f'images/wordcloud_inverse_uniqueness_{region}.png')
+    return fig
+
+
+def population_scatterplot(data):
+    """
+    Scatter plot of population against the proportion of global use of each country's most unique word.
+
+    Returns:
+    - The matplotlib Figure.
+    """
+    region_colors = {region: idx for idx, region in enumerate(data['region'].unique())}
 
+    # Create a scatter plot
+    fig = plt.figure(figsize=(10, 6))
+    plt.scatter(
+        data['population'], 
+        data['proportion_of_global'], 
+        c=data['region_color'],  # Use region-based colors
+        cmap='tab10',  # Choose a colormap (tab10 has distinct colors)
+        alpha=0.7, 
+        edgecolors='k')
+
+    # Add a legend for the regions
+    handles = [plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=plt.cm.tab10(region_colors[r] / 10), markersize=10)
+               for r in region_colors]
+    plt.legend(handles, region_colors.keys(), title="Regions", bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    # Add labels for each point
+    labels = data['name'] + " (" + data['word'] + ")"
+    for population, proportion, label in zip(data['population'], data['proportion_of_global'], labels):
+        plt.text(population, proportion, label, fontsize=8, ha='right', va='bottom', alpha=0.7)
+
+    # **Set logarithmic scale for population axis**
+    plt.xscale('log')  
+
+    # Add labels and title
+    plt.title('No correlation population size - words unique to country (Log Scale)', fontsize=14)
+    plt.xlabel('Population (2023) - Log Scale', fontsize=12)
+    plt.ylabel('Higher means word not used by other countries', fontsize=12)
+    #plt.grid(True, linestyle='--', alpha=0.6, which='both')  # Apply grid to both major and minor ticks
+    return fig
 
 
 # ---- Use FacetGrid in Seaborn to create a grid of scatter plots ----
@@ -181,36 +190,25 @@ plt.show()
 exit() """
 
 
-# ------------------- Visualisation -------------------
+if __name__ == "__main__":
+    # Set pandas to display all rows (useful for testing)
+    pd.set_option('display.max_rows', None)
+    # Set pandas to display floats in standard notation
+    pd.options.display.float_format = '{:,.0f}'.format
 
+    data = load_unique_words()
+    print(data.head())
+    print(data.columns)
 
-# Create a scatter plot
-plt.figure(figsize=(10, 6))
-plt.scatter(
-    data['population'], 
-    data['proportion_of_global'], 
-    c=data['region_color'],  # Use region-based colors
-    cmap='tab10',  # Choose a colormap (tab10 has distinct colors)
-    alpha=0.7, 
-    edgecolors='k')
-
-# Add a legend for the regions
-handles = [plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=plt.cm.tab10(region_colors[r] / 10), markersize=10)
-           for r in region_colors]
-plt.legend(handles, region_colors.keys(), title="Regions", bbox_to_anchor=(1.05, 1), loc='upper left')
-
-# Add labels for each point
-for i, row in data.iterrows():
-    label = f"{row['name']} ({row['word']})"
-    plt.text(row['population'], row['proportion_of_global'], label, fontsize=8, ha='right', va='bottom', alpha=0.7)
+    # Save the data to a CSV file
+    data.to_csv(EXPANDED_FILE, index=False)
 
-# **Set logarithmic scale for population axis**
-plt.xscale('log')  
+    # Display the merged data
+    print("Data loaded, will now visualise the data")
 
-# Add labels and title
-plt.title('No correlation population size - words unique to country (Log Scale)', fontsize=14)
-plt.xlabel('Population (2023) - Log Scale', fontsize=12)
-plt.ylabel('Higher means word not used by other countries', fontsize=12)
-#plt.grid(True, linestyle='--', alpha=0.6, which='both')  # Apply grid to both major and minor ticks
+    # Loop through each region to create a word cloud, and save the wordclouds
+    for region in data['region'].unique():
+        region_wordcloud(data[data['region'] == region], region).savefig(f'images/wordcloud_inverse_uniqueness_{region}.png')
+        plt.close()
 
-plt.savefig('images/scatterplot_uniqueness_population.png')
+    population_scatterplot(data).savefig('images/scatterplot_uniqueness_population.png')
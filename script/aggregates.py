@@ -0,0 +1,363 @@
+"""
+Corpus aggregates for quick questions across countries, e.g. "how often does 'fjord' appear in
+Nordic stories compared to the others" (`story_cli.py stats`).
+
+`build` reads the per-country outputs of the analysis stages once and saves them as a few long
+tables in <data dir>/.stats/:
+
+- countries.parquet: stories and words per country, with its name, region and sub-region
+- words.parquet: count of each lemma per country (<CC>_word_freq.csv)
+- nouns.parquet: count of each noun phrase per country (<CC>_noun_phrases.csv)
+- names.parquet: count of each main character name per country (<CC>_names.csv, cleaned as in analysis/script/names.py)
+- sentiments.parquet: stories and mean confidence per (country, top emotion) (<CC>_sentiments.csv)
+- titles.parquet: the title of each story, when it has one
+
+The tables are loaded into memory once (Aggregates.load), with the country and item columns as
+categoricals, so a query is a filter and a group-by over a few million rows at most and takes
+milliseconds. The countries are grouped by 'country', 'country_name', 'region', 'sub-region' or
+'all'. query_server.py serves the same queries over HTTP.
+"""
+
+import os
+import sys
+import glob
+import time
+import functools
+import pandas as pd
+import paths
+
+# The country table and the title extraction live with the analysis scripts
+ANALYSIS_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis", "script")
+
+GROUPS = ['country', 'country_name', 'region', 'sub-region', 'all']
+
+# Kind of item -> the per-country file it is read from and its item and count columns
+ITEM_FILES = {
+    'words': ("word_freq", 'Word', 'Frequency'),
+    'nouns': ("noun_phrases", 'Noun Phrase', 'Count'),
+    'names': ("names", 'Name', 'Count'),
+}
+KINDS = list(ITEM_FILES) + ['titles']
+
+
+def stats_dir():
+    """
+    Directory of the aggregates, hidden among the countries: ../data/.stats
+    """
+    return os.path.join(paths.DATA_DIR, ".stats")
+
+
+def source_files():
+    """
+    The per-country files the aggregates are built from.
+    """
+    kinds = ["stories", "sentiments"] + [kind for kind, _, _ in ITEM_FILES.values()]
+    return [path for kind in kinds for path in glob.glob(paths.country_file("*", kind))]
+
+
+def read_items(kind):
+    """
+    One of ITEM_FILES for every country as a long table of (country, item, count).
+    """
+    file_kind, item_column, count_column = ITEM_FILES[kind]
+    frames = []
+    for country in paths.list_country_dirs():
+        filepath = paths.country_file(country, file_kind)
+        if os.path.exists(filepath):
+            # keep_default_na so words like "nan" and "null" stay words
+            data = pd.read_csv(filepath, keep_default_na=False, dtype={item_column: str})
+            frames.append(pd.DataFrame({'country': country, 'item': data[item_column],
+                                        'count': pd.to_numeric(data[count_column], errors='coerce').fillna(0).astype('int32')}))
+    if not frames:
+        return pd.DataFrame({'country': pd.Series(dtype=str), 'item': pd.Series(dtype=str), 'count': pd.Series(dtype='int32')})
+    items = pd.concat(frames, ignore_index=True)
+    if kind == 'names':
+        items = clean_names(items)
+    items = items.groupby(['country', 'item'], as_index=False, observed=True)['count'].sum()
+    # Most common first in each country, the order of Aggregates.top(by='country')
+    return items.sort_values(['country', 'count', 'item'], ascending=[True, False, True], ignore_index=True)
+
+
+def clean_names(items):
+    """
+    Clean the names the way analysis/script/names.py does: whitespace collapsed, the replies that
+    mean no name and single letters (the remains of split names) left out, and each name in its
+    most common spelling ("Elena" rather than "ELENA").
+    """
+    sys.path.insert(0, ANALYSIS_SCRIPTS)
+    from names import normalize_names, NO_NAME
+
+    cleaned, keys = normalize_names(items['item'])
+    keep = (keys.str.len() > 1) & ~keys.isin(NO_NAME)
+    items, cleaned, keys = items[keep], cleaned[keep], keys[keep]
+    spellings = pd.DataFrame({'key': keys, 'name': cleaned, 'count': items['count']})
+    spellings = spellings.groupby(['key', 'name'], as_index=False)['count'].sum()
+    spellings = spellings.sort_values(['key', 'count'], ascending=[True, False]).drop_duplicates('key')
+    return items.assign(item=keys.map(spellings.set_index('key')['name']))
+
+
+def build(directory=None):
+    """
+    Build the aggregates from the data directory and save them to directory (default: stats_dir()).
+
+    Returns
+    -------
+    Aggregates
+    """
+    sys.path.insert(0, ANALYSIS_SCRIPTS)
+    from countries import add_country_data
+    from title_index import extract_titles
+
+    directory = directory or stats_dir()
+    stories, sentiments = [], []
+    for country in paths.list_country_dirs():
+        stories_file = paths.country_file(country, "stories")
+        if os.path.exists(stories_file):
+            data = pd.read_csv(stories_file, usecols=['Story_ID', 'Story'], keep_default_na=False)
+            data['country'] = country
+            stories.append(data)
+        sentiments_file = paths.country_file(country, "sentiments")
+        if os.path.exists(sentiments_file):
+            data = pd.read_csv(sentiments_file, usecols=['story_id', 'sentiment', 'confidence'])
+            data['country'] = country
+            sentiments.append(data)
+    if not stories:
+        raise FileNotFoundError(f"No <CC>_stories.csv files in {paths.DATA_DIR}")
+    stories = pd.concat(stories, ignore_index=True)
+
+    countries = stories.groupby('country').agg(stories=('Story_ID', 'size'),
+                                               words=('Story', lambda texts: texts.str.split().str.len().sum())).reset_index()
+    countries = add_country_data(countries, 'country', ['country_name', 'region', 'sub-region'])
+    countries[['region', 'sub-region']] = countries[['region', 'sub-region']].fillna("Unknown")
+
+    titles = extract_titles(stories['Story'])
+    titles = pd.DataFrame({'country': stories['country'], 'story_id': stories['Story_ID'], 'item': titles['title']}).dropna()
+
+    if sentiments:
+        sentiments = pd.concat(sentiments, ignore_index=True)
+        sentiments = sentiments.groupby(['country', 'sentiment'], as_index=False).agg(
+            stories=('story_id', 'size'), confidence=('confidence', 'mean'))
+    else:
+        sentiments = pd.DataFrame(columns=['country', 'sentiment', 'stories', 'confidence'])
+
+    tables = {'countries': countries, 'titles': titles, 'sentiments': sentiments,
+              **{kind: read_items(kind) for kind in ITEM_FILES}}
+    os.makedirs(directory, exist_ok=True)
+    for name, table in tables.items():
+        table.to_parquet(os.path.join(directory, f"{name}.parquet"), index=False)
+    return Aggregates(tables, directory)
+
+
+class Aggregates:
+    """
+    The aggregate tables in memory, and the queries on them.
+
+    Parameters
+    ----------
+    tables : dict of pandas.DataFrame
+        The tables written by build(), by name.
+    directory : str, optional
+        Where the tables were loaded from.
+    """
+
+    def __init__(self, tables, directory=None):
+        self.directory = directory
+        # The group totals are the slow part of top(), and a session asks for the same groups again
+        self.group_counts = functools.lru_cache(maxsize=32)(self._group_counts)
+        self.item_totals = functools.lru_cache(maxsize=len(KINDS))(self._item_totals)
+        self.countries = tables['countries'].set_index('country')
+        self.sentiments = tables['sentiments']
+        self.items = {kind: tables[kind] for kind in KINDS}
+        # Categoricals make the filters and group-bys fast and the tables small
+        for table in [self.sentiments, *self.items.values()]:
+            for column in ('country', 'item', 'sentiment'):
+                if column in table:
+                    table[column] = table[column].astype('category')
+
+    @classmethod
+    def load(cls, directory=None):
+        """
+        Read the aggregates, building them first if they are not there yet.
+        """
+        directory = directory or stats_dir()
+        if not os.path.exists(os.path.join(directory, "countries.parquet")):
+            print(f"Building the aggregates in {directory}...", file=sys.stderr)
+            return build(directory)
+        names = ['countries', 'sentiments', *KINDS]
+        return cls({name: pd.read_parquet(os.path.join(directory, f"{name}.parquet")) for name in names}, directory)
+
+    def is_stale(self):
+        """
+        Whether a per-country file changed after the aggregates were built.
+        """
+        built = os.path.getmtime(os.path.join(self.directory, "countries.parquet"))
+        return any(os.path.getmtime(path) > built for path in source_files())
+
+    def select_countries(self, where=None):
+        """
+        The countries matching every filter, e.g. {'region': ['Europe'], 'country': ['NO', 'SE']}.
+        The filter columns are country, country_name, region and sub-region.
+
+        Raises
+        ------
+        ValueError
+            If a filter column is not one of these.
+        """
+        countries = self.countries
+        for column, values in (where or {}).items():
+            if column == 'country':
+                countries = countries[countries.index.isin(values)]
+            elif column in countries.columns and column not in ('stories', 'words'):
+                countries = countries[countries[column].isin(values)]
+            else:
+                raise ValueError(f"Unknown filter column '{column}', use country, country_name, region or sub-region")
+        return countries
+
+    def group_of(self, countries, by):
+        """
+        The group of each country (a Series indexed by country code).
+        """
+        if by not in GROUPS:
+            raise ValueError(f"Unknown group '{by}', use one of {', '.join(GROUPS)}")
+        if by == 'all':
+            return pd.Series("all", index=countries.index)
+        if by == 'country':
+            return pd.Series(countries.index, index=countries.index)
+        return countries[by]
+
+    def items_of(self, kind):
+        """
+        The table of a kind of item: words, nouns, names or titles.
+        """
+        if kind not in self.items:
+            raise ValueError(f"Unknown kind '{kind}', use one of {', '.join(KINDS)}")
+        return self.items[kind]
+
+    def word_rates(self, words, by='region', where=None, kind='words'):
+        """
+        How often each word occurs in each group: its count, its rate per 1,000 words of the
+        group's stories, and the ratio of that rate to the rate in the other selected countries.
+
+        Returns
+        -------
+        pandas.DataFrame
+            by, 'item', 'count', 'words', 'per_1000' and 'ratio_to_rest', highest rate first.
+        """
+        countries = self.select_countries(where)
+        groups = self.group_of(countries, by)
+        totals = countries['words'].groupby(groups).sum()
+        items = self.items_of(kind)
+        if 'count' not in items:
+            raise ValueError(f"No word rates of {kind}, use words, nouns or names")
+        items = items[items['item'].isin([w.lower() if kind == 'words' else w for w in words])
+                      & items['country'].isin(countries.index)]
+
+        counts = items.groupby([items['country'].map(groups).astype(str).rename(by), items['item'].astype(str)],
+                               observed=True)['count'].sum()
+        # Every (group, word), also those where the word does not occur
+        index = pd.MultiIndex.from_product([totals.index, sorted(set(items['item'].astype(str)))], names=[by, 'item'])
+        table = counts.reindex(index, fill_value=0).rename('count').reset_index()
+        table['words'] = table[by].map(totals).to_numpy()
+        table['per_1000'] = table['count'] / table['words'] * 1000
+        word_totals = table.groupby('item')['count'].transform('sum')
+        rest_rate = (word_totals - table['count']) / (totals.sum() - table['words']) * 1000
+        table['ratio_to_rest'] = table['per_1000'] / rest_rate.where(rest_rate > 0)
+        return table.sort_values(['item', 'per_1000'], ascending=[True, False], ignore_index=True)
+
+    def _group_counts(self, kind, by, countries):
+        """
+        The counts of the items of a kind summed per group of the countries (a tuple of codes),
+        most common first in each group, with their share of the group's total.
+        """
+        items = self.items_of(kind)
+        groups = pd.Categorical(self.group_of(self.countries.loc[list(countries)], by).reindex(items['country'].cat.categories))
+        # Group by the integer codes of the categoricals rather than by the strings
+        frame = pd.DataFrame({'group': groups.codes[items['country'].cat.codes.to_numpy()],
+                              'item': items['item'].cat.codes.to_numpy(),
+                              'count': items['count'].to_numpy() if 'count' in items else 1})
+        frame = frame[frame['group'] >= 0]  # Countries not selected
+        if by == 'country' and 'count' in items:
+            # Already one row per (country, item), most common first
+            table = frame.reset_index(drop=True)
+        else:
+            table = frame.groupby(['group', 'item'], sort=False)['count'].sum().reset_index()
+            table = table.sort_values(['group', 'count', 'item'], ascending=[True, False, True], ignore_index=True)
+        table['share'] = table['count'] / table.groupby('group')['count'].transform('sum')
+        table.insert(0, by, groups.categories[table.pop('group')].astype(str))
+        table['item'] = items['item'].cat.categories[table['item']].astype(str)
+        return table
+
+    def top(self, kind, by='all', where=None, k=10):
+        """
+        The k most common items (words, nouns, names or titles) of each group, with their share
+        of all the group's items of that kind.
+        """
+        countries = tuple(self.select_countries(where).index)
+        table = self.group_counts(kind, by, countries)
+        return table.groupby(by, sort=False).head(k).reset_index(drop=True)[[by, 'item', 'count', 'share']]
+
+    def _item_totals(self, kind):
+        """
+        The count of each item of a kind in all countries, indexed by its category code.
+        """
+        items = self.items_of(kind)
+        return items['count'].groupby(items['item'].cat.codes.to_numpy()).sum()
+
+    def unique_items(self, kind='words', where=None, k=10, min_count=5):
+        """
+        The items most particular to each country: the share of an item's count in all countries that
+        is in this country, among the items it uses at least min_count times.
+
+        Returns
+        -------
+        pandas.DataFrame
+            'country', 'item', 'count', 'total' and 'share_of_global', most particular first.
+        """
+        countries = self.select_countries(where)
+        items = self.items_of(kind)
+        if 'count' not in items:
+            raise ValueError(f"No unique {kind}, use words, nouns or names")
+        items = items[items['country'].isin(countries.index) & (items['count'] >= min_count)]
+        # Sorted and cut on the category codes, and only the k rows per country kept turned into strings
+        table = pd.DataFrame({'country': items['country'].cat.codes.to_numpy(),
+                              'item': items['item'].cat.codes.to_numpy(),
+                              'count': items['count'].to_numpy()})
+        table['total'] = self.item_totals(kind).reindex(table['item']).to_numpy()
+        table['share_of_global'] = table['count'] / table['total']
+        table = table.sort_values(['country', 'share_of_global', 'count'], ascending=[True, False, False])
+        table = table.groupby('country', sort=False).head(k).reset_index(drop=True)
+        table['country'] = items['country'].cat.categories[table['country']].astype(str)
+        table['item'] = items['item'].cat.categories[table['item']].astype(str)
+        return table
+
+    def sentiment_counts(self, by='country_name', where=None):
+        """
+        The number of stories with each top emotion per group, one column per emotion, like
+        calculate_sentiment_counts in analysis/script/visualise_sentiments.py.
+        """
+        shares = self.sentiment_shares(by, where)
+        counts = shares.pivot(index=by, columns='sentiment', values='stories').fillna(0).astype(int)
+        return counts.rename_axis(columns=None).reset_index()
+
+    def sentiment_shares(self, by='region', where=None):
+        """
+        The share of stories whose top emotion is each sentiment, and its mean confidence, per group.
+        """
+        countries = self.select_countries(where)
+        groups = self.group_of(countries, by)
+        cube = self.sentiments[self.sentiments['country'].isin(countries.index)]
+        keys = [cube['country'].map(groups).astype(str).rename(by), cube['sentiment'].astype(str)]
+        table = cube.assign(weighted=cube['confidence'] * cube['stories']).groupby(keys, observed=True)[['stories', 'weighted']].sum()
+        table['confidence'] = table.pop('weighted') / table['stories']
+        table = table.reset_index()
+        table['share'] = table['stories'] / table.groupby(by)['stories'].transform('sum')
+        return table[[by, 'sentiment', 'stories', 'share', 'confidence']].sort_values([by, 'share'], ascending=[True, False], ignore_index=True)
+
+
+def timed(query, *args, **kwargs):
+    """
+    Run a query and return its result and how long it took in milliseconds.
+    """
+    start = time.perf_counter()
+    result = query(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
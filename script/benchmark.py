@@ -0,0 +1,400 @@
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import tempfile
+import contextlib
+import multiprocessing
+import platform
+from queue import Empty
+from importlib import metadata
+from datetime import datetime
+import click
+import pandas as pd
+import paths
+from synthetic_corpus import build_corpus
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# The combiners live with the other analysis scripts
+ANALYSIS_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis", "script")
+
+COUNTRY_CODES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "country_codes.csv")
+
+# Stage name -> which per-country file is its input. Tokens are whitespace separated words of that input.
+STAGES = {
+    'generate': 'stories',
+    'summary': 'stories',
+    'names': 'stories',
+    'words': 'stories',
+    'nouns': 'stories',
+    'sentiment': 'summaries',
+    'gather_word_freq': 'word_freq',
+    'gather_noun_phrases': 'noun_phrases',
+    'gather_names': 'names',
+    'gather_sentiments': 'sentiments',
+    'gather_sentiment_data': 'sentiments',
+}
+
+# Stages that call the OpenAI API. They are run against a local mock server, on a copy of the corpus.
+API_STAGES = ['generate', 'summary', 'names']
+
+# Commands whose start-up time is measured, up to the point where real work would begin
+STARTUP_COMMANDS = {
+    'startup --help': [sys.executable, "story_cli.py", "--help"],
+    'startup generate --help': [sys.executable, "story_cli.py", "generate", "--help"],
+    'startup import generate_stories': [sys.executable, "-c", "import story_cli, generate_stories"],
+}
+
+
+def run_stage(stage, corpus_dir, work_dir):
+    """
+    Run one pipeline stage over every country in corpus_dir.
+    """
+    paths.set_data_dir(corpus_dir)
+    countries = ('all',)
+
+    if stage == 'generate':
+        from generate_stories import main as generate_stories
+        codes = pd.read_csv(COUNTRY_CODES, keep_default_na=False).set_index('code')  # keep_default_na so Namibia (NA) is not read as missing
+        for country in paths.list_country_dirs():
+            num_stories = len(pd.read_csv(paths.country_file(country, "stories")))
+            demonym = codes.loc[country, 'Demonym 1'] if country in codes.index else country
+            country_name = codes.loc[country, 'name'] if country in codes.index else country
+            generate_stories(num_stories, demonym, country, country_name)
+    elif stage == 'summary':
+        from summary_gen import main as generate_summary
+        generate_summary(countries, "")
+    elif stage == 'names':
+        from name_extraction import main as extract_names
+        extract_names(countries, "")
+    elif stage == 'words':
+        from word_freq import main as word_freq
+        word_freq(countries, "")
+    elif stage == 'nouns':
+        from noun_phrases import main as extract_noun_phrases
+        extract_noun_phrases(countries, "")
+    elif stage == 'sentiment':
+        from sentiment_huggingface import main as sentiment
+        sentiment(countries, "")
+    elif stage == 'gather_sentiment_data':
+        sys.path.insert(0, ANALYSIS_SCRIPTS)
+        from gather_sentiments import gather_sentiment_data
+        gather_sentiment_data(corpus_dir, os.path.join(work_dir, "all_countries_sentiments.csv"))
+    elif stage.startswith('gather_'):
+        sys.path.insert(0, ANALYSIS_SCRIPTS)
+        from gather_data import create_df
+        create_df(corpus_dir, stage[len('gather_'):], output_dir=work_dir)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process in MB, or None where it cannot be measured.
+    """
+    # On Linux ru_maxrss is carried over from the parent across fork and exec, so a stage started
+    # by a large parent would report the parent's peak. VmHWM starts again at exec.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024  # In kB
+    except OSError:  # No /proc (macOS, Windows)
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _stage_worker(stage, corpus_dir, work_dir, queue):
+    """
+    Time a stage in a fresh process so the peak RSS belongs to that stage alone.
+    """
+    result = {'status': 'ok'}
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run_stage(stage, corpus_dir, work_dir)
+    except ImportError as e:
+        result['status'] = f"skipped: {e}"
+    except Exception as e:
+        result['status'] = f"error: {type(e).__name__}: {str(e).strip().splitlines()[0] if str(e).strip() else ''}"
+    result['wall_s'] = time.perf_counter() - wall_start
+    result['cpu_s'] = time.process_time() - cpu_start
+    result['peak_rss_mb'] = peak_rss_mb()
+    queue.put(result)
+
+
+def measure_stage(stage, corpus_dir, work_dir):
+    """
+    Run a stage in a child process and return its timings.
+
+    If the child dies without reporting (it crashed or was killed, e.g. for running out of
+    memory) the stage is recorded as failed rather than waited for forever.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_stage_worker, args=(stage, corpus_dir, work_dir, queue))
+    wall_start = time.perf_counter()
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if process.is_alive():
+                continue
+            try:
+                # The child may have put its result just before exiting
+                result = queue.get(timeout=1)
+            except Empty:
+                result = {
+                    'status': f"error: the stage process exited with code {process.exitcode} without a result",
+                    'wall_s': time.perf_counter() - wall_start,
+                    'cpu_s': None,
+                    'peak_rss_mb': None,
+                }
+    process.join()
+    return result
+
+
+def corpus_size(corpus_dir, kind):
+    """
+    Count the rows and the whitespace separated words in one kind of per-country file.
+    """
+    rows, tokens = 0, 0
+    for country in sorted(os.listdir(corpus_dir)):
+        file_path = f"{corpus_dir}/{country}/{country}_{kind}.csv"
+        if os.path.exists(file_path):
+            df = pd.read_csv(file_path)
+            rows += len(df)
+            text = df['Story'] if kind == 'stories' else df['Summaries'] if kind == 'summaries' else df.iloc[:, 0]
+            tokens += int(text.astype(str).str.split().str.len().sum())
+    return rows, tokens
+
+
+def measure_startup(repeats=5):
+    """
+    Time how long story_cli takes to start, in fresh interpreters.
+
+    Returns
+    -------
+    list of dict
+        One record per command in STARTUP_COMMANDS with the median wall time over the repeats.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for name, command in STARTUP_COMMANDS.items():
+        timings = []
+        status = 'ok'
+        for _ in range(repeats):
+            start = time.perf_counter()
+            completed = subprocess.run(command, cwd=script_dir, capture_output=True, text=True)
+            timings.append(time.perf_counter() - start)
+            if completed.returncode != 0:
+                status = f"error: {(completed.stderr.strip().splitlines() or ['unknown'])[-1]}"
+                break
+        wall_s = sorted(timings)[len(timings) // 2]
+        print(f"•{name}: {wall_s:.3f}s" if status == 'ok' else f"•{name}: {status}")
+        results.append({'stage': name, 'kind': 'startup', 'scale': None, 'status': status, 'wall_s': wall_s})
+    return results
+
+
+def benchmark(scales, stages, countries=None, source_dir="../data", seed=0, keep_dir=None, mock_options=None):
+    """
+    Build a synthetic corpus for each scale and time each stage on it.
+
+    Parameters
+    ----------
+    scales : list of float
+        Corpus sizes relative to the real one (1 = 50 stories per country).
+    stages : list of str
+        Stages to time, see STAGES.
+    countries : list of str, optional
+        Restrict the synthetic corpus to these country codes.
+    source_dir : str
+        The real corpus to draw sentences from.
+    seed : int
+        Seed for the synthetic corpus.
+    keep_dir : str, optional
+        Write the corpora here and keep them instead of using a temporary directory.
+    mock_options : dict, optional
+        Settings for the mock OpenAI server used by the API stages (see mock_openai_server.MockBehaviour).
+
+    Returns
+    -------
+    list of dict
+        One record per (scale, stage).
+    """
+    results = []
+    if any(stage in API_STAGES for stage in stages):
+        from mock_openai_server import start_in_background
+        server, base_url = start_in_background(**(mock_options or {}))
+        # Inherited by the stage processes
+        os.environ['OPENAI_BASE_URL'] = base_url
+        os.environ.setdefault('OPENAI_API_KEY', "mock")
+        print(f"Mock OpenAI server running at {base_url}")
+
+    for scale in scales:
+        root = keep_dir or tempfile.mkdtemp(prefix="story_bench_")
+        corpus_dir = os.path.join(root, f"scale_{scale:g}", "data")
+        work_dir = os.path.join(root, f"scale_{scale:g}", "output")
+        os.makedirs(work_dir, exist_ok=True)
+        print(f"Building synthetic corpus at {scale:g}x in {corpus_dir}...")
+        stories = build_corpus(corpus_dir, source_dir, scale, countries, seed)['stories']
+
+        for stage in stages:
+            # stories/s is relative to the corpus size, tokens/s to the words the stage actually reads
+            rows, tokens = corpus_size(corpus_dir, STAGES[stage])
+            print(f"•Timing {stage} on {stories} stories ({rows} input rows)...")
+            stage_dir = corpus_dir
+            if stage in API_STAGES:
+                # Keep the API stages from overwriting the synthetic inputs of the other stages
+                stage_dir = os.path.join(work_dir, "api_data")
+                if not os.path.exists(stage_dir):
+                    shutil.copytree(corpus_dir, stage_dir)
+            result = measure_stage(stage, stage_dir, work_dir)
+            result.update({
+                'stage': stage,
+                'kind': 'stage',
+                'scale': scale,
+                'stories': stories,
+                'input_rows': rows,
+                'tokens': tokens,
+                'stories_per_s': stories / result['wall_s'],
+                'tokens_per_s': tokens / result['wall_s'],
+            })
+            if result['status'] == 'ok':
+                print(f"  {result['wall_s']:.2f}s, {result['stories_per_s']:.1f} stories/s, {result['tokens_per_s']:.0f} tokens/s, peak RSS {result['peak_rss_mb']:.0f} MB")
+            else:
+                print(f"  {result['status']}")
+            results.append(result)
+
+        if keep_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def environment():
+    """
+    Record the interpreter and library versions, since those are usually what changed between runs.
+    """
+    versions = {}
+    for package in ['pandas', 'numpy', 'spacy', 'textblob', 'transformers', 'openai']:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'packages': versions}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline run.
+
+    A stage regresses when its stories/s drops, or its peak RSS grows, by more than threshold
+    (a fraction, e.g. 0.1 for 10%) relative to the baseline at the same scale. A start-up
+    command regresses when its wall time grows by more than threshold.
+
+    Returns
+    -------
+    list of dict
+        One record per (scale, stage) found in both runs, with a 'regression' flag.
+    """
+    previous = {(r['stage'], r['scale']): r for r in baseline['results'] if r['status'] == 'ok'}
+    report = []
+    for r in results:
+        base = previous.get((r['stage'], r['scale']))
+        if base is None or r['status'] != 'ok':
+            continue
+        if r.get('kind') == 'startup':
+            # Faster start-up is a higher "speed", like stories/s
+            speed = base['wall_s'] / r['wall_s'] - 1
+            memory = 0.0
+        else:
+            speed = r['stories_per_s'] / base['stories_per_s'] - 1
+            memory = (r['peak_rss_mb'] / base['peak_rss_mb'] - 1) if r['peak_rss_mb'] and base['peak_rss_mb'] else 0.0
+        report.append({
+            'stage': r['stage'],
+            'scale': r['scale'],
+            'speed_change': speed,
+            'memory_change': memory,
+            'regression': speed < -threshold or memory > threshold,
+        })
+    return report
+
+
+def print_comparison(report, threshold):
+    """
+    Print a comparison report and return True if any stage regressed.
+    """
+    print(f"\nComparison with baseline (threshold {threshold:.0%}):\n")
+    for r in report:
+        flag = "REGRESSION" if r['regression'] else "ok"
+        if r['scale'] is None:
+            print(f"{r['stage']:<32}          speed {r['speed_change']:+.1%}  {flag}")
+        else:
+            print(f"{r['stage']:<32} {r['scale']:>6g}x  stories/s {r['speed_change']:+.1%}  peak RSS {r['memory_change']:+.1%}  {flag}")
+    return any(r['regression'] for r in report)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--scale', 'scales', type=float, multiple=True, default=[1.0], show_default=True, help='Corpus size relative to the real one, repeat for several sizes')
+@click.option('--stage', 'stages', type=click.Choice(list(STAGES)), multiple=True, help='Stages to time (default: all)')
+@click.option('-c', '--country', 'countries', multiple=True, help='Only use these country codes in the synthetic corpus')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), default=None, help='Results file (default: ../benchmarks/<timestamp>.json)')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None, help='Compare against this results file')
+@click.option('--threshold', type=float, default=0.1, show_default=True, help='Allowed slowdown or memory growth before flagging a regression')
+@click.option('--keep', 'keep_dir', type=click.Path(file_okay=False), default=None, help='Keep the synthetic corpora in this directory')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--mock-latency', default="fixed:0", show_default=True, help='Latency distribution of the mock OpenAI server, see mock_openai_server.py')
+@click.option('--mock-error-rate', type=float, default=0.0, show_default=True, help='Fraction of mock API requests answered with 429')
+@click.option('--startup/--no-startup', default=True, show_default=True, help='Also time how long story_cli takes to start')
+def run(scales, stages, countries, output, baseline, threshold, keep_dir, seed, mock_latency, mock_error_rate, startup):
+    """Time pipeline stages on synthetic corpora."""
+    mock_options = {'latency': mock_latency, 'error_rate_429': mock_error_rate, 'seed': seed}
+    results = measure_startup() if startup else []
+    results += benchmark(list(scales), list(stages) or list(STAGES), list(countries), seed=seed, keep_dir=keep_dir,
+                        mock_options=mock_options)
+
+    output = output or f"../benchmarks/{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(), 'environment': environment(), 'results': results}, f, indent=2)
+    print(f"\nBenchmark results saved to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            if print_comparison(compare(results, json.load(f), threshold), threshold):
+                sys.exit(1)
+
+
+@cli.command(name='compare')
+@click.argument('results_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('baseline_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', type=float, default=0.1, show_default=True, help='Allowed slowdown or memory growth before flagging a regression')
+def compare_command(results_file, baseline_file, threshold):
+    """Compare a saved results file against a baseline."""
+    with open(results_file) as f:
+        results = json.load(f)['results']
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    if print_comparison(compare(results, baseline, threshold), threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,283 @@
+"""
+Experiment grids: the same stories generated with several models, temperatures and prompt templates.
+
+A grid is described by a JSON spec, e.g.
+
+    {
+        "name": "temperature_sweep",
+        "models": ["gpt-4o-mini", "gpt-4.1-mini"],
+        "temperatures": [0.2, 0.8, 1.2],
+        "prompts": {"potential": "Write a {word_count} word potential {demonym} story.",
+                    "folk": "Write a {word_count} word {demonym} folk tale."},
+        "countries": ["NO", "JP"],
+        "stories": 20
+    }
+
+Every combination of model, temperature and prompt is a cell, named e.g. gpt-4o-mini_t0.8_potential.
+Each cell is a data directory of its own, ../experiments/<name>/cells/<cell>/<CC>/<CC>_stories.csv,
+with the same columns as data/, so every analysis stage runs on it unchanged. All the stories of
+the grid are requested through one openai_client.map, so the cells share one concurrency and rate
+limit (and story_cli's budget) instead of being run one after the other. The partitions are also
+the cache: stories already in them are never requested again, so a stopped run continues where it
+stopped and a grid that grows by a model or temperature only generates the new cells.
+The generate requests are logged in ../experiments/<name>/<CC>/<CC>_usage.csv, with the cell in
+the Story_ID (<cell>:<Story_ID>).
+
+`story_cli.py grid analyze` runs the analysis stages on the cells. The API stages (GPT summaries
+and names) send the requests of all the stale cells and countries through one openai_client.map
+as well, logged the same way; the local stages run on the cells one after the other.
+"""
+
+import os
+import csv
+import json
+import time
+from datetime import date
+import paths
+import manifest
+import instrumentation
+import openai_client
+import generate_stories
+
+# The stages `story_cli.py grid analyze` runs on every cell, in this order
+ANALYSIS_STAGES = ['summary', 'names', 'nouns', 'words', 'sentiment']
+# The stages among them that call the API (summary only with the gpt engine), run by analyze()
+API_ANALYSIS_STAGES = ['summary', 'names']
+
+CELL_COLUMNS = ['Cell', 'GPT_Model', 'Temperature', 'Prompt_Name', 'Prompt_Template']
+
+
+def load_spec(filepath, experiments_dir="../experiments"):
+    """
+    Read a grid spec and fill in the defaults of `story_cli.py generate` for the keys it leaves out.
+
+    Raises
+    ------
+    ValueError
+        If the spec has no name, countries or number of stories.
+    """
+    with open(filepath, encoding="utf-8") as f:
+        spec = json.load(f)
+
+    for key in ('name', 'countries', 'stories'):
+        if key not in spec:
+            raise ValueError(f"The grid spec {filepath} has no '{key}'")
+    if isinstance(spec['countries'], str):
+        spec['countries'] = [spec['countries']]
+    spec.setdefault('models', [generate_stories.GPT_MODEL])
+    spec.setdefault('temperatures', [generate_stories.TEMPERATURE])
+    spec.setdefault('prompts', {"potential": generate_stories.PROMPT_TEMPLATE})
+    spec.setdefault('word_count', generate_stories.WORD_COUNT)
+    spec['dir'] = os.path.join(experiments_dir, spec['name'])
+    return spec
+
+
+def cells(spec):
+    """
+    The cells of a grid, one dict per (model, temperature, prompt) with the CELL_COLUMNS.
+    Prompt names with the same template as an earlier one are left out, as their cells would be duplicates.
+    """
+    grid_cells, seen = [], set()
+    for model in spec['models']:
+        for temperature in spec['temperatures']:
+            for prompt_name, template in spec['prompts'].items():
+                if (model, float(temperature), template) in seen:
+                    continue
+                seen.add((model, float(temperature), template))
+                grid_cells.append({
+                    'Cell': f"{model}_t{float(temperature):g}_{prompt_name}",
+                    'GPT_Model': model,
+                    'Temperature': float(temperature),
+                    'Prompt_Name': prompt_name,
+                    'Prompt_Template': template,
+                })
+    return grid_cells
+
+
+def cell_dir(spec, cell):
+    """
+    The data directory of a cell, e.g. ../experiments/temperature_sweep/cells/gpt-4o-mini_t0.8_potential
+    """
+    return os.path.join(spec['dir'], "cells", cell)
+
+
+def write_cells(spec):
+    """
+    Save the parameters of the cells to ../experiments/<name>/cells.csv.
+    """
+    os.makedirs(spec['dir'], exist_ok=True)
+    with open(os.path.join(spec['dir'], "cells.csv"), 'w', newline='', encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CELL_COLUMNS)
+        writer.writeheader()
+        writer.writerows(cells(spec))
+
+
+def run(spec):
+    """
+    Generate the stories of every cell that are not in its partitions yet.
+
+    The missing stories are scheduled story number first, so a run stopped by the budget leaves
+    every cell and country with about as many stories rather than finishing some cells and
+    skipping others.
+
+    Returns
+    -------
+    int
+        The number of stories generated by this run.
+    """
+    generate_stories.load_api_key()
+    countries = generate_stories.read_countries(spec['countries'])
+    grid_cells = cells(spec)
+    write_cells(spec)
+
+    # Which stories each (cell, country) partition is missing
+    partitions, missing = {}, {}
+    for cell in grid_cells:
+        with paths.use_data_dir(cell_dir(spec, cell['Cell'])):
+            for country_code in countries:
+                partitions[cell['Cell'], country_code] = paths.country_file(country_code, "stories")
+                done = generate_stories.finished_story_ids(country_code)
+                missing[cell['Cell'], country_code] = {i for i in range(spec['stories']) if f"{country_code}_{i+1}" not in done}
+    todo = [(cell, country_code, i) for i in range(spec['stories']) for cell in grid_cells for country_code in countries
+            if i in missing[cell['Cell'], country_code]]
+    print(f"Grid {spec['name']}: {len(grid_cells)} cells x {len(countries)} countries x {spec['stories']} stories, "
+          f"{len(todo)} to generate\n")
+
+    def generate_story(task):
+        cell, country_code, story_iteration = task
+        country_name, demonym = countries[country_code]
+        story_id = f"{country_code}_{story_iteration+1}"
+        prompt = generate_stories.story_prompt(demonym, country_code, cell['Prompt_Template'], spec['word_count'])
+        story = generate_stories.request_story(story_id, country_code, prompt, cell['GPT_Model'], cell['Temperature'],
+                                               ledger_id=f"{cell['Cell']}:{story_id}")
+        row = (story_id, country_code, country_name, demonym, story, prompt, date.today().strftime("%d-%m-%Y"),
+               cell['GPT_Model'], cell['Temperature'])
+        generate_stories.append_story(partitions[cell['Cell'], country_code], row)
+        print(f"{cell['Cell']}: story {story_id} saved ({len(story.split())} words)")
+
+    # The usage ledgers are kept per country for the whole grid
+    with paths.use_data_dir(spec['dir']), instrumentation.stage("grid", spec['name']):
+        for _ in openai_client.map(generate_story, todo):
+            pass
+    return len(todo)
+
+
+def analyze(spec, stage, force=False):
+    """
+    Run an API stage ('summary' with GPT or 'names') on the stale countries of every cell.
+
+    The requests of all the cells go through one openai_client.map, like the stories of run(), so
+    the cells share the concurrency instead of being analysed one after the other. Each cell keeps its own
+    manifest and outputs. When the run stops (e.g. on the budget) the finished replies of every
+    country not done yet are checkpointed in its cell, and the finished countries are recorded.
+
+    Returns
+    -------
+    int
+        The number of requests sent.
+    """
+    import pandas as pd
+    import summary_gen
+    import name_extraction
+
+    if stage == 'summary':
+        summary_gen.load_api_key()
+        request, load_checkpoint, save_checkpoint = summary_gen.summarize_story, summary_gen.load_checkpoint, summary_gen.save_checkpoint
+        save = summary_gen.save_gpt_summaries
+    elif stage == 'names':
+        name_extraction.load_api_key()
+        request, load_checkpoint, save_checkpoint = name_extraction.extract_main_character, name_extraction.load_checkpoint, name_extraction.save_checkpoint
+        def save(country_code, stories, finished):
+            name_extraction.save_names(country_code, stories.assign(Name=[finished[story_id] for story_id in stories.iloc[:, 0]]))
+    else:
+        raise ValueError(f"Not an API analysis stage: {stage}")
+
+    # The stale (cell, country) partitions, with the replies an earlier run already got
+    partitions = []
+    for cell in cells(spec):
+        directory = cell_dir(spec, cell['Cell'])
+        if not os.path.isdir(directory):
+            continue
+        with paths.use_data_dir(directory):
+            stale, skipped = manifest.plan(stage, manifest.select_countries(('all',), ""), force)
+            print(f"[{cell['Cell']}] {stage}: rebuilding {len(stale)} {'countries' if len(stale) != 1 else 'country'}, "
+                  f"skipping {len(skipped)}")
+            for country_code in stale:
+                partitions.append({'cell': cell['Cell'], 'dir': directory, 'country': country_code,
+                                   'stories': pd.read_csv(paths.country_file(country_code, "stories")),
+                                   'finished': load_checkpoint(country_code)})
+    if not partitions:
+        return 0
+    todo = [(partition, index) for partition in partitions
+            for index, story_id in enumerate(partition['stories'].iloc[:, 0]) if story_id not in partition['finished']]
+    print(f"Grid {spec['name']}: {len(todo)} {stage} requests for {len(partitions)} (cell, country) partitions\n")
+
+    def send(task):
+        partition, index = task
+        story_id = partition['stories'].iloc[index, 0]
+        reply = request(partition['country'], story_id, partition['stories']['Story'].iloc[index],
+                        ledger_id=f"{partition['cell']}:{story_id}")
+        return story_id, reply
+
+    started = time.time()
+    try:
+        # The usage ledgers are kept per country for the whole grid
+        with paths.use_data_dir(spec['dir']), instrumentation.stage(stage, spec['name']):
+            for (partition, _), (story_id, reply) in openai_client.map(send, todo):
+                partition['finished'][story_id] = reply
+    finally:
+        # Save the finished countries and checkpoint the others, also when the map stopped early
+        for partition in partitions:
+            with paths.use_data_dir(partition['dir']):
+                if partition['stories'].iloc[:, 0].isin(list(partition['finished'])).all():
+                    save(partition['country'], partition['stories'], partition['finished'])
+                elif partition['finished']:
+                    save_checkpoint(partition['country'], partition['finished'])
+        for directory in dict.fromkeys(partition['dir'] for partition in partitions):
+            with paths.use_data_dir(directory):
+                manifest.record(stage, [p['country'] for p in partitions if p['dir'] == directory], since=started)
+    return len(todo)
+
+
+def compare(spec):
+    """
+    One row per (cell, country) with the cell's parameters, the number of stories, their mean
+    length in words and, where the analyses have been run, the share of each top emotion and the
+    most common main character name. Saved to ../experiments/<name>/comparison.csv.
+    """
+    import pandas as pd
+
+    rows = []
+    for cell in cells(spec):
+        with paths.use_data_dir(cell_dir(spec, cell['Cell'])):
+            if not os.path.isdir(paths.DATA_DIR):
+                continue
+            for country_code in paths.list_country_dirs():
+                stories_file = paths.country_file(country_code, "stories")
+                if not os.path.exists(stories_file):
+                    continue
+                stories = pd.read_csv(stories_file)
+                row = dict(cell, Country=country_code, Stories=len(stories),
+                           Mean_Words=stories['Story'].fillna("").str.split().str.len().mean())
+
+                sentiments_file = paths.country_file(country_code, "sentiments")
+                if os.path.exists(sentiments_file):
+                    shares = pd.read_csv(sentiments_file)['sentiment'].value_counts(normalize=True)
+                    row.update({f"Share_{sentiment}": share for sentiment, share in shares.items()})
+                names_file = paths.country_file(country_code, "names")
+                if os.path.exists(names_file):
+                    names = pd.read_csv(names_file)
+                    row['Top_Name'] = names['Name'].iloc[0] if len(names) else None
+                rows.append(row)
+    if not rows:
+        return pd.DataFrame(columns=CELL_COLUMNS + ['Country', 'Stories', 'Mean_Words'])
+
+    comparison = pd.DataFrame(rows)
+    share_columns = sorted(c for c in comparison.columns if c.startswith("Share_"))
+    # An emotion missing from a country's sentiments has a share of 0, unless the country has no sentiments yet
+    analysed = comparison[share_columns].notna().any(axis=1)
+    comparison.loc[analysed, share_columns] = comparison.loc[analysed, share_columns].fillna(0.0)
+    comparison = comparison[[c for c in comparison.columns if c not in share_columns and c != 'Top_Name']
+                            + share_columns + (['Top_Name'] if 'Top_Name' in comparison.columns else [])]
+    comparison.drop(columns=['Prompt_Template']).to_csv(os.path.join(spec['dir'], "comparison.csv"), index=False)
+    return comparison
@@ -1,10 +1,26 @@
 import os
+import paths
+import instrumentation
+import token_usage
+import openai_client
+from time import perf_counter
 import openai
-import pandas as pd
 from dotenv import load_dotenv
 import csv
+import threading
 from datetime import date
 
+STORY_COLUMNS = ['Story_ID', 'ISO-3361', 'Country_Name', 'Demonym', 'Story', 'Prompt', 'Date', 'GPT_Model', 'Temperature']
+
+# The settings of `story_cli.py generate` (experiment_grid.py varies them)
+WORD_COUNT = 1500  # Number of words for each story
+PROMPT_TEMPLATE = "Write a {word_count} word potential {demonym} story."
+GPT_MODEL = "gpt-4o-mini"
+TEMPERATURE = 0.8
+
+COUNTRY_CODES = "country_codes.csv"
+
+_append_lock = threading.Lock()
 
 
 def load_api_key():
@@ -28,8 +44,78 @@ def load_api_key():
     
     openai.api_key = api_key
 
+    # Send requests somewhere else than api.openai.com, e.g. the local mock_openai_server.py
+    base_url = os.getenv("OPENAI_BASE_URL")
+    if base_url:
+        openai.base_url = base_url.rstrip("/") + "/"
+
+
+def read_countries(countries):
+    """
+    Return {country code: (country name, demonym)} for the given country codes ('all' for every
+    country with a demonym in country_codes.csv).
+    """
+    selected = {}
+    with open(COUNTRY_CODES, 'r', encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for line in reader:
+            if line[3] != "" and (list(countries) == ['all'] or line[0] in countries):
+                selected[line[0]] = (line[1], line[3])
+    unknown = set(countries) - set(selected) - {'all'}
+    if unknown:
+        print(f"Skipping countries without a demonym in {COUNTRY_CODES}: {', '.join(sorted(unknown))}")
+    return selected
 
-def generate_stories(number_of_stories_per_topic: int, demonym: str, country_code: str, country_name: str):
+
+def story_prompt(demonym, country_code, template=PROMPT_TEMPLATE, word_count=WORD_COUNT):
+    """
+    The prompt for a country's stories. The default country 'XX' has no demonym, so it is left out.
+    """
+    if country_code == 'XX':
+        template = template.replace(" {demonym}", "")
+    return template.format(word_count=word_count, demonym=demonym)
+
+
+def request_story(story_id, country_code, prompt, gpt_model=GPT_MODEL, temperature=TEMPERATURE, ledger_id=None):
+    """
+    Send one story prompt and return the story, logging the request in the country's token usage
+    ledger under ledger_id (the story_id by default).
+    """
+    messages = [{"role": "system", "content": ""}]  # Initial system message
+    messages.append({"role": "user", "content": prompt})
+
+    token_usage.before_request("generate", country_code)
+    start = perf_counter()
+    response = openai_client.create(
+        model=gpt_model,
+        messages=messages,
+        temperature=temperature,
+    )
+    instrumentation.record_api_call(perf_counter() - start, response.usage)
+    instrumentation.add_items()
+    token_usage.record("generate", country_code, ledger_id or story_id, gpt_model, response.usage)
+    # Extract generated story from the response
+    story = response.choices[0].message.content
+    instrumentation.echo(f'{story}\n---------------------------------\n\n')
+    return story
+
+
+def append_story(filepath, row):
+    """
+    Append one story (a tuple in STORY_COLUMNS order) to a stories file, writing the header to a new file.
+    """
+    with _append_lock:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        new_file = not os.path.exists(filepath)
+        with open(filepath, 'a', newline='', encoding="utf-8") as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
+            if new_file:
+                writer.writerow(STORY_COLUMNS)
+            writer.writerow(row)
+
+
+def generate_stories(number_of_stories_per_topic: int, demonym: str, country_code: str, country_name: str, done=None):
     """
     Generates potential stories using the OpenAI API.
 
@@ -47,6 +133,8 @@ def generate_stories(number_of_stories_per_topic: int, demonym: str, country_cod
         The ISO-3166-1 alpha-2 code for the country.
     country_name : str
         The name of the country.
+    done : list of tuples, optional
+        Stories already generated by a run that was stopped (see token_usage.py). Generation continues after them.
 
     Returns
     -------
@@ -58,41 +146,122 @@ def generate_stories(number_of_stories_per_topic: int, demonym: str, country_cod
     >>> generate_stories(["Norwegian", "Japanese"], 2)
     """
     
-    word_count = 1500 # Number of words for each story
-
     # Generate prompts based on country
-    if country_code == 'XX':    
-        prompt = f"Write a {word_count} word potential story." 
-    else:
-        prompt = f"Write a {word_count} word potential {demonym} story."  # Generate prompts based on topics
-    stories = []
+    prompt = story_prompt(demonym, country_code)
+    stories = list(done or [])
 
     # Choose GPT model and temperature
-    gpt_model = "gpt-4o-mini"
-    temperature = 0.8
+    gpt_model = GPT_MODEL
+    temperature = TEMPERATURE
 
-    # Calling the OpenAI API to generate stories
-    for story_iteration in range(number_of_stories_per_topic):
+    def generate_story(story_iteration):
         print(f"\nGenerating story {story_iteration+1} of {number_of_stories_per_topic} for {country_name}...\n")
-        messages = [{"role": "system", "content": ""}]  # Initial system message
-        messages.append({"role": "user", "content": prompt})
-        response = openai.chat.completions.create(
-            model=gpt_model,
-            messages=messages,
-            temperature=temperature,
-        )
-        # Extract generated story from the response
-        story = response.choices[0].message.content
-        print(f'{story}\n---------------------------------\n\n')
         # Create a unique identifier for each story
         story_id = f"{country_code}_{story_iteration+1}"
+        story = request_story(story_id, country_code, prompt, gpt_model, temperature)
 
         time = date.today().strftime("%d-%m-%Y")
-        stories.append((story_id, country_code, country_name, demonym, story, prompt, time, gpt_model, temperature))
+        return (story_id, country_code, country_name, demonym, story, prompt, time, gpt_model, temperature)
+
+    # Calling the OpenAI API to generate stories, several at a time (see openai_client.py)
+    finished = {}
+    try:
+        for story_iteration, story in openai_client.map(generate_story, range(len(stories), number_of_stories_per_topic)):
+            finished[story_iteration] = story
+    except token_usage.BudgetExhausted:
+        import pandas as pd
+        # A resumed run continues after the stories in the checkpoint, so only keep those without a gap
+        while len(stories) in finished:
+            stories.append(finished.pop(len(stories)))
+        token_usage.save_checkpoint(country_code, "generate", pd.DataFrame(stories, columns=STORY_COLUMNS))
+        raise
+    stories += [finished[i] for i in sorted(finished)]
         
     return stories
 
 
+def spool_dir(country_code):
+    """
+    Directory of the spool files of the stories being streamed, e.g. ../data/NO/spool
+    """
+    return os.path.join(paths.country_dir(country_code), "spool")
+
+
+def finished_story_ids(country_code):
+    """
+    The Story_IDs already in the country's stories file.
+    """
+    filepath = paths.country_file(country_code, "stories")
+    if not os.path.exists(filepath):
+        return set()
+    with open(filepath, newline='', encoding="utf-8") as f:
+        return {row['Story_ID'] for row in csv.DictReader(f)}
+
+
+def stream_stories(number_of_stories_per_topic: int, demonym: str, country_code: str, country_name: str):
+    """
+    Generates stories like generate_stories, but streams each completion into a spool file,
+    data/<CC>/spool/<Story_ID>.part, as it arrives and appends the story to the stories file when
+    its stream ends. Memory use does not grow with the number of stories, and a run that is
+    interrupted loses only the stories being streamed.
+
+    Stories already in the stories file are kept, so running the same command again continues
+    where the last run stopped. Spool files left by an interrupted run are partial stories: they
+    are reported, deleted and their stories generated again. The stories are appended in the order
+    they finish.
+
+    Returns
+    -------
+    int
+        The number of stories generated by this run.
+    """
+    prompt = story_prompt(demonym, country_code)
+    gpt_model = GPT_MODEL
+    temperature = TEMPERATURE
+
+    filepath = paths.country_file(country_code, "stories")
+    spool = spool_dir(country_code)
+    os.makedirs(spool, exist_ok=True)
+    done = finished_story_ids(country_code)
+    todo = [i for i in range(number_of_stories_per_topic) if f"{country_code}_{i+1}" not in done]
+
+    partial = sorted(name[:-len(".part")] for name in os.listdir(spool) if name.endswith(".part"))
+    if partial:
+        print(f"Found {len(partial)} partial stories from an interrupted run ({', '.join(partial)}), generating them again")
+        for story_id in partial:
+            os.remove(os.path.join(spool, f"{story_id}.part"))
+    print(f"Streaming {len(todo)} of {number_of_stories_per_topic} stories for {country_name} "
+          f"({number_of_stories_per_topic - len(todo)} already in {filepath})...\n")
+
+    def stream_story(story_iteration):
+        story_id = f"{country_code}_{story_iteration+1}"
+        spool_file = os.path.join(spool, f"{story_id}.part")
+        messages = [{"role": "system", "content": ""}, {"role": "user", "content": prompt}]
+
+        token_usage.before_request("generate", country_code)
+        start = perf_counter()
+        usage = openai_client.stream_to(spool_file, model=gpt_model, messages=messages, temperature=temperature)
+        instrumentation.record_api_call(perf_counter() - start, usage)
+        instrumentation.add_items()
+        token_usage.record("generate", country_code, story_id, gpt_model, usage)
+
+        with open(spool_file, encoding="utf-8") as f:
+            story = f.read()
+        instrumentation.echo(f'{story}\n---------------------------------\n\n')
+        row = (story_id, country_code, country_name, demonym, story, prompt, date.today().strftime("%d-%m-%Y"), gpt_model, temperature)
+        # Finalize: append the story, then drop its spool file
+        append_story(filepath, row)
+        os.remove(spool_file)
+        print(f"Story {story_id} saved ({len(story.split())} words)")
+
+    for _ in openai_client.map(stream_story, todo):
+        pass
+    if not os.listdir(spool):
+        os.rmdir(spool)
+    print(f"Dataset saved to {filepath}\n")
+    return len(todo)
+
+
 def create_dataset(stories, country_code):
     """
     Creates a CSV file from the generated stories.
@@ -106,17 +275,19 @@ def create_dataset(stories, country_code):
         Each tuple contains (story_id, country_code, country_name, demonym, story, prompt, date, gpt_model, temperature).
 
     """
+    import pandas as pd  # Imported here to keep `story_cli.py generate` quick to start
+
     # Create a DataFrame from the stories list
-    df = pd.DataFrame(stories, columns=['Story_ID', 'ISO-3361', 'Country_Name', 'Demonym', 'Story', 'Prompt', 'Date', 'GPT_Model', 'Temperature'])
+    df = pd.DataFrame(stories, columns=STORY_COLUMNS)
 
     
     # Create a directory to store the data if it does not exist
-    directory = "../data/"+country_code
+    directory = paths.country_dir(country_code)
     if not os.path.exists(directory):
-        os.mkdir(directory)
+        os.makedirs(directory)
     
     # Create a unique filename for the dataset based on the country code
-    filepath = f"{directory}/{country_code}_stories.csv"
+    filepath = paths.country_file(country_code, "stories")
 
     # Save the DataFrame to a CSV file
     df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
@@ -124,13 +295,23 @@ def create_dataset(stories, country_code):
     print(f"Dataset saved to {filepath}\n")
 
 
-def main(num_story_per_topic, demonym, country_code, country_name):
+def main(num_story_per_topic, demonym, country_code, country_name, stream=False):
     # Load the API key when the module is imported
     load_api_key()
 
+    if stream:
+        with instrumentation.stage("generate", country_code):
+            stream_stories(num_story_per_topic, demonym, country_code, country_name)
+        return
+
     # Generate stories based on countries and save to CSV
-    stories = generate_stories(num_story_per_topic, demonym, country_code, country_name)
-    create_dataset(stories, country_code)
+    with instrumentation.stage("generate", country_code):
+        done = token_usage.load_checkpoint(country_code, "generate")
+        if done is not None:
+            done = list(done.itertuples(index=False, name=None))
+        stories = generate_stories(num_story_per_topic, demonym, country_code, country_name, done)
+        create_dataset(stories, country_code)
+        token_usage.clear_checkpoint(country_code, "generate")
     
 
 
@@ -0,0 +1,208 @@
+"""
+Per-stage metrics for story_cli runs.
+
+Each stage wraps the work for one country in `with instrumentation.stage("words", "NO"):` and
+reports progress with add_items() and record_api_call(). When profiling is enabled (story_cli
+--profile), one JSON line per (stage, country) is appended to the profile file as soon as that
+country is done, and a Prometheus text file can be rewritten alongside it.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+QUIET = False  # Set by story_cli --quiet to stop the scripts echoing every story and summary
+
+_profile_path = None
+_prometheus_path = None
+_records = []
+_current = None
+_lock = threading.Lock()  # add_items and record_api_call are called from the request threads
+
+
+class StageMetrics:
+    """
+    Measurements for one stage run on one country.
+    """
+
+    def __init__(self, stage, country):
+        self.stage = stage
+        self.country = country
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.peak_rss_mb = None
+        self.items = 0
+        self.api_latencies = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def as_dict(self):
+        latencies = sorted(self.api_latencies)
+        return {
+            'stage': self.stage,
+            'country': self.country,
+            'started': self.started,
+            'wall_s': round(self.wall_s, 4),
+            'cpu_s': round(self.cpu_s, 4),
+            'peak_rss_mb': self.peak_rss_mb,
+            'items': self.items,
+            'items_per_s': round(self.items / self.wall_s, 3) if self.wall_s else None,
+            'api_requests': len(latencies),
+            'api_latency_p50_s': percentile(latencies, 50),
+            'api_latency_p90_s': percentile(latencies, 90),
+            'api_latency_p99_s': percentile(latencies, 99),
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+        }
+
+
+def percentile(sorted_values, q):
+    """
+    Nearest-rank percentile of an already sorted list, or None if it is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return round(sorted_values[rank], 4)
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the process so far in MB (a high-water mark, it never goes down).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def enable(profile_path=None, prometheus_path=None, quiet=False):
+    """
+    Turn on writing metrics to a JSONL profile and/or a Prometheus text file.
+    """
+    global _profile_path, _prometheus_path, QUIET
+    _profile_path = profile_path
+    _prometheus_path = prometheus_path
+    QUIET = quiet
+    for path in (profile_path, prometheus_path):
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+@contextmanager
+def stage(name, country):
+    """
+    Measure the work done inside the block as one (stage, country) record.
+    """
+    global _current
+    metrics = StageMetrics(name, country)
+    previous, _current = _current, metrics
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield metrics
+    finally:
+        metrics.wall_s = time.perf_counter() - wall_start
+        metrics.cpu_s = time.process_time() - cpu_start
+        metrics.peak_rss_mb = peak_rss_mb()
+        _current = previous
+        _records.append(metrics)
+        _write(metrics)
+
+
+def add_items(count=1):
+    """
+    Count stories (or other units of work) processed by the current stage.
+    """
+    if _current is not None:
+        with _lock:
+            _current.items += count
+
+
+def record_api_call(latency, usage=None):
+    """
+    Record the latency of one API request and, if given, its token usage (response.usage).
+    """
+    if _current is None:
+        return
+    with _lock:
+        _current.api_latencies.append(latency)
+        if usage is not None:
+            _current.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+            _current.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+
+def echo(text):
+    """
+    Print generated text (stories, summaries) unless running with --quiet.
+    """
+    if not QUIET:
+        print(text)
+
+
+def records():
+    """
+    Return the metrics of every stage run so far as dictionaries.
+    """
+    return [r.as_dict() for r in _records]
+
+
+def _write(metrics):
+    if _profile_path:
+        with open(_profile_path, 'a', encoding="utf-8") as f:
+            f.write(json.dumps(metrics.as_dict()) + "\n")
+    if _prometheus_path:
+        write_prometheus(_prometheus_path)
+
+
+def write_prometheus(path):
+    """
+    Write all records in the Prometheus text exposition format (for the node_exporter textfile collector).
+
+    The file is written to a temporary name and renamed, so a scraper never sees half a file.
+    """
+    gauges = [
+        ('story_stage_wall_seconds', 'Wall time of the stage for one country', 'wall_s', 1),
+        ('story_stage_cpu_seconds', 'CPU time of the stage for one country', 'cpu_s', 1),
+        ('story_stage_peak_rss_bytes', 'Peak resident set size of the process when the stage finished', 'peak_rss_mb', 1024 * 1024),
+        ('story_stage_items', 'Stories processed by the stage', 'items', 1),
+        ('story_api_requests', 'API requests made by the stage', 'api_requests', 1),
+    ]
+    lines = []
+    rows = records()
+    for name, help_text, key, factor in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for r in rows:
+            if r[key] is not None:
+                lines.append(f'{name}{{stage="{r["stage"]}",country="{r["country"]}"}} {r[key] * factor}')
+
+    lines.append("# HELP story_api_tokens Tokens used by the stage")
+    lines.append("# TYPE story_api_tokens gauge")
+    for r in rows:
+        for kind in ['prompt', 'completion']:
+            lines.append(f'story_api_tokens{{stage="{r["stage"]}",country="{r["country"]}",type="{kind}"}} {r[kind + "_tokens"]}')
+
+    lines.append("# HELP story_api_latency_seconds API request latency")
+    lines.append("# TYPE story_api_latency_seconds summary")
+    for r in rows:
+        for q in [50, 90, 99]:
+            value = r[f'api_latency_p{q}_s']
+            if value is not None:
+                lines.append(f'story_api_latency_seconds{{stage="{r["stage"]}",country="{r["country"]}",quantile="{q / 100}"}} {value}')
+
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w', encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary, path)
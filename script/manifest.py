@@ -0,0 +1,232 @@
+"""
+Manifest of the per-country artifacts, for make-style incremental rebuilds.
+
+For every (country, stage) the manifest records the hash of the stage's input files, the pipeline
+and model version that built the output, and the hash of the output files. An artifact is stale
+when any of these no longer match what is on disk, so `story_cli analyze all -a all` only reruns
+the stages and countries whose inputs, code version or model changed (or whose output was
+edited or deleted). The manifest is kept in <data dir>/manifest.json.
+"""
+
+import os
+import time
+import json
+import contextlib
+import hashlib
+from datetime import datetime
+from importlib import metadata
+import paths
+
+# Stage -> the per-country files it reads and writes (kinds of <CC>_<kind>.csv, or <kind>.<ext> for other
+# file types), and the version of its pipeline.
+# Bump 'version' when a change to a stage script changes its output, to rebuild that stage everywhere.
+STAGES = {
+    'summary': {'inputs': ['stories'], 'outputs': ['summaries'], 'version': 1, 'model': "gpt-4o-mini"},
+    'names': {'inputs': ['stories'], 'outputs': ['names'], 'version': 1, 'model': "gpt-4o-mini"},
+    'nouns': {'inputs': ['stories'], 'outputs': ['noun_phrases'], 'version': 1, 'model': "textblob"},
+    'words': {'inputs': ['stories', 'names'], 'outputs': ['word_freq', 'story_lemmas'], 'version': 2, 'model': "en_core_web_sm"},
+    'sentiment': {'inputs': ['summaries'], 'outputs': ['sentiments', 'emotion_scores.parquet'], 'version': 2,
+                  'model': "bhadresh-savani/distilbert-base-uncased-emotion"},
+    # The model is "heuristic" when story_cli runs it with --plot-engine heuristic
+    'plot': {'inputs': ['stories'], 'outputs': ['plot_structure'], 'version': 1, 'model': "gpt-4o-mini"},
+}
+
+
+def manifest_file():
+    return f"{paths.DATA_DIR}/manifest.json"
+
+
+def load():
+    """
+    Return the manifest as a dict keyed by "<country>/<stage>", or an empty dict if there is none yet.
+    """
+    if not os.path.exists(manifest_file()):
+        return {}
+    with open(manifest_file(), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save(manifest):
+    """
+    Write the manifest to a temporary file and rename it, so an interrupted run never leaves half a file.
+    """
+    temporary = f"{manifest_file()}.{os.getpid()}.tmp"
+    with open(temporary, 'w', encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temporary, manifest_file())
+
+
+@contextlib.contextmanager
+def locked(timeout=60):
+    """
+    Hold <data dir>/manifest.json.lock while updating the manifest, so processes sharing a data
+    directory (the workers of work_queue.py) don't overwrite each other's entries. A lock older than
+    timeout seconds was left by a process that died, and is taken over.
+    """
+    lock = f"{manifest_file()}.lock"
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > timeout:
+                    os.remove(lock)
+            except FileNotFoundError:
+                pass
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+
+def file_hash(filepath):
+    """
+    SHA-256 of a file's contents, or None if it does not exist.
+    """
+    if not os.path.exists(filepath):
+        return None
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def kind_file(country, kind):
+    """
+    The path of a country's file of a kind from STAGES, e.g. 'sentiments' or 'emotion_scores.parquet'.
+    """
+    kind, _, ext = kind.partition(".")
+    return paths.country_file(country, kind, ext or "csv")
+
+
+def files_hash(country, kinds):
+    """
+    Combined hash of a country's files of the given kinds, or None if any of them is missing.
+    """
+    hashes = [file_hash(kind_file(country, kind)) for kind in kinds]
+    if None in hashes:
+        return None
+    return hashlib.sha256("".join(hashes).encode("utf-8")).hexdigest()
+
+
+def model_version(stage):
+    """
+    The model a stage uses, with the installed package version for the local models.
+    """
+    model = STAGES[stage]['model']
+    package = {'nouns': "textblob", 'words': "en_core_web_sm", 'sentiment': "transformers"}.get(stage)
+    if package is None:
+        return model
+    try:
+        return f"{model} ({package} {metadata.version(package)})"
+    except metadata.PackageNotFoundError:
+        return model
+
+
+def current_entry(stage, country):
+    """
+    What the manifest entry for (stage, country) would be if it were built from the files as they are now.
+    """
+    return {
+        'input_hash': files_hash(country, STAGES[stage]['inputs']),
+        'pipeline_version': STAGES[stage]['version'],
+        'model': model_version(stage),
+        'output_hash': files_hash(country, STAGES[stage]['outputs']),
+    }
+
+
+def status(manifest, stage, country):
+    """
+    Return why (stage, country) needs rebuilding: 'missing input', 'no output', 'not in manifest',
+    'input changed', 'pipeline changed', 'model changed' or 'output changed', or 'up to date'.
+    """
+    current = current_entry(stage, country)
+    recorded = manifest.get(f"{country}/{stage}")
+    if current['input_hash'] is None:
+        return 'missing input'
+    if current['output_hash'] is None:
+        return 'no output'
+    if recorded is None:
+        return 'not in manifest'
+    if recorded['input_hash'] != current['input_hash']:
+        return 'input changed'
+    if recorded['pipeline_version'] != current['pipeline_version']:
+        return 'pipeline changed'
+    if recorded['model'] != current['model']:
+        return 'model changed'
+    if recorded['output_hash'] != current['output_hash']:
+        return 'output changed'
+    return 'up to date'
+
+
+def select_countries(countries, startfrom):
+    """
+    Expand the countries argument of story_cli ('all' or country codes) the way the stage scripts do.
+    """
+    selected = []
+    for dir in paths.list_country_dirs():
+        if 'all' in countries and len(countries) == 1:
+            if startfrom != "" and startfrom != dir:
+                continue
+            startfrom = ""
+            selected.append(dir)
+        elif dir in countries:
+            selected.append(dir)
+    return selected
+
+
+def plan(stage, countries, force=False):
+    """
+    Split countries into those to rebuild for a stage and those skipped.
+
+    Returns
+    -------
+    tuple of (list of str, dict)
+        The countries to rebuild, and the reason each skipped country was skipped.
+        Countries without the stage's input are always skipped.
+    """
+    manifest = load()
+    stale, skipped = [], {}
+    for country in countries:
+        reason = status(manifest, stage, country)
+        if reason == 'missing input' or (reason == 'up to date' and not force):
+            skipped[country] = reason
+        else:
+            stale.append(country)
+    return stale, skipped
+
+
+def record(stage, countries, since=None):
+    """
+    Record the current input and output hashes of (stage, country) for each country.
+
+    Parameters
+    ----------
+    stage : str
+        The stage that built the outputs.
+    countries : list of str
+        Countries to record.
+    since : float, optional
+        Only record countries whose output files were all written after this time (time.time()),
+        so the countries a stage did not get to before it stopped stay stale.
+    """
+    entries = {}
+    for country in countries:
+        outputs = [kind_file(country, kind) for kind in STAGES[stage]['outputs']]
+        if not all(os.path.exists(f) for f in outputs):
+            continue
+        if since is not None and min(os.path.getmtime(f) for f in outputs) < since:
+            continue
+        entry = current_entry(stage, country)
+        entry['built'] = datetime.now().isoformat(timespec="seconds")
+        entries[f"{country}/{stage}"] = entry
+    if entries:
+        with locked():
+            manifest = load()
+            manifest.update(entries)
+            save(manifest)
+    return [key.split("/")[0] for key in entries]
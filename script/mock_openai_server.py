@@ -0,0 +1,334 @@
+"""
+A local stand-in for the OpenAI chat completions API, for load-testing the generation and
+extraction scripts without spending money.
+
+Point the scripts at it with `python3 story_cli.py --base-url http://127.0.0.1:8000/v1 generate PS 1`
+(any OPENAI_API_KEY value is accepted). It answers story, summary, name and plot structure prompts with canned
+text from an existing corpus or with synthesized text, adds configurable latency, and injects
+429 and 5xx errors with the same x-ratelimit-* headers as the real API. Requests with "stream": true
+are answered with server-sent events.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import random
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import click
+
+
+SYNTHETIC_WORDS = (
+    "village forest river mountain old young woman man spirit whisper ancient secret light shadow "
+    "journey home family heart storm sea wind village elder legend dream courage hope fear night "
+    "morning path stone tree song memory promise market festival lantern bridge garden"
+).split()
+SYNTHETIC_NAMES = ["Elin", "Amina", "Li Mei", "Kofi", "Sofia", "Arjun", "Mateo", "Leila", "Unknown"]
+PLOT_SLOTS = ['setting', 'instigating_event', 'quest_giver', 'opponent', 'resolution', 'outcome']
+STREAM_CHUNK_WORDS = 3  # Words per chunk of a streamed reply
+
+
+def parse_latency(spec):
+    """
+    Turn a latency spec into a function returning a delay in seconds.
+
+    Supported specs: 'fixed:S', 'uniform:LOW,HIGH', 'normal:MEAN,SD', 'lognormal:MU,SIGMA'
+    and 'exponential:MEAN', all in seconds (lognormal parameters are those of the underlying normal).
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(values[0], values[1])
+    if kind == "exponential":
+        return lambda: random.expovariate(1 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def format_reset(seconds):
+    """
+    Format a reset time the way the x-ratelimit-reset-* headers do, e.g. '20ms', '1s' or '6m0s'.
+    """
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}m{seconds:.0f}s" if minutes else f"{seconds:.0f}s"
+
+
+def count_tokens(text):
+    """
+    Rough token count (about 4 characters per token), good enough for usage numbers and rate limits.
+    """
+    return max(1, len(text) // 4)
+
+
+class MockBehaviour:
+    """
+    Settings and shared state of a mock server: latency, error injection, rate limits and reply texts.
+    """
+
+    def __init__(self, latency="fixed:0", error_rate_429=0.0, error_rate_5xx=0.0, rpm=None, tpm=None,
+                 corpus_dir=None, seed=None, chunk_delay=0.0):
+        self.latency = parse_latency(latency)
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.chunk_delay = chunk_delay  # Seconds between the chunks of a streamed reply
+        self.rpm = rpm
+        self.tpm = tpm
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = deque()  # (timestamp, tokens) of requests in the last minute
+        self.stats = {'requests': 0, 'ok': 0, '429': 0, '5xx': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self.canned = load_canned_replies(corpus_dir) if corpus_dir else None
+
+    def check_rate_limit(self, tokens):
+        """
+        Record a request against the one-minute window. Returns the rate-limit headers, whether the
+        request is over the requests or tokens per minute limit, and the seconds until the window frees up.
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0][0] >= 60:
+                self.window.popleft()
+            used_requests = len(self.window)
+            used_tokens = sum(t for _, t in self.window)
+            limited = (self.rpm is not None and used_requests + 1 > self.rpm) or \
+                      (self.tpm is not None and used_tokens + tokens > self.tpm)
+            if not limited:
+                self.window.append((now, tokens))
+                used_requests += 1
+                used_tokens += tokens
+            reset = 60 - (now - self.window[0][0]) if self.window else 0.0
+
+        headers = {}
+        if self.rpm is not None:
+            headers['x-ratelimit-limit-requests'] = str(self.rpm)
+            headers['x-ratelimit-remaining-requests'] = str(max(0, self.rpm - used_requests))
+            headers['x-ratelimit-reset-requests'] = format_reset(reset)
+        if self.tpm is not None:
+            headers['x-ratelimit-limit-tokens'] = str(self.tpm)
+            headers['x-ratelimit-remaining-tokens'] = str(max(0, self.tpm - used_tokens))
+            headers['x-ratelimit-reset-tokens'] = format_reset(reset)
+        return headers, limited, reset
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def reply(self, prompt, max_tokens=None):
+        """
+        Pick a reply for a prompt: a name, a 50 word summary, the plot structure of a batch of stories
+        (JSON) or a story of the requested length.
+        """
+        if "plot structure" in prompt:
+            return json.dumps({'stories': [self.plot_structure(story_id)
+                                           for story_id in re.findall(r"^Story_ID: (\S+)$", prompt, re.MULTILINE)]})
+        if "name of the main character" in prompt:
+            pool = self.canned['names'] if self.canned else SYNTHETIC_NAMES
+            return self.random.choice(pool)
+        if "plot summary" in prompt:
+            if self.canned and self.canned['summaries']:
+                return self.random.choice(self.canned['summaries'])
+            return self.synthesize(50)
+        if self.canned and self.canned['stories']:
+            text = self.random.choice(self.canned['stories'])
+        else:
+            match = re.search(r"(\d+) word", prompt)
+            text = self.synthesize(int(match.group(1)) if match else 1500, title=True)
+        if max_tokens:
+            text = text[:max_tokens * 4]
+        return text
+
+    def plot_structure(self, story_id):
+        names = self.canned['names'] if self.canned else SYNTHETIC_NAMES
+        slots = {slot: " ".join(self.random.choices(SYNTHETIC_WORDS[:12], k=2)) for slot in PLOT_SLOTS}
+        return {'Story_ID': story_id, 'protagonist': self.random.choice(names), **slots}
+
+    def synthesize(self, word_count, title=False):
+        words = self.random.choices(SYNTHETIC_WORDS, k=word_count)
+        sentences = [" ".join(words[i:i + 12]).capitalize() + "." for i in range(0, word_count, 12)]
+        body = " ".join(sentences)
+        if title:
+            return f"**Title: The {self.random.choice(SYNTHETIC_WORDS).title()} of the {self.random.choice(SYNTHETIC_WORDS).title()}**\n\n{body}"
+        return body
+
+
+def load_canned_replies(corpus_dir):
+    """
+    Read stories, summaries and protagonist names from an existing corpus to replay as replies.
+    """
+    import pandas as pd
+
+    stories, summaries, names = [], [], []
+    for country in sorted(os.listdir(corpus_dir)):
+        base = f"{corpus_dir}/{country}/{country}"
+        if os.path.exists(f"{base}_stories.csv"):
+            stories.extend(pd.read_csv(f"{base}_stories.csv", usecols=['Story'])['Story'].dropna().astype(str))
+        if os.path.exists(f"{base}_summaries.csv"):
+            summaries.extend(pd.read_csv(f"{base}_summaries.csv", usecols=['Summaries'])['Summaries'].dropna().astype(str))
+        if os.path.exists(f"{base}_names.csv"):
+            names.extend(pd.read_csv(f"{base}_names.csv")['Name'].dropna().astype(str))
+    return {'stories': stories, 'summaries': summaries, 'names': names or SYNTHETIC_NAMES}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    behaviour = None  # Set by make_server
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # Keep the console quiet under load
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self.send_json(200, self.behaviour.stats)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        self.chat_completion(request)
+
+    def chat_completion(self, request):
+        behaviour = self.behaviour
+        behaviour.count('requests')
+        time.sleep(behaviour.latency())
+
+        messages = request.get("messages", [])
+        prompt = messages[-1]["content"] if messages else ""
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+        max_tokens = request.get("max_tokens") or request.get("max_completion_tokens")
+        headers, limited, reset = behaviour.check_rate_limit(prompt_tokens + (max_tokens or 0))
+
+        roll = behaviour.random.random()
+        if limited or roll < behaviour.error_rate_429:
+            behaviour.count('429')
+            headers['retry-after'] = str(max(1, math.ceil(reset))) if limited else "1"
+            self.send_json(429, {"error": {"message": "Rate limit reached (mock server)", "type": "requests",
+                                           "code": "rate_limit_exceeded"}}, headers)
+            return
+        if roll < behaviour.error_rate_429 + behaviour.error_rate_5xx:
+            behaviour.count('5xx')
+            self.send_json(behaviour.random.choice([500, 502, 503]),
+                           {"error": {"message": "The server had an error (mock server)", "type": "server_error"}}, headers)
+            return
+
+        content = behaviour.reply(prompt, max_tokens)
+        completion_tokens = count_tokens(content)
+        behaviour.count('ok')
+        behaviour.count('prompt_tokens', prompt_tokens)
+        behaviour.count('completion_tokens', completion_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage", False)
+            self.send_stream(request.get("model", "mock"), content, usage if include_usage else None, headers)
+            return
+        self.send_json(200, {
+            "id": f"chatcmpl-mock-{behaviour.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        }, headers)
+
+    def send_stream(self, model, content, usage=None, headers=None):
+        """
+        Send a reply as server-sent events, a few words per chunk like the real API, then the usage
+        chunk (if asked for with stream_options) and [DONE].
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")  # The end of the stream is the end of the connection
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.close_connection = True
+
+        base = {"id": f"chatcmpl-mock-{self.behaviour.stats['requests']}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model}
+        pieces = re.findall(r"\S+\s*", content)
+        deltas = [{"role": "assistant", "content": ""}] + [{"content": "".join(pieces[i:i + STREAM_CHUNK_WORDS])}
+                                                           for i in range(0, len(pieces), STREAM_CHUNK_WORDS)]
+        events = [dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": None}]) for delta in deltas]
+        events.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if usage is not None:
+            events.append(dict(base, choices=[], usage=usage))
+        for event in events:
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.behaviour.chunk_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def make_server(host="127.0.0.1", port=8000, **behaviour):
+    """
+    Create (but do not start) a mock server. Use port 0 to pick a free port.
+
+    Keyword arguments are passed on to MockBehaviour. The base URL to give the OpenAI client is
+    f"http://{host}:{server.server_address[1]}/v1".
+    """
+    handler = type("BoundMockHandler", (MockHandler,), {"behaviour": MockBehaviour(**behaviour)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(**kwargs):
+    """
+    Start a mock server on a free port in a daemon thread and return (server, base_url).
+    """
+    server = make_server(port=0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/v1"
+
+
+@click.command()
+@click.option('--host', default="127.0.0.1", show_default=True)
+@click.option('--port', type=int, default=8000, show_default=True)
+@click.option('--latency', default="fixed:0", show_default=True, help="fixed:S, uniform:LOW,HIGH, normal:MEAN,SD, lognormal:MU,SIGMA or exponential:MEAN (seconds)")
+@click.option('--error-rate-429', type=float, default=0.0, show_default=True, help='Fraction of requests answered with 429')
+@click.option('--error-rate-5xx', type=float, default=0.0, show_default=True, help='Fraction of requests answered with 500/502/503')
+@click.option('--rpm', type=int, default=None, help='Requests per minute before answering 429')
+@click.option('--tpm', type=int, default=None, help='Tokens per minute before answering 429')
+@click.option('--corpus', 'corpus_dir', type=click.Path(exists=True, file_okay=False), default=None, help='Replay stories, summaries and names from this data directory instead of synthesizing them')
+@click.option('--chunk-delay', type=float, default=0.0, show_default=True, help='Seconds between the chunks of a streamed reply')
+@click.option('--seed', type=int, default=None)
+def cli(host, port, latency, error_rate_429, error_rate_5xx, rpm, tpm, corpus_dir, chunk_delay, seed):
+    """Run a local OpenAI-compatible chat completions server."""
+    server = make_server(host, port, latency=latency, error_rate_429=error_rate_429, error_rate_5xx=error_rate_5xx,
+                         rpm=rpm, tpm=tpm, corpus_dir=corpus_dir, seed=seed, chunk_delay=chunk_delay)
+    print(f"Mock OpenAI server listening on http://{host}:{server.server_address[1]}/v1 (stats at /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    cli()
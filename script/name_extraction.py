@@ -1,9 +1,14 @@
 import pandas as pd
 import openai
 import os
+import paths
+import instrumentation
+import token_usage
+import openai_client
+from time import perf_counter
 from dotenv import load_dotenv
-from collections import Counter
-import re
+
+GPT_MODEL = "gpt-4o-mini"
 
 
 def load_api_key():
@@ -18,6 +23,11 @@ def load_api_key():
     
     openai.api_key = api_key
 
+    # Send requests somewhere else than api.openai.com, e.g. the local mock_openai_server.py
+    base_url = os.getenv("OPENAI_BASE_URL")
+    if base_url:
+        openai.base_url = base_url.rstrip("/") + "/"
+
 
 def initiate_chat():
     
@@ -58,29 +68,28 @@ def analyze_stories(countries):
         with the original stories and identified names/places.
     """
     
-    filepath = f"../data/{countries}/{countries}_stories.csv"
+    filepath = paths.country_file(countries, "stories")
     print(f'Extracting main character names from {filepath}...\n')
     
-    results_names = []
     df = pd.read_csv(filepath)
 
-    for index, row in df.iterrows():
-        story = row['Story']
-        print(f"•Processing story {index + 1} of {len(df)}...")
+    # Names found by an earlier run that ran out of budget
+    finished = load_checkpoint(countries)
 
-        main_char_prompt = f"Identify the name of the main character and only the name of the main character in this story:\n\n{story}"
-
-        # Get main character name
-        messages = initiate_chat()
-        messages.append({"role": "user", "content": main_char_prompt})
-        main_char_response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.8,
-            max_tokens=50,
-        )
-        main_char = main_char_response.choices[0].message.content.strip()
-        results_names.append(main_char)
+    def extract_name(index):
+        story_id = df.iloc[index, 0]
+        print(f"•Processing story {index + 1} of {len(df)}...")
+        return story_id, extract_main_character(countries, story_id, df['Story'].iloc[index])
+
+    # Ask about the stories not finished yet, several at a time (see openai_client.py)
+    todo = [index for index, story_id in enumerate(df.iloc[:, 0]) if story_id not in finished]
+    try:
+        for _, (story_id, main_char) in openai_client.map(extract_name, todo):
+            finished[story_id] = main_char
+    except token_usage.BudgetExhausted:
+        save_checkpoint(countries, finished)
+        raise
+    results_names = [finished[story_id] for story_id in df.iloc[:, 0]]
 
     # Add results to DataFrame
     df['Name'] = results_names
@@ -88,46 +97,114 @@ def analyze_stories(countries):
     return df
 
 
+def extract_main_character(dir, story_id, story, ledger_id=None):
+    """
+    Ask gpt-4o-mini for the name of the main character of one story, logging the request in the
+    country's token usage ledger under ledger_id (the story_id by default).
+    """
+    main_char_prompt = f"Identify the name of the main character and only the name of the main character in this story:\n\n{story}"
+
+    # Get main character name
+    messages = initiate_chat()
+    messages.append({"role": "user", "content": main_char_prompt})
+
+    token_usage.before_request("names", dir)
+    start = perf_counter()
+    main_char_response = openai_client.create(
+        model=GPT_MODEL,
+        messages=messages,
+        temperature=0.8,
+        max_tokens=50,
+    )
+    instrumentation.record_api_call(perf_counter() - start, main_char_response.usage)
+    instrumentation.add_items()
+    token_usage.record("names", dir, ledger_id or story_id, GPT_MODEL, main_char_response.usage)
+    return main_char_response.choices[0].message.content.strip()
+
+
+def load_checkpoint(dir):
+    """
+    The replies (Story_ID -> name) finished by an earlier run that ran out of budget.
+    """
+    done = token_usage.load_checkpoint(dir, "names")
+    return dict(zip(done['Story_ID'], done['Name'])) if done is not None else {}
+
+
+def save_checkpoint(dir, finished):
+    token_usage.save_checkpoint(dir, "names", pd.DataFrame({'Story_ID': list(finished), 'Name': list(finished.values())}))
 
-def count_names(dict_with_names):
+
+
+# Separators between the names in a reply: commas, list numbers ("1. "), and anything that is not a
+# letter or whitespace (so "Li Mei and Sung Lee" stays one name, but "Elin/Astrid" are two)
+NAME_SEPARATORS = r",|\d+\.\s*|(?:[^\w\s]|[\d_])+"
+
+
+def split_names(replies):
     """
-    Counts occurrences of names in the 'Name' column across multiple DataFrames.
+    Split the model's replies into one row per name, with vectorized string operations.
 
     Parameters
     ----------
-    dataframes : dict
-        A dictionary of DataFrames where the 'Name' column contains names to count.
+    replies : pandas.Series
+        The reply for each story (one or more names).
 
     Returns
     -------
-    dict
-        A dictionary where keys are filenames and values are DataFrames with name counts.
+    pandas.Series
+        One name per row, with the index of the reply it came from. Whitespace is normalized,
+        and empty names are dropped.
     """
+    names = replies.fillna("").astype(str).str.split(NAME_SEPARATORS, regex=True).explode()
+    names = names.str.replace(r"\s+", " ", regex=True).str.strip()
+    return names[names != ""]
 
-    names = []
-    
-    for name_list in dict_with_names['Name']:
-        split_names = re.split(r',|\d+\.\s*|[^a-zA-Z\s]+', name_list)
-        names.extend([name.strip() for name in split_names if name.strip()])
 
-    name_counts = Counter(names)
+def story_names(df):
+    """
+    The names found in each story: one row per (Story_ID, Name).
+    """
+    names = split_names(df['Name'])
+    return pd.DataFrame({'Story_ID': df['Story_ID'].loc[names.index].to_numpy(), 'Name': names.to_numpy()})
+
+
+def count_names(dict_with_names):
+    """
+    Counts occurrences of names in the 'Name' column.
+
+    Parameters
+    ----------
+    dict_with_names : pandas.DataFrame
+        A DataFrame whose 'Name' column contains the names found in each story.
 
-    # Create a new DataFrame for counts
-    counts_df = pd.DataFrame(name_counts.items(), columns=['Name', 'Count']).sort_values(by='Count', ascending=False)
-    return counts_df
+    Returns
+    -------
+    pandas.DataFrame
+        'Name' and 'Count', most common first.
+    """
+    counts = split_names(dict_with_names['Name']).value_counts()
+    return pd.DataFrame({'Name': counts.index, 'Count': counts.to_numpy()})
 
 
 def analyse_and_save(dir):
-    analyzed_dataframe = analyze_stories(dir)
-    
+    save_names(dir, analyze_stories(dir))
+
+
+def save_names(dir, analyzed_dataframe):
+    """
+    Save the name counts and the names of each story of a DataFrame with a 'Name' column, and drop the checkpoint.
+    """
     # Count names in the analyzed DataFrames
     name_count = count_names(analyzed_dataframe)
-    output_filepath = f"../data/{dir}/{dir}_names.csv"
+    output_filepath = paths.country_file(dir, "names")
 
     print(f"\nTop results for {output_filepath}:\n")
     print(f'{name_count.head()}')  # Display top counts for each file
 
     name_count.to_csv(output_filepath, index=False)
+    # The names of each story, for the name analyses across countries (analysis/script/names.py)
+    story_names(analyzed_dataframe).to_csv(paths.country_file(dir, "story_names"), index=False)
+    token_usage.clear_checkpoint(dir, "names")
     print(f'\nMain character names saved to {output_filepath}\n\n--------------------\n')
 
 
@@ -137,19 +214,19 @@ def main(countries, startfrom):
     load_api_key()
 
     if 'all' in countries and len(countries) == 1:
-        for dir in sorted(os.listdir("../data")):
-            if dir == '.DS_Store':
-                continue
+        for dir in paths.list_country_dirs():
             if startfrom != "" and startfrom != dir:
                 continue
             else:
                 startfrom = ""
-                analyse_and_save(dir)
+                with instrumentation.stage("names", dir):
+                    analyse_and_save(dir)
     
     else:
-        for dir in sorted(os.listdir("../data")):
+        for dir in paths.list_country_dirs():
             if dir in countries:
-                analyse_and_save(dir)
+                with instrumentation.stage("names", dir):
+                    analyse_and_save(dir)
 
 
 
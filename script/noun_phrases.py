@@ -1,7 +1,7 @@
 import pandas as pd
-from textblob import TextBlob
 from collections import Counter
-import os
+import paths
+import instrumentation
 
 def extract_noun_phrases(dir):
     """
@@ -15,12 +15,15 @@ def extract_noun_phrases(dir):
         pd.DataFrame: DataFrame containing filtered noun phrases and their counts.
     """
 
-    filepath = f'../data/{dir}/{dir}_stories.csv'
+    from textblob import TextBlob  # Slow to import, so only imported when noun phrases are extracted
+
+    filepath = paths.country_file(dir, "stories")
     print(f'Extracting noun phrases from {filepath}...\n')
     
     df = pd.read_csv(filepath)
     # Extract stories from the fifth column
     stories = df.iloc[:, 4].tolist()  # Adjust if the column index is different
+    instrumentation.add_items(len(stories))
 
     # Extract noun phrases 
     noun_phrases = []
@@ -44,7 +47,7 @@ def extract_noun_phrases(dir):
     print(f'{output_df.head()}')  # Display top counts for each file
 
     # Location and name of output file
-    output_filepath = f'../data/{dir}/{dir}_noun_phrases.csv'
+    output_filepath = paths.country_file(dir, "noun_phrases")
     output_df.to_csv(output_filepath, index=False)
     print(f'\nNoun phrases saved to {output_filepath}\n\n--------------------\n')
 
@@ -57,18 +60,18 @@ def main(countries, startfrom):
     """
     
     if 'all' in countries and len(countries) == 1:
-        for dir in sorted(os.listdir("../data")):
-            if dir == '.DS_Store':
-                continue
+        for dir in paths.list_country_dirs():
             if startfrom != "" and startfrom != dir:
                 continue
             else:
                 startfrom = ""
-                extract_noun_phrases(dir)
+                with instrumentation.stage("nouns", dir):
+                    extract_noun_phrases(dir)
     else:
-        for dir in sorted(os.listdir("../data")):
+        for dir in paths.list_country_dirs():
             if dir in countries:
-                extract_noun_phrases(dir)
+                with instrumentation.stage("nouns", dir):
+                    extract_noun_phrases(dir)
 
                 
         
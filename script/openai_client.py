@@ -0,0 +1,483 @@
+"""
+The shared layer between the stage scripts and the OpenAI API: rate limiting, adaptive
+concurrency, retries and a circuit breaker around chat.completions.create.
+
+- Two token buckets keep to the requests and tokens per minute. They start from story_cli --rpm and
+  --tpm (or unlimited) and are re-seeded from the x-ratelimit-* headers of every response, so they
+  follow the account's limits without manual tuning. When a limit is used up (or a 429 asks to retry
+  later) no request is sent until it resets.
+- The number of requests in flight is adjusted AIMD-style: every success raises the limit by
+  1/limit (about one more request per round), every 429 halves it.
+- 429s, timeouts, connection errors and 5xx are retried up to max_attempts times, after a
+  jittered exponential backoff (and never sooner than the retry-after header asks).
+- After failure_threshold failed requests in a row (not counting 429s) the circuit opens: nothing is
+  sent for cooldown seconds, then one trial request decides whether it closes again.
+
+The stages send their requests with map(), which runs them in a thread pool and yields the results
+as they finish, and create() (or stream_to(), for a completion streamed into a file), which does
+the limiting and retrying.
+"""
+
+import re
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, CancelledError
+import openai
+
+# Errors worth retrying: everything else (bad request, authentication, ...) fails at once
+RETRYABLE = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+# Completion tokens assumed for a request without max_tokens, until the replies show how long they are
+DEFAULT_COMPLETION_TOKENS = 2000
+
+_controller = None
+
+
+def parse_reset(value):
+    """
+    Seconds until a rate limit resets, from an x-ratelimit-reset-* header ('20ms', '1s', '6m0s'), or None.
+    """
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or "")
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+def retry_after_seconds(headers):
+    """
+    The seconds of a retry-after header, or None.
+    """
+    try:
+        return float(headers.get("retry-after")) if headers is not None and headers.get("retry-after") else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """
+    A per-minute limit (of requests or tokens). Without a limit every reservation passes at once.
+
+    Reservations may take the bucket below zero: the caller then waits until the refill has paid
+    the debt back, so concurrent callers queue up in order without a lock held while waiting. The
+    reservations of requests still in flight are kept apart, as the API's remaining counts do not
+    include them yet.
+    """
+
+    def __init__(self, per_minute=None):
+        self.lock = threading.Lock()
+        self.capacity = None
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.outstanding = 0.0
+        if per_minute:
+            self.set_limit(per_minute)
+
+    def set_limit(self, per_minute):
+        with self.lock:
+            self.refill()
+            if self.capacity is None:
+                self.level = float(per_minute)
+            self.capacity = float(per_minute)
+            self.level = min(self.level, self.capacity)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount):
+        """
+        Take amount from the bucket, but no more than its capacity, so a request larger than the
+        limit still gets through once the bucket is full.
+
+        Returns
+        -------
+        tuple of (float, tuple)
+            The seconds to wait before using it, and the reservation to settle(): the amount and
+            what was actually taken from the bucket.
+        """
+        with self.lock:
+            self.outstanding += amount
+            if self.capacity is None:
+                return 0.0, (amount, 0.0)
+            self.refill()
+            debited = min(amount, self.capacity)
+            self.level -= debited
+            return max(0.0, -self.level * 60 / self.capacity, self.paused_until - self.updated), (amount, debited)
+
+    def pause(self):
+        """
+        Seconds until the limit resets, while it is paused.
+        """
+        with self.lock:
+            return max(0.0, self.paused_until - time.monotonic())
+
+    def pause_for(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def settle(self, reservation, used):
+        """
+        Close a reservation once its request has finished, returning what was taken for it and it
+        did not use (or taking what it used beyond it).
+        """
+        amount, debited = reservation
+        with self.lock:
+            self.outstanding -= amount
+            if self.capacity is not None:
+                self.level = min(self.capacity, self.level + debited - used)
+
+    def seed(self, limit, remaining, reset=None, counted=0.0):
+        """
+        Adopt the limit and remaining amount reported by the API. With nothing remaining, nothing is
+        let through before the limit resets (in reset seconds); the bucket keeps filling meanwhile.
+
+        counted is the part of the outstanding reservations that remaining already includes: that
+        of the request whose response reported it.
+        """
+        self.set_limit(limit)
+        with self.lock:
+            self.level = min(self.level, float(remaining) - (self.outstanding - counted))
+        if remaining <= 0 and reset:
+            self.pause_for(reset)
+
+
+class AdaptiveConcurrency:
+    """
+    The number of requests allowed in flight, with additive increase and multiplicative decrease.
+    """
+
+    def __init__(self, initial=2, maximum=8):
+        self.condition = threading.Condition()
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome):
+        """
+        outcome is 'success', 'throttled' (a 429) or 'error' (which leaves the limit as it is).
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == 'success':
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif outcome == 'throttled':
+                self.limit = max(1.0, self.limit / 2)
+            self.condition.notify_all()
+
+
+class CircuitBreaker:
+    """
+    Stops all requests for cooldown seconds after failure_threshold failures in a row (an outage rather than throttling).
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def wait(self):
+        """
+        Return once a request may be sent: at once while the circuit is closed, and for a single
+        trial request once the cooldown of an open circuit has passed.
+
+        Returns
+        -------
+        bool
+            Whether the request is the trial. Its sender must call success() or failure() whatever
+            the request's outcome, or the circuit stays half-open and no request is sent again.
+        """
+        while True:
+            with self.lock:
+                if self.opened_at is None:
+                    return False
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining <= 0 and not self.trial:
+                    self.trial = True
+                    return True
+            time.sleep(max(remaining, 0.1))
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    print(f"  {self.failures} failed requests in a row, pausing requests for {self.cooldown:.0f}s")
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+class RateController:
+    """
+    Sends chat completion requests within the rate limits, retrying the ones that fail.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        Most requests in flight (and threads in map()).
+    initial_concurrency : int
+        Requests in flight to start with, before AIMD adjusts it.
+    rpm, tpm : int, optional
+        Requests and tokens per minute to keep to until the API reports its limits.
+    max_attempts : int
+        Attempts per request, including the first.
+    base_delay, max_delay : float
+        The backoff before retry n is drawn uniformly from 0 to min(max_delay, base_delay * 2**(n-1)) seconds.
+    failure_threshold, cooldown :
+        See CircuitBreaker.
+    timeout : float
+        Seconds before a request times out (and is retried).
+    seed : int, optional
+        Seed of the backoff jitter.
+    """
+
+    def __init__(self, max_concurrency=8, initial_concurrency=2, rpm=None, tpm=None, max_attempts=6,
+                 base_delay=1.0, max_delay=60.0, failure_threshold=5, cooldown=30.0, timeout=120.0, seed=None):
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'errors': 0}
+        self.completion_tokens = float(DEFAULT_COMPLETION_TOKENS)  # Moving average of the replies
+        self.client = None
+
+    def get_client(self):
+        # Created on first use, after the stage's load_api_key() has set the key and base URL.
+        # The client's own retries are turned off, the controller does the retrying.
+        if self.client is None:
+            self.client = openai.OpenAI(api_key=openai.api_key, base_url=openai.base_url,
+                                        max_retries=0, timeout=self.timeout)
+        return self.client
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def estimate_tokens(self, request):
+        prompt = sum(len(message.get("content") or "") for message in request.get("messages", [])) // 4
+        return prompt + (request.get("max_tokens") or int(self.completion_tokens))
+
+    def update_limits(self, headers, counted=(0, 0)):
+        """
+        Re-seed the buckets from the x-ratelimit-* headers of a response. counted is the requests
+        and tokens of the response's own request that are still reserved, which the API's remaining
+        counts already include.
+        """
+        if headers is None:
+            return
+        for kind, bucket, own in (('requests', self.requests, counted[0]), ('tokens', self.tokens, counted[1])):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit and remaining:
+                bucket.seed(int(limit), int(remaining), parse_reset(headers.get(f"x-ratelimit-reset-{kind}")), own)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Seconds to wait before retry number attempt: full jitter, but at least retry_after.
+        """
+        delay = self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0.0)
+
+    def create(self, **request):
+        """
+        openai.chat.completions.create(**request), within the limits and with retries.
+
+        Raises the last error once max_attempts attempts have failed, and errors that are not
+        worth retrying at once.
+        """
+        def read(raw):
+            response = raw.parse()
+            return response, response.usage
+        return self.send(request, read)
+
+    def stream_to(self, file_path, **request):
+        """
+        Stream a completion into file_path as it arrives, within the limits and with retries.
+
+        The file is flushed after every chunk, so an interrupted run leaves the text received so far.
+        A stream that breaks off is requested again from the start, overwriting the file.
+
+        Returns
+        -------
+        openai.types.CompletionUsage or None
+            The token usage of the completion.
+        """
+        def read(raw):
+            usage = None
+            with open(file_path, 'w', encoding="utf-8") as f:
+                try:
+                    for chunk in raw.parse():
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            f.write(chunk.choices[0].delta.content)
+                            f.flush()
+                        if chunk.usage is not None:
+                            usage = chunk.usage
+                except (openai.APIError, OSError):
+                    raise
+                except Exception as e:
+                    # The stream broke off, raised as the HTTP library's own error
+                    raise openai.APIConnectionError(message=f"Stream interrupted: {e}", request=raw.http_request) from e
+            return usage, usage
+        return self.send(dict(request, stream=True, stream_options={"include_usage": True}), read)
+
+    def send(self, request, read):
+        """
+        Send a request and read its response with read(raw response) -> (result, usage), retrying
+        both. Returns the result.
+        """
+        estimate = self.estimate_tokens(request)
+        for attempt in range(1, self.max_attempts + 1):
+            trial = self.breaker.wait()
+            outcome = None
+            try:
+                outcome, result = self.attempt(request, read, estimate)
+            finally:
+                if outcome == 'success':
+                    self.breaker.success()
+                elif outcome == 'error' or trial:
+                    # 429s only mean slowing down, which the limits take care of. But whatever ends
+                    # the trial request other than a success (a 429, an error that is not retried,
+                    # an interrupt) opens the circuit again, or no request would ever be sent again.
+                    self.breaker.failure()
+            if outcome == 'success':
+                return result
+            error, retry_after = result
+            if attempt == self.max_attempts:
+                raise error
+            self.count('retries')
+            time.sleep(self.backoff(attempt, retry_after))
+
+    def attempt(self, request, read, estimate):
+        """
+        Send a request once, within the limits.
+
+        Returns
+        -------
+        tuple
+            ('success', result), or ('throttled' or 'error', (error, retry_after)) for an error worth retrying.
+        """
+        self.concurrency.acquire()
+        requests_wait, requests_reserved = self.requests.reserve(1)
+        tokens_wait, tokens_reserved = self.tokens.reserve(estimate)
+        time.sleep(max(requests_wait, tokens_wait))
+        # A response received meanwhile may have paused the limits
+        time.sleep(max(self.requests.pause(), self.tokens.pause()))
+        self.count('requests')
+        try:
+            raw = self.get_client().chat.completions.with_raw_response.create(**request)
+            self.update_limits(raw.headers, counted=(1, estimate))
+            result, usage = read(raw)
+        except RETRYABLE as e:
+            throttled = isinstance(e, openai.RateLimitError)
+            self.count('throttled' if throttled else 'errors')
+            self.concurrency.release('throttled' if throttled else 'error')
+            # A failed request uses none of the limits
+            self.requests.settle(requests_reserved, 0)
+            self.tokens.settle(tokens_reserved, 0)
+            headers = getattr(getattr(e, 'response', None), 'headers', None)
+            self.update_limits(headers)
+            retry_after = retry_after_seconds(headers)
+            if throttled and retry_after:
+                # The API asks everyone to wait, not only this request
+                self.requests.pause_for(retry_after)
+                self.tokens.pause_for(retry_after)
+            return ('throttled' if throttled else 'error'), (e, retry_after)
+        except BaseException:
+            self.concurrency.release('error')
+            self.requests.settle(requests_reserved, 0)
+            self.tokens.settle(tokens_reserved, 0)
+            raise
+        self.concurrency.release('success')
+        self.requests.settle(requests_reserved, 1)
+        if usage is not None:
+            self.tokens.settle(tokens_reserved, usage.total_tokens)
+            if not request.get("max_tokens"):
+                with self.lock:
+                    self.completion_tokens += 0.2 * (usage.completion_tokens - self.completion_tokens)
+        else:
+            self.tokens.settle(tokens_reserved, estimate)
+        return 'success', result
+
+    def map(self, function, items):
+        """
+        Call function(item) for every item in a thread pool, and yield (item, result) as the calls finish.
+
+        The requests the calls send go through create(), which keeps to the adaptive number of
+        requests in flight. If a call raises, the calls not started yet are cancelled, and the
+        error is raised once the calls in progress have finished (their results are yielded first,
+        so a stage can checkpoint them). An interrupt (Ctrl-C) also cancels the calls not started yet.
+        """
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(function, item): item for item in items}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except CancelledError:
+                        continue
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                            for other in futures:
+                                other.cancel()
+                        continue
+                    yield futures[future], result
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        if error is not None:
+            raise error
+
+
+def configure(**options):
+    """
+    Set up the controller the stages use (story_cli --max-concurrency, --rpm, --tpm). See RateController.
+    """
+    global _controller
+    _controller = RateController(**options)
+    return _controller
+
+
+def controller():
+    global _controller
+    if _controller is None:
+        _controller = RateController()
+    return _controller
+
+
+def create(**request):
+    return controller().create(**request)
+
+
+def map(function, items):
+    return controller().map(function, items)
+
+
+def stream_to(file_path, **request):
+    return controller().stream_to(file_path, **request)
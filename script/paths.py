@@ -0,0 +1,51 @@
+import os
+import contextlib
+
+# Root directory holding one sub-directory per country (named by alpha-2 code).
+# The scripts are run from the script folder, so the default is relative to it.
+# Change it with set_data_dir() (e.g. to point the pipeline at a synthetic corpus).
+DATA_DIR = "../data"
+
+
+def set_data_dir(path):
+    """
+    Point every stage at a different data directory.
+    """
+    global DATA_DIR
+    DATA_DIR = path
+
+
+@contextlib.contextmanager
+def use_data_dir(path):
+    """
+    Point every stage at a different data directory inside a with block, e.g. one cell of an experiment grid.
+    """
+    global DATA_DIR
+    previous = DATA_DIR
+    DATA_DIR = path
+    try:
+        yield path
+    finally:
+        DATA_DIR = previous
+
+
+def country_dir(country_code):
+    """
+    Return the directory holding the files for a country, e.g. ../data/NO
+    """
+    return f"{DATA_DIR}/{country_code}"
+
+
+def country_file(country_code, kind, ext="csv"):
+    """
+    Return the path of a per-country file, e.g. country_file("NO", "stories") -> ../data/NO/NO_stories.csv
+    """
+    return f"{DATA_DIR}/{country_code}/{country_code}_{kind}.{ext}"
+
+
+def list_country_dirs():
+    """
+    Return the sorted country directories in DATA_DIR, skipping files such as .DS_Store and hidden
+    directories such as the work queue (.queue).
+    """
+    return sorted(d for d in os.listdir(DATA_DIR) if os.path.isdir(os.path.join(DATA_DIR, d)) and not d.startswith("."))
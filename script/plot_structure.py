@@ -0,0 +1,331 @@
+"""
+Extract the plot structure of every story: the slots of the story flowchart (setting, protagonist,
+instigating event, quest giver, opponent, resolution and outcome), one record per story.
+
+Two engines fill the slots:
+- 'gpt' sends BATCH_SIZE stories per request and asks for a JSON object with the slots of each
+- 'heuristic' is a local stand-in that needs no API: keyword rules on the opening, middle and end
+  of each story, with the protagonist taken from <CC>_story_names.csv when the names stage has run
+
+The records are saved to <CC>_plot_structure.csv with a hash of the engine and the story text. They
+are the cache: a story whose hash is already in the file is not sent again, so rerunning the stage
+after adding stories (or switching engines) only extracts the new or changed stories. The story
+graphs per country and region are built from these records by analysis/script/story_graphs.py.
+"""
+
+import re
+import json
+import hashlib
+import pandas as pd
+import paths
+import instrumentation
+import token_usage
+import openai_client
+from time import perf_counter
+from datetime import date
+from summary_gen import load_api_key
+
+SLOTS = ['setting', 'protagonist', 'instigating_event', 'quest_giver', 'opponent', 'resolution', 'outcome']
+UNKNOWN = "unknown"
+
+MODEL = "gpt-4o-mini"
+BATCH_SIZE = 5
+
+# Bump when the prompt or the rules change, to extract every story again
+PROMPT_VERSION = 1
+RULES_VERSION = 1
+
+PROMPT = """Identify the plot structure of each story below. For every story, give a short lowercase label (at most five words) for each of these slots:
+- setting: where the story takes place, e.g. "village by the fjord"
+- protagonist: the name of the main character as written in the story, or "unknown"
+- instigating_event: what sets the story going, e.g. "returns home from the city"
+- quest_giver: who or what sends the protagonist on the quest, e.g. "guardian spirit"
+- opponent: who or what the protagonist is up against, e.g. "developers"
+- resolution: how the conflict is resolved, e.g. "organising community" or "coming to terms with self"
+- outcome: how the story ends, e.g. "village becomes a beacon of unity"
+Use the same label for the same thing in different stories. Reply with a JSON object {"stories": [{"Story_ID": ..., "setting": ..., ...}]} with one entry per story, in the same order."""
+
+# Heuristic engine: slot -> (label, pattern) rules, the first label whose pattern matches wins.
+# Each slot is looked for in one part of the story (see SLOT_PARTS).
+RULES = {
+    'setting': [
+        ("village by the fjord", r"\bfjords?\b"),
+        ("coastal village", r"\b(?:fishing|coastal|seaside) (?:village|town)|\b(?:village|town) (?:by|near|on) the (?:sea|coast|shore)"),
+        ("island", r"\bisland\b"),
+        ("desert", r"\bdeserts?\b|\boasis\b|\bdunes\b"),
+        ("mountain village", r"\bmountain (?:village|town)|\b(?:village|town)\b[^.]{0,60}\bmountains?\b|\bmountains?\b[^.]{0,60}\b(?:village|town)\b"),
+        ("forest village", r"\b(?:village|town)\b[^.]{0,60}\b(?:forest|woods)\b|\b(?:forest|woods)\b[^.]{0,60}\b(?:village|town)\b"),
+        ("city", r"\b(?:city|capital|metropolis)\b"),
+        ("village", r"\b(?:village|hamlet|town)\b"),
+    ],
+    'instigating_event': [
+        ("returns home", r"\breturn(?:s|ed|ing)? (?:home|to (?:the|her|his|their) (?:village|town|hometown|island))"),
+        ("discovers an object", r"\b(?:discover|found|find|stumble|unearth)\w*\b[^.]{0,80}\b(?:box|map|letter|book|lantern|key|journal|amulet|chest|artifact|artefact|stone|scroll)\b"),
+        ("natural disaster", r"\b(?:storm|drought|flood|earthquake|wildfire|hurricane|typhoon|cyclone)s?\b"),
+        ("meets a stranger", r"\b(?:stranger|traveler|traveller|visitor|newcomer)s?\b"),
+        ("has a dream", r"\b(?:dreams?|visions?)\b"),
+        ("festival", r"\b(?:festival|celebration|competition|contest)s?\b"),
+    ],
+    'quest_giver': [
+        ("guardian spirit", r"\b(?:spirits?|guardians?)\b"),
+        ("grandparent", r"\bgrand(?:mother|father|ma|pa)\b"),
+        ("elder", r"\belders?\b|\bold (?:man|woman)\b|\bwise (?:man|woman)\b"),
+        ("mentor", r"\b(?:mentor|teacher|shaman|healer|priest|monk)s?\b"),
+        ("magical creature", r"\b(?:dragon|fox|owl|wolf|creature|fairy|djinn|genie)s?\b"),
+        ("ancestors", r"\bancestors?\b"),
+    ],
+    'opponent': [
+        ("developers", r"\b(?:developers?|corporations?|compan(?:y|ies)|construction|logging|mining)\b"),
+        ("pollution", r"\bpollut\w*|\bwaste\b|\bplastic\b"),
+        ("extreme weather", r"\b(?:storm|drought|flood|hurricane|typhoon|cyclone|blizzard)s?\b"),
+        ("war", r"\bwars?\b|\bsoldiers?\b|\binvaders?\b"),
+        ("outsiders", r"\boutsiders?\b|\bstrangers\b"),
+        ("darkness", r"\bdarkness\b|\bshadows?\b|\bcurse[sd]?\b|\bevil\b"),
+        ("greed", r"\bgreed\w*"),
+        ("modernity", r"\bmodern\w*|\btechnology\b"),
+        ("self-doubt", r"\bdoubts?\b|\bfears?\b"),
+    ],
+    'outcome': [
+        ("unity", r"\bunity\b|\bunited\b"),
+        ("sustainability", r"\bsustainab\w*|\bharmony\b"),
+        ("tradition preserved", r"\btraditions?\b|\bheritage\b|\blegacy\b"),
+        ("courage", r"\bcourage\w*|\bbrave\w*"),
+        ("hope", r"\bhope\w*"),
+    ],
+}
+
+# Protagonist, when the names stage has not run: the first "... named Elin" in the opening
+NAMED = r"\b(?:named|called) ((?:[A-Z][\w'-]+)(?: [A-Z][\w'-]+)?)"
+
+# Resolution: the more common of the two kinds of words in the end of the story
+COMMUNITY_WORDS = r"\b(?:community|villagers|together|united|neighbou?rs|everyone)\b"
+PERSONAL_WORDS = r"\b(?:herself|himself|themselves|inner|within|courage|identity)\b"
+
+# Part of the story each slot is looked for in, as fractions of its length
+SLOT_PARTS = {
+    'setting': (0, 0.15),
+    'protagonist': (0, 0.35),
+    'instigating_event': (0, 0.35),
+    'quest_giver': (0.1, 0.6),
+    'opponent': (0.3, 0.8),
+    'resolution': (0.6, 1),
+    'outcome': (0.85, 1),
+}
+
+
+def engine_name(engine):
+    """
+    The name of an engine as recorded with each story, e.g. 'gpt-4o-mini/v1' or 'heuristic/v1'.
+    """
+    if engine == "heuristic":
+        return f"heuristic/v{RULES_VERSION}"
+    return f"{MODEL}/v{PROMPT_VERSION}"
+
+
+def story_hash(engine, story):
+    """
+    Hash of the engine and the story text, the key of the cached records.
+    """
+    return hashlib.sha256(f"{engine_name(engine)}\n{story}".encode("utf-8")).hexdigest()[:16]
+
+
+def clean_label(value, lower=True):
+    """
+    A slot value as a short label: whitespace collapsed, lowercase (except for names), 'unknown' if empty.
+    """
+    value = re.sub(r"\s+", " ", str(value or "")).strip(" .,;:'\"")
+    if lower or value.lower() in (UNKNOWN, "none"):
+        value = value.lower()
+    return value[:60] or UNKNOWN
+
+
+def story_part(story, slot):
+    start, end = SLOT_PARTS[slot]
+    return story[int(len(story) * start):int(len(story) * end)]
+
+
+def heuristic_slots(story, protagonist=None):
+    """
+    Fill the slots of one story with the keyword rules. The protagonist is the name given, or else
+    the first character introduced as "named ..." in the opening.
+    """
+    if protagonist is None:
+        match = re.search(NAMED, story_part(story, 'protagonist'))
+        protagonist = match.group(1) if match else None
+    slots = {'protagonist': clean_label(protagonist, lower=False)}
+    for slot, rules in RULES.items():
+        part = story_part(story, slot)
+        slots[slot] = next((label for label, pattern in rules if re.search(pattern, part, re.IGNORECASE)), UNKNOWN)
+
+    end = story_part(story, 'resolution')
+    community = len(re.findall(COMMUNITY_WORDS, end, re.IGNORECASE))
+    personal = len(re.findall(PERSONAL_WORDS, end, re.IGNORECASE))
+    slots['resolution'] = "organising community" if community >= personal else "coming to terms with self"
+    return {slot: slots[slot] for slot in SLOTS}
+
+
+def first_names(country):
+    """
+    The first protagonist name found in each story by the names stage, {Story_ID: name}.
+    """
+    filepath = paths.country_file(country, "story_names")
+    try:
+        names = pd.read_csv(filepath, keep_default_na=False, na_values=[""]).dropna()
+    except FileNotFoundError:
+        return {}
+    names = names.drop_duplicates('Story_ID')
+    return dict(zip(names['Story_ID'].astype(str), names['Name']))
+
+
+def request_slots(country, batch):
+    """
+    Send one batch of stories to the model.
+
+    Parameters
+    ----------
+    batch : pandas.DataFrame
+        'Story_ID' and 'Story' of the stories.
+
+    Returns
+    -------
+    dict
+        {Story_ID: slots} for the stories the reply had an entry for.
+    """
+    stories = "\n\n".join(f"Story_ID: {story_id}\n{story}" for story_id, story in zip(batch['Story_ID'], batch['Story']))
+    messages = [{"role": "system", "content": ""},
+                {"role": "user", "content": f"{PROMPT}\n\n{stories}"}]
+
+    token_usage.before_request("plot", country)
+    start = perf_counter()
+    response = openai_client.create(
+        model=MODEL,
+        messages=messages,
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    instrumentation.record_api_call(perf_counter() - start, response.usage)
+    token_usage.record("plot", country, ";".join(batch['Story_ID']), MODEL, response.usage)
+
+    try:
+        entries = json.loads(response.choices[0].message.content)['stories']
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print(f"  Could not read the reply for {', '.join(batch['Story_ID'])}: {e}")
+        return {}
+
+    found = {}
+    for entry in entries:
+        story_id = str(entry.get('Story_ID', ""))
+        if story_id in set(batch['Story_ID']):
+            found[story_id] = {slot: clean_label(entry.get(slot), lower=slot != 'protagonist') for slot in SLOTS}
+    instrumentation.add_items(len(found))
+    return found
+
+
+def load_cached(country):
+    """
+    The records of an earlier run: the plot structure file and the checkpoint of a run stopped by the budget.
+    """
+    frames = []
+    filepath = paths.country_file(country, "plot_structure")
+    try:
+        frames.append(pd.read_csv(filepath, dtype=str, keep_default_na=False))
+    except FileNotFoundError:
+        pass
+    done = token_usage.load_checkpoint(country, "plot")
+    if done is not None:
+        frames.append(done.astype(str))
+    if not frames:
+        return {}
+    cached = pd.concat(frames).drop_duplicates('Story_Hash', keep='last')
+    return {row['Story_Hash']: row for row in cached.to_dict('records')}
+
+
+def extract_plot_structure(dir, engine="gpt"):
+    """
+    Extract the slots of the stories of a country that are not cached yet, and save all its records.
+
+    Parameters
+    ----------
+    dir : str
+        Country code.
+    engine : str
+        'gpt' or 'heuristic'.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The records: 'Story_ID', the slots, 'Engine', 'Story_Hash' and 'Date'.
+    """
+    filepath = paths.country_file(dir, "stories")
+    df = pd.read_csv(filepath)
+    df['Story_ID'] = df['Story_ID'].astype(str)
+    df['Story_Hash'] = [story_hash(engine, story) for story in df['Story'].astype(str)]
+
+    cached = load_cached(dir)
+    records = {h: cached[h] for h in df['Story_Hash'] if h in cached}
+    todo = df[~df['Story_Hash'].isin(records)]
+    print(f"Extracting the plot structure of {len(todo)} of {len(df)} stories from {filepath} "
+          f"({engine_name(engine)}, {len(records)} cached)...\n")
+
+    today = date.today().strftime("%d-%m-%Y")
+
+    def add(row, slots):
+        records[row.Story_Hash] = {'Story_ID': row.Story_ID, **slots, 'Engine': engine_name(engine),
+                                   'Story_Hash': row.Story_Hash, 'Date': today}
+
+    if engine == "heuristic":
+        names = first_names(dir)
+        for row in todo.itertuples():
+            add(row, heuristic_slots(str(row.Story), names.get(row.Story_ID)))
+        instrumentation.add_items(len(todo))
+    else:
+        # Stories missing from a reply are sent once more in the next round
+        for _ in range(2):
+            batches = [todo.iloc[start:start + BATCH_SIZE] for start in range(0, len(todo), BATCH_SIZE)]
+            try:
+                # Several batches at a time (see openai_client.py)
+                for batch, found in openai_client.map(lambda batch: request_slots(dir, batch), batches):
+                    for row in batch.itertuples():
+                        if row.Story_ID in found:
+                            add(row, found[row.Story_ID])
+            except token_usage.BudgetExhausted:
+                token_usage.save_checkpoint(dir, "plot", pd.DataFrame(list(records.values())))
+                raise
+            todo = todo[~todo['Story_Hash'].isin(records)]
+            if todo.empty:
+                break
+        if not todo.empty:
+            print(f"  No plot structure for {len(todo)} stories ({', '.join(todo['Story_ID'])}), "
+                  f"they are extracted again on the next run")
+
+    result = pd.DataFrame([records[h] for h in df['Story_Hash'] if h in records],
+                          columns=['Story_ID'] + SLOTS + ['Engine', 'Story_Hash', 'Date'])
+    output_filepath = paths.country_file(dir, "plot_structure")
+    result.to_csv(output_filepath, index=False)
+    token_usage.clear_checkpoint(dir, "plot")
+    print(f"Plot structure of {len(result)} stories saved to {output_filepath}\n\n--------------------\n")
+    return result
+
+
+def main(countries, startfrom, engine="gpt"):
+    if engine != "heuristic":
+        load_api_key()
+
+    if 'all' in countries and len(countries) == 1:
+        for dir in paths.list_country_dirs():
+            if startfrom != "" and startfrom != dir:
+                continue
+            else:
+                startfrom = ""
+                with instrumentation.stage("plot", dir):
+                    extract_plot_structure(dir, engine)
+
+    else:
+        for dir in paths.list_country_dirs():
+            if dir in countries:
+                with instrumentation.stage("plot", dir):
+                    extract_plot_structure(dir, engine)
+
+
+if __name__ == "__main__":
+    main(['all'], "")
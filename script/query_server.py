@@ -0,0 +1,360 @@
+"""
+A local HTTP API over the corpus aggregates (aggregates.py), for dashboards that would otherwise
+read every per-country CSV on each request.
+
+    python3 query_server.py serve --port 8100
+    curl 'http://127.0.0.1:8100/top?kind=words&by=country&country=NO,SE&k=5'
+
+The aggregates are loaded once when the server starts. Every endpoint answers GET with a JSON array
+of records:
+
+- /countries: stories and words per country, with its name, region and sub-region
+- /sentiment_counts?by=country_name: stories per top emotion in each group, one field per emotion,
+  like calculate_sentiment_counts in analysis/script/visualise_sentiments.py
+- /sentiment_shares?by=region: share and mean confidence of each top emotion per group
+- /top?kind=words&by=country&k=10: most common words, nouns, names or titles per group
+- /unique?kind=words&k=10&min_count=5: the items most particular to each country (its share of their global count)
+- /word_rates?words=fjord,sakura&by=sub-region: counts and rates per 1,000 words per group
+
+by is country, country_name, region, sub-region or all. The queries take the filters country,
+country_name, region and sub-region, with comma separated values, like `story_cli.py stats --where`.
+/stats reports the requests, the result cache and when the aggregates were loaded.
+
+The JSON of each answer is kept in a least recently used cache, limited both in entries and in
+bytes, so the queries a dashboard repeats are answered without running pandas again. Responses
+say whether they came from the cache (X-Cache: hit or miss) and how long the query took
+(X-Query-Ms). `python3 query_server.py bench` measures the latency per endpoint, cold and cached.
+"""
+
+import json
+import time
+import threading
+import statistics
+import http.client
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import click
+import paths
+
+FILTERS = ['country', 'country_name', 'region', 'sub-region']
+
+# Endpoint -> the Aggregates query it runs, and its parameters with their defaults (None: required)
+ENDPOINTS = {
+    'sentiment_counts': ('sentiment_counts', {'by': 'country_name'}),
+    'sentiment_shares': ('sentiment_shares', {'by': 'region'}),
+    'top': ('top', {'kind': 'words', 'by': 'country', 'k': 10}),
+    'unique': ('unique_items', {'kind': 'words', 'k': 10, 'min_count': 5}),
+    'word_rates': ('word_rates', {'words': None, 'by': 'region', 'kind': 'words'}),
+}
+
+
+class ResultCache:
+    """
+    Least recently used cache of encoded answers, holding at most max_entries answers and max_bytes
+    bytes. An answer larger than max_bytes is not kept.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries < 1 or len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.bytes += len(value)
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.bytes,
+                        max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+
+class QueryService:
+    """
+    The aggregates loaded once, the result cache, and the request counts of a server.
+    """
+
+    def __init__(self, aggregates, cache):
+        self.aggregates = aggregates
+        self.cache = cache
+        self.loaded = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.requests = 0
+        self.lock = threading.Lock()
+        # pandas does not promise that concurrent reads are safe, and the queries hold the GIL anyway
+        self.query_lock = threading.Lock()
+        self.countries = aggregates.countries.reset_index().to_json(orient='records').encode("utf-8")
+
+    def parse(self, endpoint, query):
+        """
+        Turn the query string of a request into the keyword arguments of its Aggregates query.
+
+        Raises
+        ------
+        ValueError
+            If a parameter is unknown, missing or not a number where one is expected.
+        """
+        method, defaults = ENDPOINTS[endpoint]
+        kwargs, where = dict(defaults), {}
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name in FILTERS:
+                where.setdefault(name, []).extend(v.strip() for v in value.split(",") if v.strip())
+            elif name == 'words':
+                kwargs['words'] = [word.strip() for word in value.split(",") if word.strip()]
+            elif name in defaults and isinstance(defaults[name], int):
+                try:
+                    kwargs[name] = int(value)
+                except ValueError:
+                    raise ValueError(f"{name} must be a whole number, not '{value}'")
+            elif name in defaults:
+                kwargs[name] = value
+            else:
+                raise ValueError(f"Unknown parameter '{name}' for /{endpoint}, use {', '.join(list(defaults) + FILTERS)}")
+        missing = [name for name, value in kwargs.items() if not value and value != 0]
+        if missing:
+            raise ValueError(f"/{endpoint} needs {', '.join(missing)}")
+        return method, dict(kwargs, where={name: sorted(values) for name, values in sorted(where.items())} or None)
+
+    def answer(self, endpoint, query):
+        """
+        The JSON answer to a query and whether it came from the cache.
+        """
+        method, kwargs = self.parse(endpoint, query)
+        # Keyed on the parsed arguments, so parameter order and defaults left out share an entry
+        key = json.dumps([endpoint, kwargs], sort_keys=True)
+        payload = self.cache.get(key)
+        if payload is not None:
+            return payload, True
+        with self.query_lock:
+            result = getattr(self.aggregates, method)(**kwargs)
+        payload = result.to_json(orient='records').encode("utf-8")
+        self.cache.put(key, payload)
+        return payload, False
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def stats(self):
+        return {'requests': self.requests, 'loaded': self.loaded, 'directory': self.aggregates.directory,
+                'countries': len(self.aggregates.countries), 'cache': self.cache.info()}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    service = None  # Set by make_server
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are separate writes: with Nagle's algorithm on, a keep-alive client
+    # waits for the delayed ACK (about 40 ms) before it gets the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass  # Keep the console quiet under load
+
+    def send_payload(self, status, payload, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_json(self, status, message):
+        self.send_payload(status, json.dumps({"error": {"message": message}}).encode("utf-8"))
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        endpoint = url.path.strip("/")
+        self.service.count_request()
+        if endpoint == "stats":
+            self.send_payload(200, json.dumps(self.service.stats()).encode("utf-8"))
+        elif endpoint == "countries":
+            self.send_payload(200, self.service.countries)
+        elif endpoint in ENDPOINTS:
+            try:
+                payload, hit = self.service.answer(endpoint, url.query)
+            except ValueError as e:
+                self.send_error_json(400, str(e))
+                return
+            except Exception as e:
+                self.send_error_json(500, f"{type(e).__name__}: {e}")
+                return
+            self.send_payload(200, payload, {"X-Cache": "hit" if hit else "miss",
+                                             "X-Query-Ms": f"{(time.perf_counter() - start) * 1000:.2f}"})
+        else:
+            self.send_error_json(404, f"Unknown path {url.path}, use /{', /'.join(['countries', *ENDPOINTS, 'stats'])}")
+
+
+def make_server(aggregates, host="127.0.0.1", port=8100, cache_entries=1024, cache_bytes=64 * 2**20):
+    """
+    Create (but do not start) a query server over loaded Aggregates. Use port 0 to pick a free port.
+    """
+    service = QueryService(aggregates, ResultCache(cache_entries, cache_bytes))
+    handler = type("BoundQueryHandler", (QueryHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(aggregates, **kwargs):
+    """
+    Start a query server on a free port in a daemon thread and return (server, url).
+    """
+    server = make_server(aggregates, port=0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def bench_queries(countries, words):
+    """
+    A dashboard-like mix of queries: per country, its sentiments, top words and unique words, and
+    per region and sub-region the sentiments, top names and the rates of some words.
+    """
+    queries = []
+    for country in countries:
+        queries += [("sentiment_counts", {'by': 'country', 'country': country}),
+                    ("top", {'kind': 'words', 'by': 'country', 'country': country, 'k': 20}),
+                    ("unique", {'kind': 'words', 'country': country, 'k': 20})]
+    for by in ('region', 'sub-region'):
+        queries += [("sentiment_counts", {'by': by}),
+                    ("sentiment_shares", {'by': by}),
+                    ("top", {'kind': 'names', 'by': by, 'k': 10}),
+                    ("word_rates", {'words': ",".join(words), 'by': by})]
+    return [(endpoint, f"/{endpoint}?{urlencode(params)}") for endpoint, params in queries]
+
+
+def benchmark(url, queries, repeats=5, concurrency=1):
+    """
+    Send every query repeats times, all of them once before any is repeated, and time them.
+
+    Returns
+    -------
+    dict
+        {(endpoint, 'cold' or 'cached'): [milliseconds, ...]}. The first answer to a query that the
+        server did not have cached is cold, the answers from its cache are cached.
+    """
+    address = urlsplit(url)
+    local = threading.local()
+
+    def get(path):
+        # One keep-alive connection per client thread, so the times are not connection set-ups
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection(address.hostname, address.port, timeout=60)
+        start = time.perf_counter()
+        local.connection.request("GET", path)
+        response = local.connection.getresponse()
+        response.read()
+        elapsed = (time.perf_counter() - start) * 1000
+        if response.status != 200:
+            raise click.ClickException(f"{path} answered {response.status}")
+        return elapsed, response.getheader("X-Cache") == "hit"
+
+    timings = {}
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in range(repeats):
+            for (endpoint, _), (elapsed, hit) in zip(queries, executor.map(get, [path for _, path in queries])):
+                timings.setdefault((endpoint, 'cached' if hit else 'cold'), []).append(elapsed)
+    return timings
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+@click.group()
+def cli():
+    """Serve the corpus aggregates over HTTP, and measure its latency."""
+
+
+@cli.command()
+@click.option('--data-dir', type=click.Path(file_okay=False), default=paths.DATA_DIR, show_default=True, help='Directory with one folder per country')
+@click.option('--host', default="127.0.0.1", show_default=True)
+@click.option('--port', type=int, default=8100, show_default=True)
+@click.option('--cache-entries', type=click.IntRange(0), default=1024, show_default=True, help='Most answers kept in the result cache (0 turns it off)')
+@click.option('--cache-mb', type=click.FloatRange(0), default=64, show_default=True, help='Most megabytes of answers kept in the result cache')
+@click.option('--rebuild', is_flag=True, help='Build the aggregates from the per-country files before serving them')
+def serve(data_dir, host, port, cache_entries, cache_mb, rebuild):
+    """Load the aggregates and answer queries until stopped with Ctrl-C."""
+    import aggregates
+
+    paths.set_data_dir(data_dir)
+    start = time.perf_counter()
+    table = aggregates.build() if rebuild else aggregates.Aggregates.load()
+    if table.is_stale():
+        print("The per-country files changed since the aggregates were built, use --rebuild to update them")
+    server = make_server(table, host, port, cache_entries, int(cache_mb * 2**20))
+    print(f"Loaded the aggregates of {len(table.countries)} countries in {time.perf_counter() - start:.1f}s")
+    print(f"Query server listening on http://{host}:{server.server_address[1]} (stats at /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command()
+@click.option('--data-dir', type=click.Path(file_okay=False), default=paths.DATA_DIR, show_default=True, help='Directory with one folder per country')
+@click.option('--url', default=None, help='Measure this running server instead of one started in this process, e.g. http://127.0.0.1:8100')
+@click.option('--countries', 'num_countries', type=click.IntRange(1), default=20, show_default=True, help='Countries to query one by one')
+@click.option('--word', 'words', multiple=True, default=['forest', 'sea', 'river', 'desert'], show_default=True, help='Words of the word_rates queries')
+@click.option('--repeats', type=click.IntRange(1), default=5, show_default=True, help='Times each query is sent')
+@click.option('--concurrency', type=click.IntRange(1), default=1, show_default=True, help='Requests in flight at once')
+@click.option('--cache-entries', type=click.IntRange(0), default=1024, show_default=True, help='Result cache of the server started here (0 to time every query uncached)')
+def bench(data_dir, url, num_countries, words, repeats, concurrency, cache_entries):
+    """Time the queries of a dashboard-like workload, cold and from the cache."""
+    if url is None:
+        import aggregates
+
+        paths.set_data_dir(data_dir)
+        # The client shares the GIL with the server here, so a server started apart answers a bit faster
+        _, url = start_in_background(aggregates.Aggregates.load(), cache_entries=cache_entries)
+    url = url.rstrip("/")
+    address = urlsplit(url)
+    connection = http.client.HTTPConnection(address.hostname, address.port, timeout=60)
+    connection.request("GET", "/countries")
+    countries = [row['country'] for row in json.loads(connection.getresponse().read())][:num_countries]
+
+    queries = bench_queries(countries, words)
+    start = time.perf_counter()
+    timings = benchmark(url, queries, repeats, concurrency)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(queries)} queries x {repeats} against {url}, {concurrency} at a time: "
+          f"{len(queries) * repeats / elapsed:.0f} requests/s\n")
+    print(f"{'endpoint':<18}{'answer':<8}{'requests':>9}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for (endpoint, answer), values in sorted(timings.items()):
+        print(f"{endpoint:<18}{answer:<8}{len(values):>9}{statistics.mean(values):>10.2f}{percentile(values, 0.5):>9.2f}"
+              f"{percentile(values, 0.95):>9.2f}{percentile(values, 0.99):>9.2f}{max(values):>9.2f}")
+    connection.request("GET", "/stats")
+    cache = json.loads(connection.getresponse().read())['cache']
+    print(f"\nServer cache: {cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions, "
+          f"{cache['entries']} answers in {cache['bytes'] / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,63 +1,103 @@
 import pandas as pd
-from transformers import AutoTokenizer, TFAutoModelForSequenceClassification
-from transformers import pipeline
 from datetime import date
-import os
+import functools
+import paths
+import instrumentation
 
-def sentiment_analysis(directory):
+model_name = "bhadresh-savani/distilbert-base-uncased-emotion"
+
+# The model's classes, in the order of its labels
+EMOTIONS = ['sadness', 'joy', 'love', 'anger', 'fear', 'surprise']
+
+
+@functools.lru_cache(maxsize=None)
+def load_sentiment_analyzer():
     """
-    Perform sentiment analysis on all CSV files in a directory and return a concatenated DataFrame.
+    Load the emotion model once per process (an experiment grid runs this stage for many cells).
+
+    transformers and TF-Keras take seconds to import, so they are only imported here, when
+    sentiment analysis is actually run.
     """
-    print(f"\n--------------------\n\nPerforming sentiment analysis on {directory}...\n\n--------------------\n")
-    # dfs = []
-    model_name = "bhadresh-savani/distilbert-base-uncased-emotion"
+    from transformers import AutoTokenizer, TFAutoModelForSequenceClassification
+    from transformers import pipeline
+
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = TFAutoModelForSequenceClassification.from_pretrained(model_name)
 
     # Create a sentiment-analysis pipeline
-    sentiment_analyzer = pipeline('sentiment-analysis', model=model, tokenizer=tokenizer, device=0)
+    return pipeline('sentiment-analysis', model=model, tokenizer=tokenizer, device=0)
+
+
+def emotion_scores(story_ids, results):
+    """
+    The probabilities of all the emotions of each story, from the pipeline's results with top_k=None.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One float32 column per emotion (in EMOTIONS order), indexed by story_id.
+    """
+    scores = pd.DataFrame([{result['label']: result['score'] for result in story} for story in results],
+                          index=pd.Index(story_ids, name='story_id'))
+    return scores.reindex(columns=EMOTIONS).astype('float32')
+
+
+def sentiment_analysis(directory, sentiment_analyzer):
+    """
+    Perform sentiment analysis on all CSV files in a directory and return a concatenated DataFrame.
+
+    The top emotion of each story and its score are saved to <CC>_sentiments.csv, and the
+    probabilities of all six emotions to <CC>_emotion_scores.parquet (float32), so other
+    thresholds and secondary emotions need no rerun of the model.
+    """
+    print(f"\n--------------------\n\nPerforming sentiment analysis on {directory}...\n\n--------------------\n")
+    # dfs = []
 
-    filepath = f"../data/{directory}/{directory}_summaries.csv"
+    filepath = paths.country_file(directory, "summaries")
     
     df = pd.read_csv(filepath)
 
     # Extract text data from the specified columns (adjust the index if needed)
     texts = df.iloc[:, 1].tolist()
     story_ids = df.iloc[:, 0].tolist()
+    instrumentation.add_items(len(texts))
 
-    # Apply sentiment analysis to the list of texts
-    results = sentiment_analyzer(texts)
-
+    # Apply sentiment analysis to the list of texts, keeping the probabilities of all the classes
+    results = sentiment_analyzer(texts, top_k=None)
+    scores = emotion_scores(story_ids, results)
+    scores.to_parquet(paths.country_file(directory, "emotion_scores", "parquet"))
 
     sentiment_df = pd.DataFrame()
     sentiment_df['story_id'] = story_ids
-    sentiment_df['sentiment'] = [result['label'] for result in results]
-    sentiment_df['confidence'] = [round(result['score'], 2) for result in results]
+    sentiment_df['sentiment'] = scores.idxmax(axis=1).to_numpy()
+    sentiment_df['confidence'] = scores.max(axis=1).round(2).to_numpy()
     sentiment_df['model'] = model_name
     sentiment_df['date'] = date.today().strftime("%d-%m-%Y") 
 
-    sentiment_df.to_csv(f'../data/{directory}/{directory}_sentiments.csv', index=False)  # Save the DataFrame to a CSV file
+    sentiment_df.to_csv(paths.country_file(directory, "sentiments"), index=False)  # Save the DataFrame to a CSV file
 
 
 
 
 
 def main(countries, startfrom):
+    sentiment_analyzer = load_sentiment_analyzer()
+
     if 'all' in countries and len(countries) == 1:
-        for dir in sorted(os.listdir("../data")):
-            if dir == '.DS_Store':
-                continue
+        for dir in paths.list_country_dirs():
             if startfrom != "" and startfrom != dir:
                 continue
             else:
                 startfrom = ""
-                sentiment_analysis(dir)
+                with instrumentation.stage("sentiment", dir):
+                    sentiment_analysis(dir, sentiment_analyzer)
                 
     
     else:
-        for dir in sorted(os.listdir("../data")):
+        for dir in paths.list_country_dirs():
             if dir in countries:
-                sentiment_analysis(dir)
+                with instrumentation.stage("sentiment", dir):
+                    sentiment_analysis(dir, sentiment_analyzer)
                 
 
     
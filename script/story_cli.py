@@ -1,25 +1,65 @@
 import click
-from generate_stories import main as generate_stories
-from name_extraction import main as extract_names
-from noun_phrases import main as extract_noun_phrases
-from sentiment_huggingface import main as sentiment
-from word_freq import main as word_freq
-from summary_gen import main as generate_summary
 import csv
+import os
+import time
+import functools
+import paths
+import manifest
+import instrumentation
+import token_usage
 
 
 
 @click.group()
-def cli():
-    pass
+@click.option('--data-dir', type=click.Path(file_okay=False), default=paths.DATA_DIR, show_default=True, help='Directory with one folder per country')
+@click.option('--base-url', envvar='OPENAI_BASE_URL', default=None, help='OpenAI-compatible API to call instead of api.openai.com, e.g. http://127.0.0.1:8000/v1 for mock_openai_server.py')
+@click.option('--profile', type=click.Path(dir_okay=False), default=None, help='Append wall/CPU time, peak RSS, items, API latency and token usage per (stage, country) to this JSONL file')
+@click.option('--prometheus', type=click.Path(dir_okay=False), default=None, help='Also write the metrics to this Prometheus text file')
+@click.option('-q', '--quiet', is_flag=True, help="Don't echo generated stories and summaries")
+@click.option('--budget-usd', type=float, default=None, help='Stop the run once the OpenAI requests have cost this much')
+@click.option('--budget-tokens', type=int, default=None, help='Stop the run after this many prompt + completion tokens')
+@click.option('--slow-down-at', type=float, default=0.8, show_default=True, help='Share of the budget after which requests are slowed down')
+@click.option('--max-concurrency', type=click.IntRange(1), default=None, help='Most OpenAI requests in flight at once  [default: 8]')
+@click.option('--rpm', type=click.IntRange(1), default=None, help='Requests per minute to keep to until the API reports its limits')
+@click.option('--tpm', type=click.IntRange(1), default=None, help='Tokens per minute to keep to until the API reports its limits')
+def cli(data_dir, base_url, profile, prometheus, quiet, budget_usd, budget_tokens, slow_down_at, max_concurrency, rpm, tpm):
+    paths.set_data_dir(data_dir)
+    if base_url:
+        os.environ['OPENAI_BASE_URL'] = base_url
+    instrumentation.enable(profile, prometheus, quiet)
+    token_usage.set_budget(budget_usd, budget_tokens, slow_down_at)
+    if max_concurrency or rpm or tpm:
+        import openai_client  # Imported here as it imports openai, which the other commands don't need
+        options = {'max_concurrency': max_concurrency} if max_concurrency else {}
+        openai_client.configure(rpm=rpm, tpm=tpm, **options)
+
+
+def stop_cleanly_on_budget(command):
+    """
+    Turn a BudgetExhausted error into a short message on how to resume, instead of a traceback.
+    """
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        try:
+            return command(*args, **kwargs)
+        except token_usage.BudgetExhausted as e:
+            raise click.ClickException(f"{e}\nFinished records are saved in a checkpoint. Run the same command again "
+                                       f"(with -s {e.country} when processing all countries) to continue from there.")
+    return wrapper
     
 
 @cli.command()
 @click.argument('countries', nargs=-1, type=str) # country codes or 'all' for all countries
 @click.argument('num_story_per_topic', type=int)
 @click.option('-s', '--startfrom', type=str, default='', help='Start from a specific country code when generating all')
-def generate(countries, num_story_per_topic, startfrom):
+@click.option('--stream', is_flag=True, help='Stream each story into a spool file and append it to the stories file when done, keeping the stories already there')
+@stop_cleanly_on_budget
+def generate(countries, num_story_per_topic, startfrom, stream):
     """Generate stories."""
+    # The stage modules are imported by the commands that use them, so --help and generate
+    # don't wait for transformers, spaCy and TextBlob to load
+    from generate_stories import main as generate_stories
+
     print("Generating stories...")
 
     # Read the country codes from the CSV file
@@ -36,10 +76,10 @@ def generate(countries, num_story_per_topic, startfrom):
                 country_name = line[1]
                 demonym = line[3]
                 if 'all' in countries and len(countries) == 1: 
-                    generate_stories(num_story_per_topic, demonym, country_code, country_name)
+                    generate_stories(num_story_per_topic, demonym, country_code, country_name, stream=stream)
 
                 elif country_code in countries:
-                     generate_stories(num_story_per_topic, demonym, country_code, country_name)
+                     generate_stories(num_story_per_topic, demonym, country_code, country_name, stream=stream)
                 
                     
 
@@ -47,26 +87,440 @@ def generate(countries, num_story_per_topic, startfrom):
 
 @cli.command()
 @click.argument('countries', nargs=-1, type=str) # country codes or 'all' for all countries
-@click.option('-a', '--analysis', type=str, multiple=1, default=['all'], help='Type of analysis to perform: names, noun_phrases, tb_sentiment, word_freq')
+@click.option('-a', '--analysis', type=str, multiple=1, default=['all'], help='Type of analysis to perform: names, noun_phrases, tb_sentiment, word_freq, or plot (never part of all)')
 @click.option('-s', '--startfrom', type=str, default='', help='Start from a specific country code when analysing all')
-def analyze(analysis, countries, startfrom):
-    
+@click.option('-f', '--force', is_flag=True, help='Rebuild even the countries whose outputs are up to date')
+@click.option('--plot-engine', type=click.Choice(['gpt', 'heuristic']), default='gpt', show_default=True, help='How the plot analysis fills the story slots: batched GPT requests or local keyword rules')
+@click.option('--summary-engine', type=click.Choice(['gpt', 'extractive']), default='gpt', show_default=True, help='How the summaries are written: by gpt-4o-mini, or locally from the most central sentences of each story')
+@click.option('-w', '--workers', type=click.IntRange(1), default=None, help='Processes for the extractive summaries  [default: number of CPUs]')
+@stop_cleanly_on_budget
+def analyze(analysis, countries, startfrom, force, plot_engine, summary_engine, workers):
+    selected = manifest.select_countries(countries, startfrom)
+
     if "summary" in analysis or "all" in analysis:
-        generate_summary(countries, startfrom)
+        use_engine("summary", summary_engine)
+        run_if_stale("summary", selected, force, engine=summary_engine, processes=workers)
     if "names" in analysis or "all" in analysis:
-        extract_names(countries, startfrom)
+        run_if_stale("names", selected, force)
     if "nouns" in analysis or "all" in analysis:
-        extract_noun_phrases(countries, startfrom)
+        run_if_stale("nouns", selected, force)
     if "words" in analysis or "all" in analysis:
-        word_freq(countries, startfrom)
+        run_if_stale("words", selected, force)
     if "sentiment" in analysis or "all" in analysis:
-        sentiment(countries, startfrom)
+        run_if_stale("sentiment", selected, force)
+    # Not part of 'all': it sends every story to the API again
+    if "plot" in analysis:
+        use_engine("plot", plot_engine)
+        run_if_stale("plot", selected, force, engine=plot_engine)
+
+
+def use_engine(stage, engine):
+    """
+    Record the engine of a stage that has a local alternative to GPT as its model in the manifest,
+    so switching engines rebuilds the stage.
+    """
+    manifest.STAGES[stage]['model'] = "gpt-4o-mini" if engine == "gpt" else engine
+
+
+def run_if_stale(stage, countries, force=False, **options):
+    """
+    Run a stage on the countries whose outputs are stale according to the manifest, and record what it built.
+    Options are passed on to the stage's main().
+    """
+    stale, skipped = manifest.plan(stage, countries, force)
+    up_to_date = [c for c, reason in skipped.items() if reason == 'up to date']
+    missing = [c for c, reason in skipped.items() if reason == 'missing input']
+    print(f"{stage}: rebuilding {len(stale)} {'countries' if len(stale) != 1 else 'country'}"
+          f"{' (' + ', '.join(stale) + ')' if 0 < len(stale) <= 10 else ''}, "
+          f"skipping {len(up_to_date)} up to date" + (f" and {len(missing)} without input ({', '.join(missing)})" if missing else ""))
+    if not stale:
+        return
+
+    # The stage modules are imported only when there is work for them
+    if stage == "summary":
+        from summary_gen import main
+    elif stage == "names":
+        from name_extraction import main
+    elif stage == "nouns":
+        from noun_phrases import main
+    elif stage == "words":
+        from word_freq import main
+    elif stage == "plot":
+        from plot_structure import main
+    else:
+        from sentiment_huggingface import main
+
+    started = time.time()
+    try:
+        main(stale, "", **options)
+    finally:
+        # Also record the countries finished before a budget stop or an error
+        manifest.record(stage, stale, since=started)
+
+
+
+@cli.command()
+@click.option('-b', '--by', type=click.Choice(['Stage', 'Country', 'Model', 'Date'], case_sensitive=False), multiple=True, help='Group by these columns (default: Stage and Country)')
+def usage(by):
+    """Show OpenAI token usage and cost from the per-country ledgers."""
+    import pandas as pd
+
+    by = tuple(b.capitalize() for b in by) or ('Stage', 'Country')
+    summary = token_usage.summarize(by)
+    with pd.option_context('display.max_rows', None, 'display.float_format', '{:.4f}'.format):
+        print(summary.to_string(index=False))
+    print(f"\nTotal: {summary['Prompt_Tokens'].sum()} prompt tokens, {summary['Completion_Tokens'].sum()} completion tokens, ${summary['Cost_USD'].sum():.4f}")
+
+
+
+@cli.command(name='manifest')
+@click.argument('countries', nargs=-1, type=str) # country codes or 'all' for all countries
+@click.option('-a', '--analysis', type=click.Choice(list(manifest.STAGES)), multiple=True, help='Only show these stages (default: all)')
+@click.option('--adopt', is_flag=True, help='Record the existing outputs as up to date without rebuilding them')
+def manifest_command(countries, analysis, adopt):
+    """Show which analysis outputs are stale, or adopt existing outputs."""
+    selected = manifest.select_countries(countries or ('all',), "")
+    stages = analysis or list(manifest.STAGES)
+
+    if adopt:
+        for stage in stages:
+            recorded = manifest.record(stage, selected)
+            print(f"{stage}: recorded {len(recorded)} countries as up to date")
+        return
+
+    current = manifest.load()
+    for stage in stages:
+        reasons = {}
+        for country in selected:
+            reasons.setdefault(manifest.status(current, stage, country), []).append(country)
+        print(f"{stage}:")
+        for reason, stage_countries in sorted(reasons.items()):
+            print(f"  {reason:<16} {len(stage_countries):>4}  {' '.join(stage_countries) if reason != 'up to date' else ''}")
+
+
+
+@cli.group()
+@click.option('--experiments-dir', type=click.Path(file_okay=False), default="../experiments", show_default=True, help='Directory with one folder per experiment grid')
+@click.pass_context
+def grid(ctx, experiments_dir):
+    """Generate and compare stories across models, temperatures and prompts (see experiment_grid.py)."""
+    ctx.obj = experiments_dir
+
+
+def load_grid_spec(spec, experiments_dir):
+    import experiment_grid
+    try:
+        return experiment_grid.load_spec(spec, experiments_dir)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@grid.command(name='run')
+@click.argument('spec', type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def grid_run(experiments_dir, spec):
+    """Generate the stories of every cell of a grid spec that are not there yet."""
+    import experiment_grid
+
+    spec = load_grid_spec(spec, experiments_dir)
+    try:
+        generated = experiment_grid.run(spec)
+    except token_usage.BudgetExhausted as e:
+        raise click.ClickException(f"{e}\nThe finished stories are saved in the cells. Run the same command again to continue from there.")
+    print(f"\nGenerated {generated} stories in {os.path.join(spec['dir'], 'cells')}")
+
+
+@grid.command(name='analyze')
+@click.argument('spec', type=click.Path(exists=True, dir_okay=False))
+@click.option('-a', '--analysis', type=click.Choice(['all', 'summary', 'names', 'nouns', 'words', 'sentiment']), multiple=True, default=['all'], help='Analyses to run on every cell')
+@click.option('-f', '--force', is_flag=True, help='Rebuild even the outputs that are up to date')
+@click.option('--summary-engine', type=click.Choice(['gpt', 'extractive']), default='gpt', show_default=True, help='How the summaries are written')
+@click.option('-w', '--workers', type=click.IntRange(1), default=None, help='Processes for the extractive summaries  [default: number of CPUs]')
+@click.pass_obj
+@stop_cleanly_on_budget
+def grid_analyze(experiments_dir, spec, analysis, force, summary_engine, workers):
+    """Run the analyses on every cell of a grid.
+
+    The cells are analysed in one process, stage by stage, so spaCy and the emotion model are loaded
+    once for the whole grid. The API stages send the requests of all the cells through one concurrent
+    map with one rate limit. Each cell keeps its own manifest, so only new or changed cells are
+    analysed again.
+    """
+    import experiment_grid
+
+    spec = load_grid_spec(spec, experiments_dir)
+    use_engine("summary", summary_engine)
+    for stage in experiment_grid.ANALYSIS_STAGES:
+        if stage not in analysis and 'all' not in analysis:
+            continue
+        if stage in experiment_grid.API_ANALYSIS_STAGES and not (stage == "summary" and summary_engine == "extractive"):
+            experiment_grid.analyze(spec, stage, force)
+            continue
+        options = {'engine': summary_engine, 'processes': workers} if stage == "summary" else {}
+        for cell in experiment_grid.cells(spec):
+            directory = experiment_grid.cell_dir(spec, cell['Cell'])
+            if not os.path.isdir(directory):
+                continue
+            with paths.use_data_dir(directory):
+                print(f"[{cell['Cell']}] ", end="")
+                run_if_stale(stage, manifest.select_countries(('all',), ""), force, **options)
+
+
+@grid.command(name='compare')
+@click.argument('spec', type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def grid_compare(experiments_dir, spec):
+    """Tabulate story length, emotions and top names per cell and country."""
+    import pandas as pd
+    import experiment_grid
+
+    spec = load_grid_spec(spec, experiments_dir)
+    comparison = experiment_grid.compare(spec)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200,
+                           'display.float_format', '{:.2f}'.format):
+        print(comparison.drop(columns=['Prompt_Template']).to_string(index=False))
+    print(f"\nSaved to {os.path.join(spec['dir'], 'comparison.csv')}")
+
+
+
+@cli.group()
+@click.option('--queue-dir', type=click.Path(file_okay=False), default=None, help='Queue directory on the filesystem the workers share  [default: <data-dir>/.queue]')
+@click.pass_context
+def queue(ctx, queue_dir):
+    """Share (stage, country) tasks between workers on several processes or hosts (see work_queue.py)."""
+    import work_queue
+    ctx.obj = work_queue.WorkQueue(queue_dir or work_queue.queue_dir())
+
+
+@queue.command(name='enqueue')
+@click.argument('countries', nargs=-1, type=str) # country codes or 'all' for all countries
+@click.option('-n', '--stories', type=click.IntRange(1), default=None, help='Also generate this many stories per country (streamed, keeping the stories already there)')
+@click.option('-a', '--analysis', type=click.Choice(['all', 'none', *manifest.STAGES]), multiple=True, default=['all'], help='Analyses to queue; all is every stage but plot, none only queues generate')
+@click.option('-f', '--force', is_flag=True, help='Rebuild even the outputs that are up to date')
+@click.option('--plot-engine', type=click.Choice(['gpt', 'heuristic']), default='gpt', show_default=True, help='How the plot analysis fills the story slots')
+@click.option('--summary-engine', type=click.Choice(['gpt', 'extractive']), default='gpt', show_default=True, help='How the summaries are written')
+@click.pass_obj
+def queue_enqueue(work, countries, stories, analysis, force, plot_engine, summary_engine):
+    """Queue the tasks of a generate and analyze run."""
+    if stories is not None:
+        from generate_stories import read_countries
+        selected = list(read_countries(countries))
+    else:
+        selected = manifest.select_countries(countries, "")
+
+    stages = [stage for stage in manifest.STAGES if stage in analysis or ('all' in analysis and stage != 'plot')]
+    added = 0
+    for country in selected:
+        if stories is not None:
+            added += work.enqueue('generate', country, {'stories': stories})
+        for stage in stages:
+            options = {'force': force}
+            if stage == 'plot':
+                options['engine'] = plot_engine
+            elif stage == 'summary':
+                options['engine'] = summary_engine
+            added += work.enqueue(stage, country, options)
+    print(f"Queued {added} tasks for {len(selected)} countries in {work.directory} "
+          f"(tasks already pending or running are not queued twice)")
+
+
+@queue.command(name='work')
+@click.option('-p', '--processes', type=click.IntRange(1), default=1, show_default=True, help='Worker processes to start on this host')
+@click.option('--lease-timeout', type=click.FloatRange(min=0, min_open=True), default=300, show_default=True, help='Seconds without a heartbeat after which a lease is reclaimed')
+@click.option('--poll', type=click.FloatRange(min=0, min_open=True), default=2, show_default=True, help='Seconds between looks at the queue while the tasks left wait for running ones')
+@click.pass_obj
+def queue_work(work, processes, lease_timeout, poll):
+    """Claim and run queued tasks until none are left."""
+    if processes == 1:
+        run_worker(None, work.directory, lease_timeout, poll)
+        return
+
+    import multiprocessing
+    # Each process starts fresh and sets itself up from the same global options as this one
+    settings = click.get_current_context().find_root().params
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(settings, work.directory, lease_timeout, poll))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [worker.pid for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise click.ClickException(f"Worker processes {', '.join(map(str, failed))} stopped with an error")
+
+
+def run_worker(settings, queue_directory, lease_timeout, poll):
+    """
+    Run one queue worker. settings are the global options of story_cli, for worker processes started by `queue work -p`.
+    """
+    import work_queue
+
+    if settings is not None:
+        cli.callback(**settings)
+    try:
+        counts = work_queue.work(work_queue.WorkQueue(queue_directory), run_queue_task, lease_timeout, poll)
+    except token_usage.BudgetExhausted as e:
+        message = f"{e}\nThe task is back in the queue. Run a worker again to continue."
+        if settings is None:
+            raise click.ClickException(message)
+        print(message)
+        raise SystemExit(1)
+    print(f"{work_queue.worker_name()}: {counts['done']} tasks done, {counts['failed']} failed, {counts['lost']} leases lost")
+
+
+def run_queue_task(task):
+    """
+    Run one task of the work queue: generate the stories of a country, or one analysis stage for a country.
+    """
+    options = dict(task['options'])
+    if task['stage'] == 'generate':
+        from generate_stories import main as generate_stories, read_countries
+        (country_name, demonym), = read_countries([task['country']]).values()
+        # Streamed, so a task run again after its worker died keeps the stories already saved
+        generate_stories(options['stories'], demonym, task['country'], country_name, stream=True)
+        return
+    force = options.pop('force', False)
+    if 'engine' in options:
+        use_engine(task['stage'], options['engine'])
+    if task['stage'] == 'summary':
+        options['processes'] = 1  # The worker processes are the parallelism
+    run_if_stale(task['stage'], [task['country']], force, **options)
+
+
+@queue.command(name='status')
+@click.pass_obj
+def queue_status(work):
+    """Show the tasks per stage and state, the running tasks and the errors of the failed ones."""
+    import work_queue
+
+    counts = work_queue.status(work)
+    print(f"{'stage':<10}" + "".join(f"{state:>9}" for state in work_queue.STATES))
+    for stage in work_queue.STAGE_FILES:
+        if stage in counts:
+            print(f"{stage:<10}" + "".join(f"{counts[stage][state]:>9}" for state in work_queue.STATES))
+    for lease in work.files('leased'):
+        age = time.time() - os.path.getmtime(work.path('leased', lease))
+        print(f"running  {lease[:-len('.json')]} (last heartbeat {age:.0f}s ago)")
+    for name in work.files('failed'):
+        print(f"failed   {name[:-len('.json')]}: {work.read('failed', name).get('error')}")
+
+
+@queue.command(name='retry')
+@click.pass_obj
+def queue_retry(work):
+    """Queue the failed tasks again."""
+    tasks = work.retry_failed()
+    print(f"Queued {len(tasks)} failed tasks again{': ' + ', '.join(tasks) if tasks else ''}")
+
+
+
+@cli.group()
+def stats():
+    """Query word, noun, name, title and emotion counts across countries and regions (see aggregates.py)."""
+
+
+def parse_where(where):
+    """
+    Turn --where options like 'region=Europe,Asia' into {'region': ['Europe', 'Asia']}.
+    """
+    filters = {}
+    for condition in where:
+        column, sep, values = condition.partition("=")
+        if not sep or not values:
+            raise click.BadParameter(f"'{condition}' is not COLUMN=VALUE[,VALUE...]", param_hint="'--where'")
+        filters.setdefault(column.strip(), []).extend(value.strip() for value in values.split(","))
+    return filters
+
+
+def load_aggregates():
+    import aggregates
+
+    table = aggregates.Aggregates.load()
+    if table.is_stale():
+        click.echo("The per-country files changed since the aggregates were built, run `stats build` to update them", err=True)
+    return table
+
+
+def print_query(query, *args, output_format='table', **kwargs):
+    """
+    Run an Aggregates query, print its result in output_format and how long it took on stderr.
+    """
+    import pandas as pd
+    import aggregates
+
+    try:
+        result, ms = aggregates.timed(query, *args, **kwargs)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if output_format == 'json':
+        print(result.to_json(orient='records'))
+    elif output_format == 'csv':
+        print(result.to_csv(index=False), end="")
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.4g}'.format):
+            print(result.to_string(index=False) if len(result) else "No matching rows")
+    click.echo(f"Query took {ms:.1f} ms", err=True)
+
+
+def stats_options(command):
+    """
+    The --by, --where and --format options the stats queries share.
+    """
+    command = click.option('--format', 'output_format', type=click.Choice(['table', 'json', 'csv']), default='table', show_default=True, help='Output format')(command)
+    command = click.option('--where', multiple=True, metavar='COLUMN=VALUE[,VALUE...]', help='Only these countries: country, country_name, region or sub-region (repeat to combine)')(command)
+    command = click.option('--by', type=click.Choice(['country', 'country_name', 'region', 'sub-region', 'all']), default='region', show_default=True, help='How to group the countries')(command)
+    return command
+
+
+@stats.command(name='build')
+def stats_build():
+    """Build the aggregates from the per-country files, again after new stories or analyses."""
+    import aggregates
+
+    start = time.perf_counter()
+    table = aggregates.build()
+    print(f"Built the aggregates of {len(table.countries)} countries in {time.perf_counter() - start:.1f}s: "
+          + ", ".join(f"{len(items):,} {kind}" for kind, items in table.items.items())
+          + f"\nSaved to {table.directory}")
+
+
+@stats.command(name='words')
+@click.argument('words', nargs=-1, required=True)
+@stats_options
+@click.option('--kind', type=click.Choice(['words', 'nouns', 'names']), default='words', show_default=True, help='Look the words up among the lemmas, noun phrases or names')
+def stats_words(words, by, where, output_format, kind):
+    """How often WORDS occur per group, per 1,000 words and compared to the other countries."""
+    table = load_aggregates()
+    print_query(table.word_rates, words, by, parse_where(where), kind, output_format=output_format)
+
+
+@stats.command(name='top')
+@click.argument('kind', type=click.Choice(['words', 'nouns', 'names', 'titles']))
+@stats_options
+@click.option('-k', '--top', 'k', type=click.IntRange(1), default=10, show_default=True, help='Items per group')
+def stats_top(kind, by, where, output_format, k):
+    """The most common words, noun phrases, names or titles of each group."""
+    table = load_aggregates()
+    print_query(table.top, kind, by, parse_where(where), k, output_format=output_format)
+
 
+@stats.command(name='sentiments')
+@stats_options
+def stats_sentiments(by, where, output_format):
+    """The share of stories with each top emotion per group."""
+    table = load_aggregates()
+    print_query(table.sentiment_shares, by, parse_where(where), output_format=output_format)
 
 
 
 cli.add_command(generate)
 cli.add_command(analyze)
+cli.add_command(usage)
+cli.add_command(manifest_command)
+cli.add_command(grid)
+cli.add_command(queue)
+cli.add_command(stats)
 
 
 
@@ -1,8 +1,27 @@
 import pandas as pd
+import numpy as np
 import openai
 import os
+import re
+import paths
+import instrumentation
+import token_usage
+import openai_client
+from time import perf_counter
 from dotenv import load_dotenv
 from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+
+SUMMARY_WORDS = 50  # Length of the GPT summaries, and the word budget of the extractive ones
+GPT_MODEL = "gpt-4o-mini"
+
+GPT_PROMPT = "In English, write a 50 word plot summary of this story: [STORY]"
+EXTRACTIVE_PROMPT = f"The most central sentences of the story (TF-IDF cosine centrality), up to {SUMMARY_WORDS} words: [STORY]"
+
+# A sentence ends at . ! or ? (and a closing quote or bracket) followed by whitespace, or at a line break
+SENTENCE_END = re.compile(r"(?<=[.!?])[ \t]+|(?<=[.!?][\"'”’)\]])[ \t]+|\s*\n\s*")
+# Markdown headings such as "**Chapter 1: The Call of the Grove**" or "# Title", which are not sentences
+HEADING = re.compile(r'#+\s.*|\*\*[^*]+\*\*:?')
 
 
 def load_api_key():
@@ -17,11 +36,68 @@ def load_api_key():
     
     openai.api_key = api_key
 
+    # Send requests somewhere else than api.openai.com, e.g. the local mock_openai_server.py
+    base_url = os.getenv("OPENAI_BASE_URL")
+    if base_url:
+        openai.base_url = base_url.rstrip("/") + "/"
+
+
 
 
 
+def split_sentences(text):
+    """
+    Split a story into sentences, dropping headings and empty ones.
+    """
+    sentences = (sentence.replace("**", "").strip() for sentence in SENTENCE_END.split(text) if not HEADING.fullmatch(sentence.strip()))
+    return [sentence for sentence in sentences if sentence]
+
+
+def extractive_summary(story, max_words=SUMMARY_WORDS):
+    """
+    Summarize a story without the API: the sentences most similar to the rest of the story.
 
-def generate_summary(dir):
+    Each sentence is a TF-IDF vector over the story's own sentences, and its centrality is the sum of
+    its cosine similarities to the other sentences. The most central sentences that fit in max_words
+    are kept, in story order. If not even the most central sentence fits, it is cut at max_words.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer  # Imported here so the gpt engine doesn't load scikit-learn
+
+    sentences = split_sentences(str(story))
+    if not sentences:
+        return ""
+    try:
+        vectors = TfidfVectorizer(stop_words='english').fit_transform(sentences)
+    except ValueError:  # Nothing but stop words
+        return " ".join(" ".join(sentences).split()[:max_words])
+    # The rows are L2-normalized, so the dot products are the cosine similarities
+    similarity = (vectors @ vectors.T).toarray()
+    centrality = similarity.sum(axis=1) - similarity.diagonal()
+
+    chosen, words = [], 0
+    for index in np.argsort(-centrality, kind='stable'):
+        length = len(sentences[index].split())
+        if words + length <= max_words:
+            chosen.append(index)
+            words += length
+    if not chosen:
+        return " ".join(sentences[np.argmax(centrality)].split()[:max_words])
+    return " ".join(sentences[index] for index in sorted(chosen))
+
+
+def extractive_summaries(stories, executor=None, processes=1):
+    """
+    The extractive summary of each story, computed in the executor's processes (processes of
+    them) if one is given.
+    """
+    if executor is None:
+        return [extractive_summary(story) for story in stories]
+    # A few chunks per process: few enough to keep the pickling cheap, enough to balance the load
+    chunksize = max(1, len(stories) // (4 * processes))
+    return list(executor.map(extractive_summary, stories, chunksize=chunksize))
+
+
+def generate_summary(dir, engine="gpt", executor=None, processes=1):
     """
     Create summaries of stories from CSV files in a directory using OpenAI's GPT model.
 
@@ -29,6 +105,13 @@ def generate_summary(dir):
     ----------
     dir : str
         Name of directory containing CSV files with stories.
+    engine : str
+        'gpt' asks gpt-4o-mini for a 50 word summary of each story. 'extractive' picks the most
+        central sentences of each story locally, without the API (see extractive_summary).
+    executor : concurrent.futures.ProcessPoolExecutor, optional
+        Processes for the extractive engine.
+    processes : int
+        The number of processes of the executor.
 
     Returns
     -------
@@ -36,62 +119,133 @@ def generate_summary(dir):
         
     """
     
-    filepath = f"../data/{dir}/{dir}_stories.csv"
-    print(f'Generating plot summary from {filepath}...\n')
+    filepath = paths.country_file(dir, "stories")
+    print(f'Generating plot summary from {filepath}{" (extractive)" if engine == "extractive" else ""}...\n')
     
-    results = []
     df = pd.read_csv(filepath)
+    if engine == "extractive":
+        results = extractive_summaries(df['Story'].fillna("").astype(str).tolist(), executor, processes)
+        instrumentation.add_items(len(results))
+        save_summaries(dir, df, results, "extractive", EXTRACTIVE_PROMPT)
+        return df
 
-    for index, row in df.iterrows():
-        story = row['Story']
+    # Summaries finished by an earlier run that ran out of budget
+    finished = load_checkpoint(dir)
+
+    def summarize(index):
+        story_id = df.iloc[index, 0]
         print(f"•Processing story {index + 1} of {len(df)}...")
+        return story_id, summarize_story(dir, story_id, df['Story'].iloc[index])
+
+    # Summarize the stories not finished yet, several at a time (see openai_client.py)
+    todo = [index for index, story_id in enumerate(df.iloc[:, 0]) if story_id not in finished]
+    try:
+        for _, (story_id, plot_sum) in openai_client.map(summarize, todo):
+            finished[story_id] = plot_sum
+    except token_usage.BudgetExhausted:
+        save_checkpoint(dir, finished)
+        raise
+
+    save_gpt_summaries(dir, df, finished)
+    return df
 
-        prompt = f"In English, write a 50 word plot summary of this story:\n\n{story}"
-        model = "gpt-4o-mini"
-        # Get main character name
-        messages = messages = [{"role": "system", "content": ""}]
-        messages.append({"role": "user", "content": prompt})
-        main_char_response = openai.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.8,
-        )
-        plot_sum = main_char_response.choices[0].message.content.strip()
-        print('-------------------\n' + plot_sum + '\n-------------------\n\n')
-        results.append(plot_sum)
 
+def summarize_story(dir, story_id, story, ledger_id=None):
+    """
+    Ask gpt-4o-mini for a 50 word summary of one story, logging the request in the country's token
+    usage ledger under ledger_id (the story_id by default).
+    """
+    prompt = f"In English, write a 50 word plot summary of this story:\n\n{story}"
+    messages = [{"role": "system", "content": ""}]
+    messages.append({"role": "user", "content": prompt})
+
+    token_usage.before_request("summary", dir)
+    start = perf_counter()
+    response = openai_client.create(
+        model=GPT_MODEL,
+        messages=messages,
+        temperature=0.8,
+    )
+    instrumentation.record_api_call(perf_counter() - start, response.usage)
+    instrumentation.add_items()
+    token_usage.record("summary", dir, ledger_id or story_id, GPT_MODEL, response.usage)
+    plot_sum = response.choices[0].message.content.strip()
+    instrumentation.echo('-------------------\n' + plot_sum + '\n-------------------\n\n')
+    return plot_sum
+
+
+def load_checkpoint(dir):
+    """
+    The summaries (Story_ID -> summary) finished by an earlier run that ran out of budget.
+    """
+    done = token_usage.load_checkpoint(dir, "summary")
+    return dict(zip(done['Story_ID'], done['Summaries'])) if done is not None else {}
+
+
+def save_checkpoint(dir, finished):
+    token_usage.save_checkpoint(dir, "summary", pd.DataFrame({'Story_ID': list(finished), 'Summaries': list(finished.values())}))
+
+
+def save_gpt_summaries(dir, df, finished):
+    """
+    Save the GPT summaries once every story of df has one, and drop the checkpoint.
+    """
+    results = [finished[story_id] for story_id in df.iloc[:, 0]]
+    save_summaries(dir, df, results, GPT_MODEL, GPT_PROMPT)
+    token_usage.clear_checkpoint(dir, "summary")
+
+
+def save_summaries(dir, df, results, model, prompt):
+    """
+    Save the summary of each story to <CC>_summaries.csv, with the prompt (or method) and model that wrote them.
+    """
     summary_df = pd.DataFrame()
     story_ids = df.iloc[:, 0].tolist()
     summary_df['Story_ID'] = story_ids
     summary_df['Summaries'] = results
-    summary_df['Prompt'] = "In English, write a 50 word plot summary of this story: [STORY]"
+    summary_df['Prompt'] = prompt
     summary_df['Model'] = model
     summary_df['Date'] = date.today().strftime("%d-%m-%Y") 
 
-    output_filepath = f'../data/{dir}/{dir}_summaries.csv'
+    output_filepath = paths.country_file(dir, "summaries")
     summary_df.to_csv(output_filepath, index=False)
-    return df
 
 
 
-def main(countries, startfrom):
+def main(countries, startfrom, engine="gpt", processes=None):
+    """
+    processes is the number of processes for the extractive engine (default: the number of CPUs).
+    One pool serves all the countries.
+    """
+    if engine == "extractive":
+        processes = processes or os.cpu_count() or 1
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                summarize_countries(countries, startfrom, engine, executor, processes)
+        else:
+            summarize_countries(countries, startfrom, engine)
+        return
+
     # Load the API key
     load_api_key()
+    summarize_countries(countries, startfrom, engine)
 
+
+def summarize_countries(countries, startfrom, engine="gpt", executor=None, processes=1):
     if 'all' in countries and len(countries) == 1:
-        for dir in sorted(os.listdir("../data")):
-            if dir == '.DS_Store':
-                continue
+        for dir in paths.list_country_dirs():
             if startfrom != "" and startfrom != dir:
                 continue
             else:
                 startfrom = ""
-                generate_summary(dir)
+                with instrumentation.stage("summary", dir):
+                    generate_summary(dir, engine, executor, processes)
     
     else:
-        for dir in sorted(os.listdir("../data")):
+        for dir in paths.list_country_dirs():
             if dir in countries:
-                generate_summary(dir)
+                with instrumentation.stage("summary", dir):
+                    generate_summary(dir, engine, executor, processes)
 
 
 
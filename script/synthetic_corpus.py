@@ -0,0 +1,184 @@
+import os
+import re
+import csv
+import click
+import numpy as np
+import pandas as pd
+from collections import Counter
+from datetime import date
+import paths
+
+
+EMOTIONS = ['sadness', 'joy', 'love', 'anger', 'fear', 'surprise']  # In the order of sentiment_huggingface.EMOTIONS
+STORIES_PER_COUNTRY = 50  # Size of the real corpus: 50 stories for each country
+
+
+def load_source_material(source_dir, sample_countries=20, seed=0):
+    """
+    Collect sentences, titles and names from the real corpus to build synthetic stories from.
+
+    Resampling real sentences keeps the vocabulary and sentence lengths realistic, so spaCy
+    and TextBlob do about the same amount of work per word as on the real stories.
+
+    Parameters
+    ----------
+    source_dir : str
+        The data directory of the real corpus (one folder per country).
+    sample_countries : int
+        How many countries to read sentences from.
+    seed : int
+        Seed for choosing the countries.
+
+    Returns
+    -------
+    dict
+        Lists of 'sentences', 'titles' and 'names'.
+    """
+    rng = np.random.default_rng(seed)
+    with paths.use_data_dir(source_dir):
+        countries = paths.list_country_dirs()
+    if len(countries) > sample_countries:
+        countries = sorted(rng.choice(countries, size=sample_countries, replace=False))
+
+    sentences, titles, names = [], [], []
+    for country in countries:
+        stories_file = f"{source_dir}/{country}/{country}_stories.csv"
+        names_file = f"{source_dir}/{country}/{country}_names.csv"
+        if os.path.exists(stories_file):
+            stories = pd.read_csv(stories_file, usecols=['Story'])['Story'].dropna().astype(str)
+            titles.extend(stories.str.extract(r"\*\*Title: (.*?)\*\*")[0].dropna().tolist())
+            # Drop markdown headings so the resampled text is plain prose
+            body = stories.str.replace(r"\*\*.*?\*\*", " ", regex=True)
+            for text in body:
+                sentences.extend(s.strip() for s in re.split(r"(?<=[.!?])\s+", text) if len(s.split()) > 3)
+        if os.path.exists(names_file):
+            names.extend(pd.read_csv(names_file)['Name'].dropna().astype(str).tolist())
+
+    if not sentences:
+        raise ValueError(f"No stories found in {source_dir} to build a synthetic corpus from.")
+
+    return {'sentences': sentences, 'titles': titles or ["The Whispering Pines"], 'names': names or ["Elin"]}
+
+
+def synthesize_story(rng, sentences, titles, num_sentences):
+    """
+    Build one story from a random title and num_sentences randomly drawn sentences.
+    """
+    picked = rng.integers(0, len(sentences), size=num_sentences)
+    title = titles[rng.integers(0, len(titles))]
+    body = " ".join(sentences[i] for i in picked)
+    return f"**Title: {title}**\n\n{body}"
+
+
+def build_corpus(output_dir, source_dir="../data", scale=1.0, countries=None, seed=0):
+    """
+    Write a synthetic corpus with the same layout and columns as the real one.
+
+    Every country gets round(50 * scale) stories plus the per-country files the later stages
+    read (summaries, names per country and per story, sentiments and emotion scores, word frequencies, lemma counts
+    per story and noun phrases), so each stage can be run on its own without calling the OpenAI
+    API or the transformer model first.
+
+    Parameters
+    ----------
+    output_dir : str
+        Where to write the corpus. One folder per country is created inside it.
+    source_dir : str
+        The real data directory to draw sentences, titles and names from.
+    scale : float
+        Size relative to the real corpus, e.g. 1 for 50 stories per country and 100 for 5000.
+    countries : list of str, optional
+        Country codes to generate. Defaults to every country in source_dir.
+    seed : int
+        Seed for the random generator, so the same arguments give the same corpus.
+
+    Returns
+    -------
+    dict
+        Number of countries, stories and words written.
+    """
+    rng = np.random.default_rng(seed)
+    material = load_source_material(source_dir, seed=seed)
+    sentences, titles, names = material['sentences'], material['titles'], material['names']
+
+    if not countries:
+        with paths.use_data_dir(source_dir):
+            countries = paths.list_country_dirs()
+    num_stories = max(1, round(STORIES_PER_COUNTRY * scale))
+    # Draw enough sentences to reach the 1500 words the real prompt asks for
+    num_sentences = int(1500 / np.mean([len(s.split()) for s in sentences])) + 1
+    today = date.today().strftime("%d-%m-%Y")
+    total_words = 0
+
+    for country in countries:
+        directory = f"{output_dir}/{country}"
+        os.makedirs(directory, exist_ok=True)
+        story_ids = [f"{country}_{i + 1}" for i in range(num_stories)]
+        stories = [synthesize_story(rng, sentences, titles, num_sentences) for _ in story_ids]
+        total_words += sum(len(story.split()) for story in stories)
+
+        pd.DataFrame({
+            'Story_ID': story_ids,
+            'ISO-3361': country,
+            'Country_Name': country,
+            'Demonym': country,
+            'Story': stories,
+            'Prompt': "Write a 1500 word potential story.",
+            'Date': today,
+            'GPT_Model': "synthetic",
+            'Temperature': 0.8,
+        }).to_csv(f"{directory}/{country}_stories.csv", index=False, quoting=csv.QUOTE_ALL)
+
+        # 50 word summaries taken from the start of each story body
+        summaries = [" ".join(story.split("\n\n", 1)[-1].split()[:50]) for story in stories]
+        pd.DataFrame({
+            'Story_ID': story_ids,
+            'Summaries': summaries,
+            'Prompt': "In English, write a 50 word plot summary of this story: [STORY]",
+            'Model': "synthetic",
+            'Date': today,
+        }).to_csv(f"{directory}/{country}_summaries.csv", index=False)
+
+        protagonist_names = [names[i] for i in rng.integers(0, len(names), size=num_stories)]
+        protagonists = Counter(protagonist_names)
+        pd.DataFrame(protagonists.most_common(), columns=['Name', 'Count']).to_csv(f"{directory}/{country}_names.csv", index=False)
+        pd.DataFrame({'Story_ID': story_ids, 'Name': protagonist_names}).to_csv(f"{directory}/{country}_story_names.csv", index=False)
+
+        # Emotion probabilities summing to 1, with the top emotion and its score as the sentiment
+        scores = pd.DataFrame(rng.dirichlet(np.full(len(EMOTIONS), 0.5), size=num_stories).astype(np.float32),
+                              index=pd.Index(story_ids, name='story_id'), columns=EMOTIONS)
+        scores.to_parquet(f"{directory}/{country}_emotion_scores.parquet")
+        pd.DataFrame({
+            'story_id': story_ids,
+            'sentiment': scores.idxmax(axis=1).to_numpy(),
+            'confidence': scores.max(axis=1).round(2).to_numpy(),
+            'model': "synthetic",
+            'date': today,
+        }).to_csv(f"{directory}/{country}_sentiments.csv", index=False)
+
+        # Cheap stand-ins for the spaCy and TextBlob outputs so the combiners have input
+        words = Counter(w for story in stories for w in re.findall(r"[a-z]+", story.lower()) if len(w) > 3)
+        pd.DataFrame(words.most_common(), columns=['Word', 'Frequency']).to_csv(f"{directory}/{country}_word_freq.csv", index=False)
+        story_lemmas = [(story_id, word, count) for story_id, story in zip(story_ids, stories)
+                        for word, count in Counter(w for w in re.findall(r"[a-z]+", story.lower()) if len(w) > 3).items()]
+        pd.DataFrame(story_lemmas, columns=['Story_ID', 'Lemma', 'Count']).to_csv(f"{directory}/{country}_story_lemmas.csv", index=False)
+        pairs = Counter(" ".join(p) for story in stories for p in re.findall(r"\b([a-z]{4,}) ([a-z]{4,})\b", story.lower()))
+        pd.DataFrame(pairs.most_common(), columns=['Noun Phrase', 'Count']).to_csv(f"{directory}/{country}_noun_phrases.csv", index=False)
+
+    return {'countries': len(countries), 'stories': num_stories * len(countries), 'words': total_words}
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--scale', type=float, default=1.0, show_default=True, help='Corpus size relative to the real one (1 = 50 stories per country)')
+@click.option('-c', '--country', 'countries', multiple=True, help='Only generate these country codes')
+@click.option('--source', 'source_dir', default="../data", show_default=True, help='Real corpus to draw sentences from')
+@click.option('--seed', type=int, default=0, show_default=True)
+def cli(output_dir, scale, countries, source_dir, seed):
+    """Write a synthetic story corpus to OUTPUT_DIR."""
+    stats = build_corpus(output_dir, source_dir, scale, list(countries), seed)
+    print(f"Wrote {stats['stories']} stories ({stats['words']} words) for {stats['countries']} countries to {output_dir}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,135 @@
+"""
+Tests of the token buckets of openai_client, and of the circuit breaker of RateController against a
+local server that answers with a scripted sequence of status codes. Run with `python -m pytest` from script/.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openai
+import pytest
+from openai_client import RateController, TokenBucket
+
+COMPLETION = {"id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "test",
+              "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "A story."}}],
+              "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8}}
+
+
+def test_reservation_larger_than_capacity_leaves_no_extra_credit():
+    bucket = TokenBucket(100)
+    wait, reservation = bucket.reserve(250)
+    assert wait == 0 and reservation == (250, 100)
+    bucket.settle(reservation, 250)
+    # Used 250 of a 100 per minute limit: 150 in debt, not 100 - 100 + 250 - 250 = 0 or more
+    assert bucket.level == pytest.approx(-150, abs=1)
+    assert bucket.outstanding == 0
+
+
+def test_failed_reservation_is_given_back():
+    bucket = TokenBucket(100)
+    _, reservation = bucket.reserve(250)
+    bucket.settle(reservation, 0)
+    assert bucket.level == pytest.approx(100, abs=1)
+
+
+def test_seed_does_not_count_the_reporting_request_twice():
+    bucket = TokenBucket(1000)
+    _, own = bucket.reserve(100)  # The request whose response reports the limits
+    _, other = bucket.reserve(50)  # Still in flight, not in the API's remaining count yet
+    bucket.seed(1000, 600, counted=100)
+    assert bucket.level == pytest.approx(600 - 50, abs=1)
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    statuses = None  # Set by scripted_server: the status of each request in turn, then 200
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status = self.statuses.pop(0) if self.statuses else 200
+        body = COMPLETION if status == 200 else {"error": {"message": f"Scripted {status}", "type": "test"}}
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def scripted_server():
+    """
+    Start a server in a thread. Yields a function that takes the statuses to answer with and
+    returns a RateController sending to the server.
+    """
+    handler = type("Handler", (ScriptedHandler,), {"statuses": []})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def controller(statuses):
+        handler.statuses[:] = statuses
+        rate_controller = RateController(max_attempts=6, base_delay=0.01, max_delay=0.05,
+                                         failure_threshold=2, cooldown=0.2, seed=0)
+        rate_controller.client = openai.OpenAI(api_key="test", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                                               max_retries=0, timeout=5)
+        return rate_controller
+
+    yield controller
+    server.shutdown()
+
+
+def create_in_thread(rate_controller, timeout=10):
+    """
+    Send one request from a thread, failing the test if it does not return (or raise) within timeout seconds.
+    """
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = rate_controller.create(model="test", messages=[{"role": "user", "content": "Hi"}])
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"The request hung (breaker trial={rate_controller.breaker.trial})"
+    return outcome
+
+
+def test_trial_throttled_reopens_circuit_then_recovers(scripted_server):
+    # Two 500s open the circuit, the trial after the cooldown gets a 429, the next trial succeeds
+    rate_controller = scripted_server([500, 500, 429])
+    outcome = create_in_thread(rate_controller)
+
+    assert outcome['result'].choices[0].message.content == "A story."
+    assert rate_controller.stats == {'requests': 4, 'retries': 3, 'throttled': 1, 'errors': 2}
+    breaker = rate_controller.breaker
+    assert breaker.opened_at is None and not breaker.trial and breaker.failures == 0
+
+
+def test_trial_error_not_retried_reopens_circuit(scripted_server):
+    # The trial gets a 400, which is raised at once: the circuit must not stay half-open
+    rate_controller = scripted_server([500, 500, 400])
+    outcome = create_in_thread(rate_controller)
+
+    assert isinstance(outcome['error'], openai.BadRequestError)
+    breaker = rate_controller.breaker
+    assert breaker.opened_at is not None and not breaker.trial
+
+    # The next request waits for the cooldown and is the trial that closes the circuit again
+    outcome = create_in_thread(rate_controller)
+    assert 'result' in outcome
+    assert breaker.opened_at is None and not breaker.trial
+
+
+def test_throttling_alone_does_not_open_circuit(scripted_server):
+    rate_controller = scripted_server([429, 429, 429])
+    outcome = create_in_thread(rate_controller)
+
+    assert 'result' in outcome
+    assert rate_controller.breaker.opened_at is None
+    assert rate_controller.stats['throttled'] == 3
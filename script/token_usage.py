@@ -0,0 +1,224 @@
+"""
+Token usage and cost accounting for the scripts that call the OpenAI API.
+
+Every request is written to a per-country ledger, data/<CC>/<CC>_usage.csv, with the Story_ID it
+belongs to. A run can be given a budget (story_cli --budget-usd / --budget-tokens): once a set
+share of it is spent the requests are slowed down, and when it is used up the current stage saves
+the records it has finished to a checkpoint file and stops. Running the same command again (with
+-s <country> when processing all countries) picks up from the checkpoint instead of paying twice.
+"""
+
+import os
+import csv
+import time
+import threading
+from datetime import date
+import paths
+
+# USD per 1M tokens (input, output). Update when OpenAI changes its prices.
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+LEDGER_COLUMNS = ['Story_ID', 'Stage', 'Model', 'Prompt_Tokens', 'Completion_Tokens', 'Cost_USD', 'Date']
+
+_budget = None
+_unpriced = set()
+_lock = threading.Lock()  # The stages send requests from several threads (openai_client.py)
+
+
+class BudgetExhausted(Exception):
+    """
+    Raised before a request when the run's budget is used up.
+    """
+
+    def __init__(self, budget, stage, country):
+        self.stage = stage
+        self.country = country
+        super().__init__(f"Budget exhausted during {stage} for {country}: spent ${budget.spent_usd:.4f} "
+                         f"and {budget.spent_tokens} tokens ({budget.describe_limit()}).")
+
+
+class Budget:
+    """
+    A spending limit in USD and/or tokens for one run.
+
+    Parameters
+    ----------
+    usd : float, optional
+        Maximum cost of the run in USD.
+    tokens : int, optional
+        Maximum number of prompt + completion tokens for the run.
+    slow_down_at : float
+        Share of the budget after which requests are delayed.
+    max_delay : float
+        Delay in seconds added to each request just before the budget runs out. The delay grows
+        linearly from 0 at slow_down_at to max_delay at the limit.
+    """
+
+    def __init__(self, usd=None, tokens=None, slow_down_at=0.8, max_delay=10.0):
+        self.usd = usd
+        self.tokens = tokens
+        self.slow_down_at = slow_down_at
+        self.max_delay = max_delay
+        self.spent_usd = 0.0
+        self.spent_tokens = 0
+
+    def used(self):
+        """
+        Share of the budget spent so far (the larger of the USD and token shares).
+        """
+        shares = []
+        if self.usd:
+            shares.append(self.spent_usd / self.usd)
+        if self.tokens:
+            shares.append(self.spent_tokens / self.tokens)
+        return max(shares, default=0.0)
+
+    def delay(self):
+        """
+        Seconds to wait before the next request.
+        """
+        used = self.used()
+        if used <= self.slow_down_at:
+            return 0.0
+        return self.max_delay * min(1.0, (used - self.slow_down_at) / (1 - self.slow_down_at))
+
+    def describe_limit(self):
+        limits = []
+        if self.usd:
+            limits.append(f"limit ${self.usd}")
+        if self.tokens:
+            limits.append(f"limit {self.tokens} tokens")
+        return ", ".join(limits)
+
+
+def set_budget(usd=None, tokens=None, slow_down_at=0.8, max_delay=10.0):
+    """
+    Set the budget for the rest of the run. Without usd or tokens there is no limit.
+    """
+    global _budget
+    _budget = Budget(usd, tokens, slow_down_at, max_delay) if (usd or tokens) else None
+
+
+def cost(model, prompt_tokens, completion_tokens):
+    """
+    Cost in USD of one request, or 0 for models missing from PRICES.
+    """
+    if model not in PRICES:
+        if model not in _unpriced:
+            print(f"No price known for {model}, counting its cost as 0 (add it to PRICES in token_usage.py)")
+            _unpriced.add(model)
+        return 0.0
+    input_price, output_price = PRICES[model]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def before_request(stage, country):
+    """
+    Call before each API request. Waits when the budget is nearly spent and raises
+    BudgetExhausted when it is used up.
+    """
+    if _budget is None:
+        return
+    if _budget.used() >= 1:
+        raise BudgetExhausted(_budget, stage, country)
+    delay = _budget.delay()
+    if delay:
+        print(f"  {_budget.used():.0%} of budget used, waiting {delay:.1f}s before the next request")
+        time.sleep(delay)
+
+
+def record(stage, country, story_id, model, usage):
+    """
+    Add one request's token usage (response.usage) to the country's ledger and charge it to the budget.
+    """
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    request_cost = cost(model, prompt_tokens, completion_tokens)
+
+    with _lock:
+        if _budget is not None:
+            _budget.spent_usd += request_cost
+            _budget.spent_tokens += prompt_tokens + completion_tokens
+
+        filepath = paths.country_file(country, "usage")
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        new_file = not os.path.exists(filepath)
+        with open(filepath, 'a', newline='', encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(LEDGER_COLUMNS)
+            writer.writerow([story_id, stage, model, prompt_tokens, completion_tokens, round(request_cost, 8),
+                             date.today().strftime("%d-%m-%Y")])
+
+
+def summarize(by=('Stage', 'Country')):
+    """
+    Aggregate the ledgers of all countries.
+
+    Parameters
+    ----------
+    by : tuple of str
+        Columns to group by, any of 'Stage', 'Country', 'Model' and 'Date'.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Requests, prompt and completion tokens and cost per group.
+    """
+    import pandas as pd  # Not imported at the top so `story_cli.py --help` and `generate` start quickly
+
+    ledgers = []
+    for country in paths.list_country_dirs():
+        filepath = paths.country_file(country, "usage")
+        if os.path.exists(filepath):
+            ledger = pd.read_csv(filepath)
+            ledger['Country'] = country
+            ledgers.append(ledger)
+    if not ledgers:
+        return pd.DataFrame(columns=list(by) + ['Requests', 'Prompt_Tokens', 'Completion_Tokens', 'Cost_USD'])
+
+    ledger = pd.concat(ledgers, ignore_index=True)
+    return ledger.groupby(list(by)).agg(
+        Requests=('Story_ID', 'size'),
+        Prompt_Tokens=('Prompt_Tokens', 'sum'),
+        Completion_Tokens=('Completion_Tokens', 'sum'),
+        Cost_USD=('Cost_USD', 'sum'),
+    ).reset_index()
+
+
+def checkpoint_file(country, stage):
+    return paths.country_file(country, f"{stage}_checkpoint")
+
+
+def load_checkpoint(country, stage):
+    """
+    Return the records a stage finished for a country before it was stopped, or None.
+    """
+    filepath = checkpoint_file(country, stage)
+    if not os.path.exists(filepath):
+        return None
+    import pandas as pd
+    done = pd.read_csv(filepath)
+    print(f"Resuming {stage} for {country} from {filepath} ({len(done)} records already done)")
+    return done
+
+
+def save_checkpoint(country, stage, df):
+    """
+    Save the records a stage has finished for a country so a later run can skip them.
+    """
+    filepath = checkpoint_file(country, stage)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    df.to_csv(filepath, index=False, quoting=csv.QUOTE_ALL)
+    print(f"Saved {len(df)} finished records to {filepath}")
+
+
+def clear_checkpoint(country, stage):
+    filepath = checkpoint_file(country, stage)
+    if os.path.exists(filepath):
+        os.remove(filepath)
@@ -1,13 +1,14 @@
 import pandas as pd
-import spacy
 from collections import Counter
-import os
+import functools
+import paths
+import instrumentation
 
 
 
-def lemmatize_and_count(texts, nlp):
+def lemmatize_stories(texts, nlp):
     """
-    Perform lemmatization on a list of texts and count word frequencies.
+    Lemmatize each text and count its lemmas.
 
     This function uses SpaCy to lemmatize the words in the provided texts and
     counts the frequency of each lemma that is an alphabetic word and not a stopword.
@@ -16,12 +17,10 @@ def lemmatize_and_count(texts, nlp):
         texts (iterable of str): List or series of texts to process.
 
     Returns:
-        Counter: A Counter object with word frequencies.
+        list of Counter: The lemma frequencies of each text.
     """
-    word_freq = Counter()
-    for doc in nlp.pipe(texts, disable=['ner', 'parser']):
-        word_freq.update([token.lemma_.lower() for token in doc if token.is_alpha and not token.is_stop])
-    return word_freq
+    return [Counter(token.lemma_.lower() for token in doc if token.is_alpha and not token.is_stop)
+            for doc in nlp.pipe(texts, disable=['ner', 'parser'])]
 
 def word_frequency_with_lemmatization(dir, nlp):
     """
@@ -29,7 +28,8 @@ def word_frequency_with_lemmatization(dir, nlp):
 
     Reads a CSV file, extracts a column of text, lemmatizes the words, and calculates
     the frequency of each unique lemma. The results are saved to a new CSV file with
-    frequencies in descending order.
+    frequencies in descending order. The lemma counts of each story are saved as well, in long
+    format (Story_ID, Lemma, Count), for the story vectors in analysis/script/story_vectors.py.
 
     Args:
         input_file (str): The path to the input CSV file.
@@ -40,16 +40,20 @@ def word_frequency_with_lemmatization(dir, nlp):
 
     list_of_names = get_names(dir)
 
-    filepath = f'../data/{dir}/{dir}_stories.csv'
+    filepath = paths.country_file(dir, "stories")
     print(f'\nCalculating word frequencies for {filepath}...\n')
 
     df = pd.read_csv(filepath)
 
     # Extract the target text column for processing
     text_column = df.iloc[:, 4].dropna().astype(str)  # Adjust column index if necessary
+    instrumentation.add_items(len(text_column))
 
-    # Perform lemmatization and count word frequencies
-    word_freq = lemmatize_and_count(text_column, nlp)
+    # Perform lemmatization and count word frequencies, per story and in total
+    story_counts = lemmatize_stories(text_column, nlp)
+    word_freq = Counter()
+    for counts in story_counts:
+        word_freq.update(counts)
 
     # Convert the frequency data to a DataFrame and sort by frequency
     word_freq_df = pd.DataFrame(word_freq.items(), columns=['Word', 'Frequency'])
@@ -62,40 +66,60 @@ def word_frequency_with_lemmatization(dir, nlp):
     print(f'{word_freq_df.head()}')  # Display top counts for each file
 
     # Create output file name based on input file name
-    output_file = f'../data/{dir}/{dir}_word_freq.csv'
+    output_file = paths.country_file(dir, "word_freq")
 
     # Save the word frequency data to a CSV file
     word_freq_df.to_csv(output_file, index=False)
-    print(f'\nWord frequency saved to {output_file}\n\n--------------------\n')
+    print(f'\nWord frequency saved to {output_file}')
+
+    # Per-story lemma counts, without names like the totals
+    story_ids = df.loc[text_column.index].iloc[:, 0]
+    story_lemmas_df = pd.DataFrame(
+        [(story_id, lemma, count) for story_id, counts in zip(story_ids, story_counts) for lemma, count in counts.items()],
+        columns=['Story_ID', 'Lemma', 'Count'])
+    story_lemmas_df = story_lemmas_df[~story_lemmas_df['Lemma'].isin(list_of_names)]
+    story_lemmas_file = paths.country_file(dir, "story_lemmas")
+    story_lemmas_df.to_csv(story_lemmas_file, index=False)
+    print(f'Lemma counts per story saved to {story_lemmas_file}\n\n--------------------\n')
 
 def get_names(dir):
     """
     Get a list of names from a text file and lower.
     """
-    with open(f'../data/{dir}/{dir}_names.csv', 'r') as f:
+    with open(paths.country_file(dir, "names"), 'r') as f:
         df = pd.read_csv(f)
         names = df['Name'].str.lower().tolist()
         
     return names
 
 
+@functools.lru_cache(maxsize=None)
+def load_nlp():
+    """
+    Load SpaCy's English language model once per process, so an experiment grid (experiment_grid.py)
+    running this stage for many cells loads it only once. spaCy is imported here so other commands
+    don't pay for importing it.
+    """
+    import spacy
+    return spacy.load('en_core_web_sm')
+
+
 def main(countries, startfrom):
-    # Load SpaCy's English language model
-    nlp = spacy.load('en_core_web_sm')
+    nlp = load_nlp()
     
     if 'all' in countries and len(countries) == 1:
-        for dir in sorted(os.listdir(f'../data/')):
-            if dir == '.DS_Store':
-                continue
+        for dir in paths.list_country_dirs():
             if startfrom != "" and startfrom != dir:
                 continue
             else:
                 startfrom = ""
-                word_frequency_with_lemmatization(dir, nlp)
+                with instrumentation.stage("words", dir):
+                    word_frequency_with_lemmatization(dir, nlp)
     else:
-        for dir in sorted(os.listdir(f'../data/')):
+        for dir in paths.list_country_dirs():
             if dir in countries:
-                word_frequency_with_lemmatization(dir, nlp)
+                with instrumentation.stage("words", dir):
+                    word_frequency_with_lemmatization(dir, nlp)
     
 
 
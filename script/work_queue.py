@@ -0,0 +1,294 @@
+"""
+A work queue of (stage, country) tasks on a shared filesystem, to run the pipeline on several machines.
+
+The coordinator (`story_cli.py queue enqueue`) writes one JSON file per task to <queue>/pending/.
+Workers (`story_cli.py queue work`, any number of processes on any host that mounts the data
+directory) claim a task by renaming its file into <queue>/leased/ with their worker id in the
+name. A rename is atomic, so every task goes to exactly one worker. While a worker runs a task it
+touches its lease file every few seconds. A lease that has not been touched for lease_timeout
+seconds belongs to a worker that died: the next worker that looks renames it back to pending/ and
+the task is run again. Finished tasks are moved to done/, and tasks that raised to failed/ with
+the error.
+
+A task is only claimed once the tasks that build its inputs are finished (generate before
+summary, summary before sentiment, names before words), following manifest.STAGES. The stages
+write to the normal <data dir>/<CC>/ files, and a worker that lost its lease does not mark the
+task done. The hosts' clocks are compared through the file modification times, so they should
+be roughly in sync.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+from datetime import datetime
+import paths
+import manifest
+import token_usage
+
+STATES = ['pending', 'leased', 'done', 'failed']
+
+# The order the stages are claimed in. Stage -> the per-country files it reads and writes.
+STAGE_FILES = {'generate': {'inputs': [], 'outputs': ['stories']},
+               **{stage: {'inputs': spec['inputs'], 'outputs': spec['outputs']} for stage, spec in manifest.STAGES.items()}}
+
+
+def dependencies(stage):
+    """
+    The stages that write the inputs of a stage, e.g. dependencies('sentiment') -> ['summary'].
+    """
+    inputs = set(STAGE_FILES[stage]['inputs'])
+    return [other for other, files in STAGE_FILES.items() if other != stage and inputs & set(files['outputs'])]
+
+
+def queue_dir():
+    """
+    The default queue directory, hidden among the countries in the data directory: ../data/.queue
+    """
+    return os.path.join(paths.DATA_DIR, ".queue")
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    The task files in a queue directory, one sub-directory per state.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for state in STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def path(self, state, name):
+        return os.path.join(self.directory, state, name)
+
+    def files(self, state):
+        return sorted(name for name in os.listdir(os.path.join(self.directory, state)) if name.endswith(".json") and not name.startswith("."))
+
+    def tasks(self, state):
+        """
+        The task names ("<stage>_<CC>") in a state. Leased files are named <task>@<worker>.json.
+        """
+        return [name[:-len(".json")].split("@")[0] for name in self.files(state)]
+
+    def read(self, state, name):
+        with open(self.path(state, name), encoding="utf-8") as f:
+            return json.load(f)
+
+    def enqueue(self, stage, country, options=None):
+        """
+        Add a task, unless it is already waiting or running. A finished or failed task is queued again.
+
+        Returns
+        -------
+        bool
+            Whether the task was added.
+        """
+        task = f"{stage}_{country}"
+        if task in self.tasks('pending') or task in self.tasks('leased'):
+            return False
+        for state in ('done', 'failed'):
+            if os.path.exists(self.path(state, f"{task}.json")):
+                os.remove(self.path(state, f"{task}.json"))
+        # Written next to the states and renamed in, so no worker reads half a file
+        temporary = os.path.join(self.directory, f".{task}.{os.getpid()}.tmp")
+        with open(temporary, 'w', encoding="utf-8") as f:
+            json.dump({'stage': stage, 'country': country, 'options': options or {},
+                       'enqueued': datetime.now().isoformat(timespec="seconds")}, f)
+        os.replace(temporary, self.path('pending', f"{task}.json"))
+        return True
+
+    def is_ready(self, task, waiting):
+        """
+        Whether none of the tasks building a task's inputs is still pending, leased or failed.
+        """
+        stage, country = task.split("_", 1)
+        return not any(f"{other}_{country}" in waiting for other in dependencies(stage))
+
+    def claim(self, worker):
+        """
+        Lease the first ready task to worker, in stage order.
+
+        Returns
+        -------
+        str or None
+            The lease file name, or None if no task is ready.
+        """
+        waiting = set(self.tasks('pending')) | set(self.tasks('leased')) | set(self.tasks('failed'))
+        order = list(STAGE_FILES)
+        pending = sorted(self.tasks('pending'), key=lambda task: (order.index(task.split("_", 1)[0]), task))
+        for task in pending:
+            if not self.is_ready(task, waiting):
+                continue
+            lease = f"{task}@{worker}.json"
+            try:
+                os.rename(self.path('pending', f"{task}.json"), self.path('leased', lease))
+            except FileNotFoundError:
+                continue  # Another worker claimed it first
+            os.utime(self.path('leased', lease))
+            return lease
+        return None
+
+    def reclaim_expired(self, lease_timeout):
+        """
+        Put the tasks whose lease was not renewed for lease_timeout seconds back in pending/.
+        """
+        reclaimed = []
+        now = time.time()
+        for lease in self.files('leased'):
+            try:
+                if now - os.path.getmtime(self.path('leased', lease)) <= lease_timeout:
+                    continue
+                task = lease.split("@")[0]
+                os.rename(self.path('leased', lease), self.path('pending', f"{task}.json"))
+            except FileNotFoundError:
+                continue  # Finished, or reclaimed by another worker
+            print(f"Lease {lease[:-len('.json')]} expired, {task} is pending again")
+            reclaimed.append(task)
+        return reclaimed
+
+    def finish(self, lease, state, error=None):
+        """
+        Move a lease to done/ or failed/ (with the error). Returns False if the lease was lost.
+        """
+        task = lease.split("@")[0]
+        try:
+            if error is not None:
+                record = self.read('leased', lease)
+                record.update(error=error, worker=lease[len(task) + 1:-len(".json")],
+                              failed=datetime.now().isoformat(timespec="seconds"))
+                with open(self.path('leased', lease), 'w', encoding="utf-8") as f:
+                    json.dump(record, f)
+            os.rename(self.path('leased', lease), self.path(state, f"{task}.json"))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release(self, lease):
+        """
+        Give a task back to the queue straight away, e.g. when its worker is stopped with Ctrl-C.
+        """
+        try:
+            os.rename(self.path('leased', lease), self.path('pending', f"{lease.split('@')[0]}.json"))
+        except FileNotFoundError:
+            pass
+
+    def retry_failed(self):
+        """
+        Move the failed tasks back to pending/.
+        """
+        tasks = self.tasks('failed')
+        for task in tasks:
+            record = self.read('failed', f"{task}.json")
+            self.enqueue(record['stage'], record['country'], record['options'])
+        return tasks
+
+
+class Heartbeat:
+    """
+    Touch a lease file every interval seconds from a background thread. lost is set once the file
+    is gone, i.e. the lease expired and was reclaimed by another worker.
+    """
+
+    def __init__(self, filepath, interval):
+        self.filepath = filepath
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.filepath)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def work(queue, run_task, lease_timeout=300, poll=2.0, worker=None):
+    """
+    Claim and run tasks until the queue has none left that can be run.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The queue to take tasks from.
+    run_task : callable
+        Called with the task dict (stage, country and options) to run it.
+    lease_timeout : float
+        Seconds without a heartbeat after which a lease counts as abandoned.
+    poll : float
+        Seconds to wait before looking again when every task left is leased or waiting for one.
+    worker : str, optional
+        Name of this worker in the lease files (default: <host>-<pid>).
+
+    Returns
+    -------
+    dict
+        The number of tasks this worker finished ('done'), that failed ('failed') and whose lease it lost ('lost').
+    """
+    worker = worker or worker_name()
+    counts = {'done': 0, 'failed': 0, 'lost': 0}
+    while True:
+        queue.reclaim_expired(lease_timeout)
+        lease = queue.claim(worker)
+        if lease is None and not queue.files('leased'):
+            # Look once more, as the last running task may have finished after the first look
+            lease = queue.claim(worker)
+            if lease is None:
+                blocked = queue.tasks('pending')
+                if blocked:
+                    print(f"{worker}: {len(blocked)} tasks wait for failed tasks ({', '.join(queue.tasks('failed'))})")
+                break
+        if lease is None:
+            time.sleep(poll)
+            continue
+
+        task = queue.read('leased', lease)
+        print(f"{worker}: running {task['stage']} for {task['country']}")
+        error = None
+        try:
+            with Heartbeat(queue.path('leased', lease), max(lease_timeout / 5, 0.1)) as heartbeat:
+                run_task(task)
+        except token_usage.BudgetExhausted:
+            # Not the task's fault: leave it for a worker with budget left
+            queue.release(lease)
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"{worker}: {task['stage']} for {task['country']} failed: {error}")
+        except BaseException:
+            queue.release(lease)
+            raise
+
+        if heartbeat.lost or not queue.finish(lease, 'failed' if error else 'done', error):
+            print(f"{worker}: lost the lease of {task['stage']} for {task['country']}, another worker runs it again")
+            counts['lost'] += 1
+        else:
+            counts['failed' if error else 'done'] += 1
+    return counts
+
+
+def status(queue):
+    """
+    The number of tasks in each state, per stage, as {stage: {state: count}}.
+    """
+    counts = {}
+    for state in STATES:
+        for task in queue.tasks(state):
+            stage = task.split("_", 1)[0]
+            counts.setdefault(stage, dict.fromkeys(STATES, 0))[state] += 1
+    return counts